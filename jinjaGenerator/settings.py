@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -126,4 +127,70 @@ STATIC_URL = 'static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 MEDIA_URL = '/media/'
-MEDIA_ROOT = BASE_DIR / 'media'
\ No newline at end of file
+MEDIA_ROOT = BASE_DIR / 'media'
+
+# Renderer
+
+# Seconds a template folder fingerprint is reused before the folder is scanned again for changes
+TEMPLATE_FINGERPRINT_TTL = 2.0
+# Uploaded templates: content-addressed files and one immutable folder per version, see main/template_store.py
+TEMPLATE_STORE_DIR = BASE_DIR / 'templates' / '.store'
+# Seconds a replaced template version is kept for the renders still reading it, before it can be pruned
+TEMPLATE_VERSION_RETENTION = 3600
+# Seconds the in-memory registry of templates (main/template_registry.py) is used before being reloaded from the
+# database in the background, None never reloads it: only right for a single server process, the others would not
+# see new uploads
+TEMPLATE_REGISTRY_TTL = 60
+# Templates whose environment, manifest and compiled templates are built at startup and after each upload:
+# None for all of them, a list of names for a hot set, [] builds them on the first render only
+TEMPLATE_WARM_UP = None
+
+# Workers rendering and writing the output files of a single render, 0 or 1 renders them one after another
+RENDER_WORKERS = 0
+# Pool used when RENDER_WORKERS > 1: 'thread' or 'process'
+RENDER_EXECUTOR = 'thread'
+# Bytes read at once from static files streamed into a ZIP response
+RENDER_STREAM_CHUNK_SIZE = 64 * 1024
+# Write buffer of the rendered files, Jinja2 output is streamed through it instead of being joined in memory first
+RENDER_WRITE_BUFFER_SIZE = 1024 * 1024
+# How static files are put in the output folder: 'auto' (reflink, then copy_file_range, then copy), 'hardlink',
+# 'reflink', 'copy_file_range' or 'copy'. Hardlinked outputs share their content with the uploaded template
+RENDER_STATIC_STRATEGY = 'auto'
+# Keep the previous output of a template and only rewrite the files whose content changed
+RENDER_INCREMENTAL = False
+# Incremental renders record the top-level context keys read by each template output, and only render again the
+# outputs whose keys or '_path' changed since the previous render. Those renders do not use the render cache
+RENDER_TRACK_DEPENDENCIES = True
+# Rendered outputs kept in memory, keyed by template version, context, template path and '_path'. 0 disables the cache
+RENDER_CACHE_MAX_ENTRIES = 10000
+RENDER_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# Larger outputs are streamed to their file without being kept in memory for the render cache
+RENDER_CACHE_MAX_ENTRY_BYTES = 1024 * 1024
+# Background render jobs (/template/render/jobs): concurrent jobs, jobs waiting for a worker, seconds a finished job is kept
+RENDER_JOB_WORKERS = 2
+RENDER_JOB_QUEUE_SIZE = 16
+RENDER_JOB_RETENTION = 3600
+# Output folders of a single render (render jobs, /template/render?workspace=1) under toutput/.workspaces:
+# seconds a finished one is kept, and bytes all of them may take before the oldest finished ones are deleted
+RENDER_WORKSPACE_RETENTION = 3600
+RENDER_WORKSPACE_MAX_BYTES = 1024 * 1024 * 1024
+# Log level of the renderer: INFO logs one summary per render, DEBUG also every resolved and written file
+RENDER_LOG_LEVEL = os.environ.get('RENDER_LOG_LEVEL', 'INFO')
+# Value of the X-Profiling-Token header allowing /template/render?profile=... besides staff users, unset disables it
+RENDER_PROFILING_TOKEN = os.environ.get('RENDER_PROFILING_TOKEN', None)
+# Import the python helpers of a template (filters, tests, ...) on first use instead of when its environment is built.
+# Helpers whose constants the templates use are still imported upfront
+RENDER_LAZY_HELPERS = True
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'main.renderer': {'handlers': ['console'], 'level': RENDER_LOG_LEVEL, 'propagate': False},
+        'main.template_registry': {'handlers': ['console'], 'level': RENDER_LOG_LEVEL, 'propagate': False},
+        'main.jobs': {'handlers': ['console'], 'level': RENDER_LOG_LEVEL, 'propagate': False},
+    },
+}
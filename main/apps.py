@@ -1,6 +1,31 @@
+import os
+import sys
+
 from django.apps import AppConfig
 
 
+def _serves_requests():
+    """
+    Whether this process is about to serve requests: the WSGI / ASGI module of the project is being imported by a
+    server, or this is the runserver process that serves (not the autoreloader parent). Other management commands
+    and scripts setting Django up do not warm templates up.
+    """
+    if 'jinjaGenerator.wsgi' in sys.modules or 'jinjaGenerator.asgi' in sys.modules:
+        return True
+    if os.path.basename(sys.argv[0]) != 'manage.py' or len(sys.argv) < 2 or sys.argv[1] != 'runserver':
+        return False
+    return '--noreload' in sys.argv or os.environ.get('RUN_MAIN') == 'true'
+
+
 class MainConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'main'
+
+    def ready(self):
+        from jinjaGenerator.settings import TEMPLATE_WARM_UP
+        from .template_registry import start_warm_up
+
+        # load the template registry and build the environments of the templates off the request path,
+        # on a thread since the database should not be queried while apps are being set up
+        if _serves_requests():
+            start_warm_up(TEMPLATE_WARM_UP)
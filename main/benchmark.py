@@ -0,0 +1,230 @@
+"""
+Benchmarks of the resolver and renderer hot paths on synthetic templates, run with `python manage.py benchmark`.
+Everything is generated in a temporary folder, nothing is downloaded.
+"""
+import contextlib
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from jinjaGenerator.settings import BASE_DIR
+from .renderer.loader import create_jinja_env, compile_templates
+from .renderer.manifest import build_manifest
+from .renderer.render_cache import render_cache
+from .renderer.renderer import render
+from .renderer.wildcard_resolver import resolve_path
+
+# format of the results file, incremented when its structure changes
+RESULTS_VERSION = 1
+
+__FILTERS = '''
+def snake(value):
+    return value.replace('-', '_').lower()
+
+def prefix(value, text):
+    return text + value
+
+def suffix(value, text='_'):
+    return value + text
+'''
+
+__FRAGMENT = '''# {{ project }} / {{ name }}
+{% for field in fields %}#   {{ field.name }}: {{ field.type }}
+{% endfor %}'''
+
+__MACROS = '''{% macro field(f) %}    {{ f.name }}: {{ f.type }} = None{% endmacro %}'''
+
+__MODEL_TEMPLATE = '''{{ render_fragment('header.txt', {'name': _path.models.name, 'fields': []}, pure=True) }}
+{% import 'macros/fields' as m %}
+class {{ _path.models.name | capitalize }}:
+{% for model in models %}{% if model.name == _path.models.name %}{% for f in model.fields %}{{ m.field(f) }}
+{% endfor %}{% endif %}{% endfor %}'''
+
+__FIELD_TEMPLATE = '''{{ render_fragment('header.txt', {'name': _path.models.fields.name, 'fields': []}) }}
+{{ _path.models.fields.name }}'''
+
+__INDEX_TEMPLATE = '''{% for model in models %}{{ model.name }}: {{ model.fields | length }} fields
+{% endfor %}'''
+
+
+def generate_template(folder, assets=4, asset_size=1024 * 1024):
+    """
+    Write a synthetic template into folder: a per-model template, a nested per-field fan-out through chained filters,
+    pure and impure fragments, a macro, an index without wildcards and large static assets.
+    """
+    files = {
+        'filters/bench.py': __FILTERS,
+        'fragments/header.txt': __FRAGMENT,
+        'macros/fields': __MACROS,
+        'project/index.txt.j2': __INDEX_TEMPLATE,
+        'project/models/%models.name%.py.j2': __MODEL_TEMPLATE,
+        "project/fields/%models.fields.name$snake$prefix('f_')$suffix%.txt.j2": __FIELD_TEMPLATE,
+    }
+    for relative_path, content in files.items():
+        path = os.path.join(folder, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(content)
+    os.makedirs(os.path.join(folder, 'project', 'assets'), exist_ok=True)
+    for i in range(assets):
+        with open(os.path.join(folder, 'project', 'assets', f'asset_{i}.bin'), 'wb') as f:
+            f.write(os.urandom(asset_size))
+
+def generate_context(models=100, fields=10):
+    return {
+        "project": "bench",
+        "models": [
+            {
+                "name": f"model-{i}",
+                "fields": [{"name": f"model-{i}-field-{j}", "type": "str" if j % 2 else "int"} for j in range(fields)],
+            }
+            for i in range(models)
+        ],
+    }
+
+
+def __summary(durations):
+    return {
+        "runs": len(durations),
+        "min": min(durations),
+        "median": statistics.median(durations),
+        "mean": statistics.fmean(durations),
+        "max": max(durations),
+    }
+
+@contextlib.contextmanager
+def __quiet_logger(name):
+    logger = logging.getLogger(name)
+    level = logger.level
+    logger.setLevel(logging.WARNING)
+    try:
+        yield
+    finally:
+        logger.setLevel(level)
+
+def __timed(function, repeat):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return __summary(durations)
+
+def __git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=BASE_DIR, capture_output=True, text=True,
+                              timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def __time_view(template_folder, context, repeat, workspaces_dir):
+    """
+    Time POST /template/render through the Django test client, against a throwaway test database,
+    rendering into workspaces under workspaces_dir instead of toutput/.workspaces.
+    """
+    from django.test import Client
+    from django.test.utils import setup_test_environment, teardown_test_environment, setup_databases, \
+        teardown_databases
+    from .models import Template as TemplateModel
+    from .renderer import workspaces
+    from .template_registry import template_registry
+
+    setup_test_environment()
+    databases = setup_databases(verbosity=0, interactive=False)
+    default_workspaces_dir, workspaces.WORKSPACES_DIR = workspaces.WORKSPACES_DIR, workspaces_dir
+    try:
+        TemplateModel.objects.create(name='benchmark', folder=template_folder)
+        client = Client()
+        body = json.dumps(context)
+        output_folders = []
+
+        def post():
+            response = client.post('/template/render?template_name=benchmark&workspace=1', body,
+                                   content_type='application/json')
+            if response.status_code != 200:
+                raise RuntimeError(f"/template/render returned {response.status_code}: {response.content[:200]!r}")
+            output_folders.append(response.json()['output_folder'])
+        try:
+            return __timed(post, repeat)
+        finally:
+            for output_folder in output_folders:
+                workspaces.remove_workspace(output_folder)
+    finally:
+        workspaces.WORKSPACES_DIR = default_workspaces_dir
+        # the registry holds the templates of the test database, and would reload them from the real one
+        template_registry.clear()
+        teardown_databases(databases, verbosity=0)
+        teardown_test_environment()
+
+def run_benchmarks(models=100, fields=10, assets=4, asset_size=1024 * 1024, repeat=5, view=True, log=None) -> dict:
+    """
+    Generate a synthetic template and context, then time each hot path separately.
+    :param log: Called with a line of progress, nothing is reported when not given
+    :returns: results, as written by the benchmark command
+    """
+    log = log or (lambda line: None)
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='jinja-benchmark-') as temp_dir:
+        template_folder = os.path.join(temp_dir, 'benchmark')
+        output_folder = os.path.join(temp_dir, 'output')
+        generate_template(template_folder, assets, asset_size)
+        context = generate_context(models, fields)
+
+        log("create_jinja_env")
+        results['create_jinja_env'] = __timed(lambda: create_jinja_env(template_folder, precompiled=False), repeat)
+        compile_templates(template_folder)
+        results['create_jinja_env_precompiled'] = __timed(lambda: create_jinja_env(template_folder), repeat)
+
+        log("resolve_path")
+        env = create_jinja_env(template_folder)
+        wildcard_paths = [entry.path for entry in build_manifest(template_folder) if entry.has_wildcards]
+        resolved = [0]
+
+        def resolve_all():
+            resolved[0] = sum(len(resolve_path(path, context, env)) for path in wildcard_paths)
+        results['resolve_path'] = __timed(resolve_all, repeat)
+        results['resolve_path']['paths'] = resolved[0]
+
+        # log records of the renderer would be timed too
+        with __quiet_logger('main.renderer'):
+            log("render")
+
+            def render_cold():
+                render_cache.clear()
+                render(template_folder, context, output_folder=output_folder)
+            results['render'] = __timed(render_cold, repeat)
+            results['render_cached'] = __timed(lambda: render(template_folder, context, output_folder=output_folder),
+                                               repeat)
+            results['render_incremental'] = __timed(
+                lambda: render(template_folder, context, incremental=True, output_folder=output_folder), repeat)
+            if view:
+                log("/template/render")
+                results['view'] = __time_view(template_folder, context, repeat, os.path.join(temp_dir, 'workspaces'))
+        render_cache.clear()
+
+    return {
+        "version": RESULTS_VERSION,
+        "commit": __git_commit(),
+        "created_at": time.time(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "parameters": {"models": models, "fields": fields, "assets": assets, "asset_size": asset_size,
+                       "repeat": repeat},
+        "results": results,
+    }
+
+def compare_results(baseline, current) -> dict:
+    """
+    Ratio current / baseline of the median duration of every benchmark found in both, above 1 is slower.
+    """
+    return {
+        name: current['results'][name]['median'] / timing['median']
+        for name, timing in baseline['results'].items()
+        if name in current['results'] and timing['median'] > 0
+    }
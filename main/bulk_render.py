@@ -0,0 +1,184 @@
+"""
+Offline render of one template with many contexts on a process pool, run with `python manage.py bulk_render`.
+"""
+import json
+import logging
+import os
+import re
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from typing import NamedTuple, Optional
+
+from .renderer.renderer import render, render_zip_stream, warm_up_template
+from .renderer.timing import RenderTimings
+
+# characters kept in the name of an item, which names its output folder or archive
+__UNSAFE_NAME_CHARS = re.compile(r'[^A-Za-z0-9._-]')
+# template folder of a worker process, set once by __init_worker
+__worker_state = {}
+
+
+class BulkItem(NamedTuple):
+    """
+    Context to render, read from a JSON Lines file or a folder of JSON files.
+    """
+    index: int
+    name: str  # output folder or archive name, unique in the run
+    source: str  # file, with its line for JSON Lines, e.g. contexts.jsonl:12
+    context: Optional[dict]  # None when it could not be read
+    error: Optional[str] = None
+
+
+def __item_name(context, name_key, default):
+    name = context.get(name_key) if name_key and isinstance(context, dict) else None
+    name = __UNSAFE_NAME_CHARS.sub('_', str(name)) if name is not None else ''
+    return name.strip('.') or default
+
+def __parse_context(text):
+    context = json.loads(text)
+    if not isinstance(context, dict) or not context:
+        raise ValueError("a context must be a non empty JSON object")
+    return context
+
+def __read_sources(path):
+    """
+    Yield (default name, source, text) of every context: one per line of a JSON Lines file, or per '.json' file of
+    a folder, and one per line of its '.jsonl' files, sorted by file name.
+    """
+    if os.path.isdir(path):
+        for file_name in sorted(os.listdir(path)):
+            file_path = os.path.join(path, file_name)
+            if file_name.endswith('.json'):
+                with open(file_path, 'r', encoding='utf-8') as f:
+                    yield os.path.splitext(file_name)[0], file_path, f.read()
+            elif file_name.endswith('.jsonl'):
+                yield from __read_lines(file_path, os.path.splitext(file_name)[0] + '-')
+        return
+    yield from __read_lines(path, '')
+
+def __read_lines(file_path, prefix):
+    with open(file_path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            if line.strip():
+                yield f"{prefix}{line_number:06d}", f"{file_path}:{line_number}", line
+
+def read_items(path, name_key=None):
+    """
+    Yield the BulkItem of every context of path, lazily so a large file is not held in memory.
+    An item that can not be parsed is yielded with its error instead of its context.
+    :param name_key: Top-level key of the contexts naming their output, the line or file name when not given
+    """
+    names = set()
+    for index, (default_name, source, text) in enumerate(__read_sources(path)):
+        try:
+            context = __parse_context(text)
+        except ValueError as e:
+            yield BulkItem(index, default_name, source, None, f"Invalid context: {e}")
+            continue
+        name = __item_name(context, name_key, default_name)
+        if name in names:
+            yield BulkItem(index, name, source, None, f"Duplicate name '{name}'")
+            continue
+        names.add(name)
+        yield BulkItem(index, name, source, context)
+
+
+def __init_worker(template_folder, log_level):
+    # every worker builds the environment, the manifest and the compiled templates once, before its first item
+    logging.getLogger('main.renderer').setLevel(log_level)
+    __worker_state['template_folder'] = template_folder
+    warm_up_template(template_folder)
+
+def __render_item(item: BulkItem, output_folder, archive, incremental):
+    """
+    Render one item in a worker. Failures are reported in the result rather than raised, so the others go on.
+    """
+    template_folder = __worker_state['template_folder']
+    start = time.perf_counter()
+    result = {"index": item.index, "name": item.name, "source": item.source}
+    try:
+        if archive:
+            output_path = os.path.join(output_folder, item.name + '.zip')
+            size = 0
+            with open(output_path + '.tmp', 'wb') as f:
+                for chunk in render_zip_stream(template_folder, item.context):
+                    f.write(chunk)
+                    size += len(chunk)
+            os.replace(output_path + '.tmp', output_path)
+            # only reads the central directory at the end of the archive
+            with zipfile.ZipFile(output_path) as written:
+                files = len(written.namelist())
+            result.update(output=output_path, files=files, bytes=size)
+        else:
+            timings = RenderTimings()
+            output_path = render(template_folder, item.context, workers=0, incremental=incremental,
+                                 output_folder=os.path.join(output_folder, item.name), timings=timings,
+                                 use_cache=False)
+            phases = timings.phases
+            result.update(output=output_path, files=phases.get('outputs', (0, 0, 0))[0],
+                          bytes=sum(phases.get(phase, (0, 0, 0))[2] for phase in ('render', 'copy')))
+        result["status"] = 'done'
+    except Exception as e:
+        if archive and os.path.exists(output_path + '.tmp'):
+            os.remove(output_path + '.tmp')
+        result.update(status='failed', error=f"{type(e).__name__}: {e}")
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+def bulk_render(template_folder, items, output_folder, workers=None, archive=False, incremental=False,
+                log_level=logging.WARNING, on_result=None) -> dict:
+    """
+    Render the template folder with every item on a pool of worker processes, each writing its items into
+    output_folder/<name>/ or output_folder/<name>.zip. At most a few items per worker are read ahead.
+    :param items: BulkItem iterable, see read_items
+    :param workers: Worker processes, the CPU count when not given
+    :param incremental: Keep the output of the previous run of each item and only write what changed
+    :param log_level: Level of the renderer logs in the workers
+    :param on_result: Called with the result of every item when it finishes, in completion order
+    :returns: Summary of the run with the result of every item, in the order of the items
+    """
+    workers = workers or os.cpu_count() or 1
+    os.makedirs(output_folder, exist_ok=True)
+    results = []
+    start = time.perf_counter()
+
+    def finished(result):
+        results.append(result)
+        if on_result is not None:
+            on_result(result)
+
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=__init_worker, initargs=(template_folder, log_level))
+    with pool:
+        in_flight = set()
+        for item in items:
+            if item.error is not None:
+                finished({"index": item.index, "name": item.name, "source": item.source, "status": 'failed',
+                          "error": item.error, "seconds": 0.0})
+                continue
+            while len(in_flight) >= workers * 2:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finished(future.result())
+            in_flight.add(pool.submit(__render_item, item, output_folder, archive, incremental))
+        for future in wait(in_flight).done:
+            finished(future.result())
+    duration = time.perf_counter() - start
+
+    results.sort(key=lambda result: result['index'])
+    done = [result for result in results if result['status'] == 'done']
+    files = sum(result.get('files', 0) for result in done)
+    size = sum(result.get('bytes', 0) for result in done)
+    return {
+        "template_folder": template_folder,
+        "output_folder": output_folder,
+        "workers": workers,
+        "items": len(results),
+        "done": len(done),
+        "failed": len(results) - len(done),
+        "seconds": duration,
+        "items_per_second": len(done) / duration if duration else 0,
+        "files_per_second": files / duration if duration else 0,
+        "bytes_per_second": size / duration if duration else 0,
+        "results": results,
+    }
@@ -0,0 +1,127 @@
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from jinjaGenerator.settings import RENDER_JOB_WORKERS, RENDER_JOB_QUEUE_SIZE, RENDER_JOB_RETENTION
+from .renderer.metrics import registry, Gauge
+from .renderer.renderer import render
+from .renderer.timing import RenderTimings
+from .renderer.workspaces import create_workspace, release_workspace, start_workspace_collection
+
+__logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """
+    Raised when a render job is submitted while all workers are busy and the queue is full.
+    """
+
+
+class RenderJob:
+    """
+    Render of a template running in the background, polled through its id.
+    """
+    def __init__(self, template_name, template_folder):
+        self.id = uuid.uuid4().hex
+        self.template_name = template_name
+        self.template_folder = template_folder
+        self.status = 'queued'  # queued -> running -> done | failed
+        self.files_done = 0
+        self.files_total = None  # known once the paths are resolved, before the first file is written
+        self.error = None
+        self.output_folder = None  # workspace of this job only, created when it starts running
+        self.timings = RenderTimings()
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ('done', 'failed')
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "template_name": self.template_name,
+            "status": self.status,
+            "files_done": self.files_done,
+            "files_total": self.files_total,
+            "error": self.error,
+            "output_folder": self.output_folder,
+            "timings": self.timings.to_dict(),
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+__executor = ThreadPoolExecutor(max_workers=RENDER_JOB_WORKERS, thread_name_prefix='render-job')
+# running + queued jobs, bounded so a burst of submissions can not pile up unbounded work
+__slots = threading.BoundedSemaphore(RENDER_JOB_WORKERS + RENDER_JOB_QUEUE_SIZE)
+__jobs = {}
+__jobs_lock = threading.Lock()
+
+
+def __forget_finished_jobs():
+    expired_before = time.time() - RENDER_JOB_RETENTION
+    for job_id in [job_id for job_id, job in __jobs.items() if job.finished and job.finished_at < expired_before]:
+        del __jobs[job_id]
+
+def __run_job(job, context):
+    job.status = 'running'
+    job.started_at = time.time()
+
+    def progress(files_done, files_total):
+        job.files_done = files_done
+        job.files_total = files_total
+
+    status = 'failed'
+    try:
+        job.output_folder = create_workspace(job.template_name)
+        render(job.template_folder, context, progress=progress, output_folder=job.output_folder, timings=job.timings)
+        status = 'done'
+    except Exception as e:
+        __logger.exception("Render job %s of %s failed", job.id, job.template_name)
+        job.error = str(e)
+    finally:
+        if job.output_folder is not None:
+            release_workspace(job.output_folder)
+        # finished_at first: a job with a finished status is expected to have it, see __forget_finished_jobs
+        job.finished_at = time.time()
+        job.status = status
+        __slots.release()
+
+def __count_jobs():
+    counts = {'queued': 0, 'running': 0, 'done': 0, 'failed': 0}
+    with __jobs_lock:
+        for job in __jobs.values():
+            counts[job.status] += 1
+    return counts
+
+registry.register(Gauge('jinja_render_jobs', "Render jobs known to this process, by status", ('status',),
+                        function=__count_jobs))
+
+def submit_render_job(template_name, template_folder, context) -> RenderJob:
+    """
+    Queue the render of a template on the background executor and return immediately.
+    Each job renders into its own workspace, so jobs of the same template can run at the same time.
+    Raises QueueFullError when RENDER_JOB_WORKERS jobs are running and RENDER_JOB_QUEUE_SIZE are waiting.
+    """
+    if not __slots.acquire(blocking=False):
+        raise QueueFullError(f"{RENDER_JOB_WORKERS} render jobs running and {RENDER_JOB_QUEUE_SIZE} queued")
+    job = RenderJob(template_name, template_folder)
+    with __jobs_lock:
+        __forget_finished_jobs()
+        __jobs[job.id] = job
+    start_workspace_collection()
+    __executor.submit(__run_job, job, context)
+    return job
+
+def get_render_job(job_id):
+    """
+    Return the job with this id, or None when it does not exist or finished more than RENDER_JOB_RETENTION seconds ago.
+    """
+    with __jobs_lock:
+        return __jobs.get(job_id)
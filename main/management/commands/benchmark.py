@@ -0,0 +1,47 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from main.benchmark import run_benchmarks, compare_results
+
+
+class Command(BaseCommand):
+    help = ("Time create_jinja_env, resolve_path, render and the /template/render view on a synthetic template, "
+            "and write the results as JSON")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--models', type=int, default=100, help="Models in the context (default 100)")
+        parser.add_argument('--fields', type=int, default=10, help="Fields of every model (default 10)")
+        parser.add_argument('--assets', type=int, default=4, help="Static assets in the template (default 4)")
+        parser.add_argument('--asset-size', type=int, default=1024 * 1024, help="Bytes of every asset (default 1 MiB)")
+        parser.add_argument('--repeat', type=int, default=5, help="Runs of every benchmark (default 5)")
+        parser.add_argument('--no-view', action='store_true', help="Skip the /template/render view benchmark")
+        parser.add_argument('--output', help="File the JSON results are written to, stdout when not given")
+        parser.add_argument('--compare', help="JSON results of a previous run, to report the change of every median")
+
+    def handle(self, *args, **options):
+        if options['repeat'] < 1:
+            raise CommandError("--repeat must be at least 1")
+        baseline = None
+        if options['compare']:
+            try:
+                with open(options['compare']) as f:
+                    baseline = json.load(f)
+            except (OSError, ValueError) as e:
+                raise CommandError(f"Can not read {options['compare']}: {e}")
+
+        results = run_benchmarks(models=options['models'], fields=options['fields'], assets=options['assets'],
+                                 asset_size=options['asset_size'], repeat=options['repeat'],
+                                 view=not options['no_view'], log=lambda line: self.stderr.write(f"timing {line}"))
+
+        output = json.dumps(results, indent=1)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output)
+        for name, timing in results['results'].items():
+            self.stderr.write(f"{name:<30} median {timing['median'] * 1000:10.2f} ms  min {timing['min'] * 1000:10.2f} ms")
+        if baseline is not None:
+            for name, ratio in compare_results(baseline, results).items():
+                self.stderr.write(f"{name:<30} {ratio:6.2f}x baseline")
@@ -0,0 +1,80 @@
+import json
+import logging
+import os
+from concurrent.futures.process import BrokenProcessPool
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError
+
+from main.bulk_render import bulk_render, read_items
+from main.template_registry import template_registry
+
+
+class Command(BaseCommand):
+    help = ("Render a template with every context of a JSON Lines file or a folder of JSON files, on a pool of "
+            "worker processes, each context into its own output folder or ZIP archive")
+
+    def add_arguments(self, parser):
+        parser.add_argument('template', help="Name of an uploaded template, or a template folder with --folder")
+        parser.add_argument('contexts', help="JSON Lines file with one context per line, or a folder of .json "
+                                             "(one context each) and .jsonl files")
+        parser.add_argument('--output', required=True, help="Folder receiving a folder or archive per context")
+        parser.add_argument('--folder', action='store_true', help="template is the path of a template folder")
+        parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: CPU count)")
+        parser.add_argument('--archive', action='store_true', help="Write <name>.zip archives instead of folders")
+        parser.add_argument('--incremental', action='store_true',
+                            help="Keep the output folders of a previous run and only write what changed")
+        parser.add_argument('--name-key', help="Top-level key of the contexts naming their output "
+                                               "(default: line number or file name)")
+        parser.add_argument('--report', help="File the JSON report (every item and the throughput) is written to")
+
+    def handle(self, *args, **options):
+        if options['workers'] is not None and options['workers'] < 1:
+            raise CommandError("--workers must be at least 1")
+        if options['archive'] and options['incremental']:
+            raise CommandError("--incremental only applies to output folders, not to --archive")
+        if options['folder']:
+            template_folder = os.path.abspath(options['template'])
+            if not os.path.isdir(os.path.join(template_folder, 'project')):
+                raise CommandError(f"{template_folder} is not a template folder: no 'project' folder")
+        else:
+            try:
+                template = template_registry.get(name=options['template'])
+            except DatabaseError as e:
+                raise CommandError(f"Can not look template '{options['template']}' up, pass its folder with "
+                                   f"--folder: {e}")
+            if template is None:
+                raise CommandError(f"Template '{options['template']}' not found")
+            template_folder = template.folder
+        if not os.path.exists(options['contexts']):
+            raise CommandError(f"{options['contexts']} not found")
+        verbosity = options['verbosity']
+
+        def on_result(result):
+            if result['status'] == 'failed':
+                self.stderr.write(f"failed {result['name']} ({result['source']}): {result['error']}")
+            elif verbosity >= 2:
+                self.stdout.write(f"done   {result['name']}: {result['files']} files, {result['bytes']} bytes "
+                                  f"in {result['seconds'] * 1000:.2f} ms")
+
+        try:
+            summary = bulk_render(template_folder, read_items(options['contexts'], options['name_key']),
+                                  os.path.abspath(options['output']), workers=options['workers'],
+                                  archive=options['archive'], incremental=options['incremental'],
+                                  log_level=logging.INFO if verbosity >= 3 else logging.WARNING, on_result=on_result)
+        except BrokenProcessPool as e:
+            raise CommandError(f"A worker process died, e.g. while loading the template: {e}")
+        except OSError as e:
+            raise CommandError(str(e))
+
+        if options['report']:
+            with open(options['report'], 'w') as f:
+                json.dump(summary, f, indent=1)
+        self.stdout.write(
+            f"Rendered {summary['done']}/{summary['items']} contexts ({summary['failed']} failed) "
+            f"in {summary['seconds']:.2f} s on {summary['workers']} workers: "
+            f"{summary['items_per_second']:.1f} contexts/s, {summary['files_per_second']:.1f} files/s, "
+            f"{summary['bytes_per_second'] / (1024 * 1024):.2f} MiB/s"
+        )
+        if summary['failed']:
+            raise CommandError(f"{summary['failed']} contexts failed to render")
@@ -0,0 +1,26 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='template',
+            name='folder',
+            field=models.CharField(max_length=255),
+        ),
+        migrations.AddField(
+            model_name='template',
+            name='version',
+            field=models.CharField(blank=True, default='', max_length=40),
+        ),
+        migrations.AddField(
+            model_name='template',
+            name='manifest',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
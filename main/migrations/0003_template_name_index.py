@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0002_template_version_manifest'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='template',
+            name='name',
+            field=models.CharField(db_index=True, max_length=100),
+        ),
+    ]
@@ -0,0 +1,28 @@
+from django.db import migrations, models
+
+
+def remove_duplicate_names(apps, schema_editor):
+    # lookups by name always resolved to the first row of a name, the later ones were never used
+    Template = apps.get_model('main', 'Template')
+    seen = set()
+    for template in Template.objects.order_by('id').only('id', 'name'):
+        if template.name in seen:
+            template.delete()
+        else:
+            seen.add(template.name)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0003_template_name_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_names, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='template',
+            name='name',
+            field=models.CharField(max_length=100, unique=True),
+        ),
+    ]
@@ -2,8 +2,14 @@ from django.db import models
 
 # Create your models here.
 class Template(models.Model):
-    name = models.CharField(max_length=100)
-    folder = models.CharField(max_length=100)
+    # unique, and so indexed: renders look their template up by name
+    name = models.CharField(max_length=100, unique=True)
+    # folder of the active version, templates/.store/versions/<version>/<name> for uploaded templates
+    folder = models.CharField(max_length=255)
+    # sha1 of the manifest, empty for templates whose folder is not in the template store
+    version = models.CharField(max_length=40, blank=True, default='')
+    # file path relative to the template folder -> sha1 of its content
+    manifest = models.JSONField(blank=True, default=dict)
 
     def __str__(self):
-        return self.name
\ No newline at end of file
+        return self.name
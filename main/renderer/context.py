@@ -0,0 +1,98 @@
+from collections.abc import Mapping
+
+# recorded by TrackingContext when the whole context is read, JSON contexts only have string keys
+ALL_KEYS = None
+
+
+class LayeredContext(Mapping):
+    """
+    Read-only view of a context with values laid over it, without copying either of them.
+    Looks like the deep merge of overlay into base: when both hold a dict for a key, the result for that key
+    is itself a LayeredContext of the two; otherwise the overlay value wins.
+    """
+    __slots__ = ('_base', '_overlay')
+
+    def __init__(self, base, overlay):
+        self._base = base
+        self._overlay = overlay
+
+    def __getitem__(self, key):
+        if key in self._overlay:
+            value = self._overlay[key]
+            if isinstance(value, dict) and key in self._base:
+                base_value = self._base[key]
+                if isinstance(base_value, Mapping):
+                    return LayeredContext(base_value, value)
+            return value
+        return self._base[key]
+
+    def __contains__(self, key):
+        return key in self._overlay or key in self._base
+
+    def __iter__(self):
+        # same order as the merged dict: the base keys, then the keys only in the overlay
+        yield from self._base
+        for key in self._overlay:
+            if key not in self._base:
+                yield key
+
+    def __len__(self):
+        return len(self._base) + sum(1 for key in self._overlay if key not in self._base)
+
+    def __repr__(self):
+        return f"LayeredContext({self._base!r}, {self._overlay!r})"
+
+
+class TrackingContext(Mapping):
+    """
+    Read-only view of a context recording the top-level keys looked up through it, found or not, in keys_read.
+    Iterating it or taking its length depends on every key: it records ALL_KEYS.
+    """
+    __slots__ = ('_context', 'keys_read')
+
+    def __init__(self, context):
+        self._context = context
+        self.keys_read = set()
+
+    def __getitem__(self, key):
+        self.keys_read.add(key)
+        return self._context[key]
+
+    def __contains__(self, key):
+        self.keys_read.add(key)
+        return key in self._context
+
+    def __iter__(self):
+        self.keys_read.add(ALL_KEYS)
+        return iter(self._context)
+
+    def __len__(self):
+        self.keys_read.add(ALL_KEYS)
+        return len(self._context)
+
+    def __repr__(self):
+        return f"TrackingContext({self._context!r})"
+
+
+def render_with_parent(template, parent) -> str:
+    """
+    Render a template against a mapping used as is for the context lookups.
+    Template.render copies its variables and the template globals into a new dict on every call;
+    here the parent mapping (e.g. a ChainMap over the context of another template) is shared instead,
+    so it must already contain the globals the template needs.
+    """
+    ctx = template.new_context(parent, shared=True)
+    try:
+        return template.environment.concat(template.root_render_func(ctx))
+    except Exception:
+        return template.environment.handle_exception()
+
+def generate_with_parent(template, parent):
+    """
+    Like render_with_parent, but yields the output in chunks as Jinja2 generates it, see Template.generate.
+    """
+    ctx = template.new_context(parent, shared=True)
+    try:
+        yield from template.root_render_func(ctx)
+    except Exception:
+        yield template.environment.handle_exception()
@@ -1,12 +1,61 @@
+import contextlib
+import contextvars
+import json
+import time
+from collections import ChainMap
+
 from jinja2 import pass_context, pass_environment, Environment, FileSystemLoader
 from jinja2.runtime import Context
 
+from main.renderer.context import render_with_parent
+from main.renderer.timing import current_detail_timings
+
+# outputs of pure fragments for the render in progress: (path, additional context, overrides) -> output
+__fragment_memo = contextvars.ContextVar('fragment_memo', default=None)
+
+
+@contextlib.contextmanager
+def fragment_memo(memo):
+    """
+    Memoize the pure fragments rendered inside the block into memo, a dict shared by all the outputs of one render.
+    """
+    token = __fragment_memo.set(memo)
+    try:
+        yield memo
+    finally:
+        __fragment_memo.reset(token)
+
+def __memo_key(path, additional_context, overrides_context):
+    try:
+        return path, json.dumps(additional_context, sort_keys=True), overrides_context
+    except (TypeError, ValueError):
+        # not serializable, e.g. a macro passed as argument: rendered every time
+        return None
 
 @pass_context
-def render_fragment(ctx: Context, path, additional_context=None, overrides_context=False):
+def render_fragment(ctx: Context, path, additional_context=None, overrides_context=False, pure=False):
+    """
+    Render fragments/<path> with the context of the calling template and additional_context.
+    The calling context wins over additional_context, unless overrides_context is set.
+    A pure fragment only depends on its path and additional_context: it is rendered once per render.
+    """
     if additional_context is None:
         additional_context = {}
+    memo = __fragment_memo.get() if pure else None
+    memo_key = __memo_key(path, additional_context, overrides_context) if memo is not None else None
+    if memo_key is not None and memo_key in memo:
+        return memo[memo_key]
+    timings = current_detail_timings()
+    start = time.perf_counter() if timings is not None else 0
     template = ctx.environment.get_template('fragments/' + path)
-    full_context = {} if overrides_context else additional_context
-    full_context.update(ctx.parent)
-    return template.render(full_context)
\ No newline at end of file
+    # layered over the calling context instead of copying it
+    if overrides_context:
+        full_context = ChainMap(additional_context, ctx.parent)
+    else:
+        full_context = ChainMap(ctx.parent, additional_context)
+    output = render_with_parent(template, full_context)
+    if timings is not None:
+        timings.add_detail('fragments', path, time.perf_counter() - start)
+    if memo_key is not None:
+        memo[memo_key] = output
+    return output
@@ -0,0 +1,96 @@
+import json
+import logging
+import os
+
+from .context import ALL_KEYS
+from .render_cache import context_fingerprint
+
+__logger = logging.getLogger(__name__)
+# written in the output folder by incremental renders tracking dependencies, next to the output manifest
+OUTPUT_DEPENDENCIES_NAME = '.render-dependencies.json'
+# format of the dependencies file, incremented when its structure changes: older files are ignored
+DEPENDENCIES_VERSION = 1
+
+
+def output_dependencies(keys_read, additional_context) -> dict:
+    """
+    Dependencies of a rendered template output: the top-level context keys it read, see TrackingContext,
+    and the hash of its '_path'.
+    """
+    keys = sorted(key for key in keys_read if key is not ALL_KEYS)
+    if ALL_KEYS in keys_read:
+        keys.insert(0, ALL_KEYS)
+    return {"keys": keys, "path": context_fingerprint(additional_context)}
+
+
+def load_output_dependencies(output_folder):
+    """
+    Dependencies saved in the output folder by the previous render, None when there are none or they can not be read.
+    The file is removed: a render failing midway leaves outputs the saved dependencies do not describe anymore.
+    """
+    path = os.path.join(output_folder, OUTPUT_DEPENDENCIES_NAME)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r') as f:
+            dependencies = json.load(f)
+    except (OSError, ValueError) as e:
+        __logger.warning("Ignoring output dependencies %s: %s", path, e)
+        dependencies = None
+    os.remove(path)
+    if not isinstance(dependencies, dict) or dependencies.get('version') != DEPENDENCIES_VERSION:
+        return None
+    return dependencies
+
+
+class DependencyTracker:
+    """
+    Dependencies of the template outputs of an incremental render, compared with those saved by the previous render
+    of the same output folder: an output only needs to be rendered again when its template folder changed,
+    its '_path' changed, or one of the context keys it read has a different value.
+    """
+    def __init__(self, fingerprint, context, previous=None):
+        """
+        :param fingerprint: Fingerprint of the template folder
+        :param previous: Dependencies saved by the previous render, see load_output_dependencies
+        """
+        self.fingerprint = fingerprint
+        self.context_hashes = {key: context_fingerprint(value) for key, value in context.items()}
+        self.outputs = {}  # output relative path -> output_dependencies
+        self._previous_outputs = {}
+        self._changed_keys = set()
+        if previous is not None and previous.get('fingerprint') == fingerprint:
+            self._previous_outputs = previous.get('outputs', {})
+            previous_hashes = previous.get('context', {})
+            self._changed_keys = {key for key in self.context_hashes.keys() | previous_hashes.keys()
+                                  if self.context_hashes.get(key) != previous_hashes.get(key)}
+
+    def is_up_to_date(self, relative_path, additional_context) -> bool:
+        """
+        Whether the previous output of relative_path is still what rendering it again would write.
+        """
+        previous = self._previous_outputs.get(relative_path)
+        if previous is None:
+            return False
+        keys = previous['keys']
+        if keys and keys[0] is ALL_KEYS:
+            if self._changed_keys:
+                return False
+        elif not self._changed_keys.isdisjoint(keys):
+            return False
+        return previous['path'] == context_fingerprint(additional_context)
+
+    def carry_over(self, relative_path):
+        # the output is kept as is, so are its dependencies
+        self.outputs[relative_path] = self._previous_outputs[relative_path]
+
+    def save(self, output_folder):
+        path = os.path.join(output_folder, OUTPUT_DEPENDENCIES_NAME)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({
+                "version": DEPENDENCIES_VERSION,
+                "fingerprint": self.fingerprint,
+                "context": self.context_hashes,
+                "outputs": self.outputs,
+            }, f, sort_keys=True)
+        os.replace(path + '.tmp', path)
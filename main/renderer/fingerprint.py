@@ -0,0 +1,106 @@
+import hashlib
+import os
+import threading
+import time
+
+from jinjaGenerator.settings import TEMPLATE_FINGERPRINT_TTL
+
+# folders created by python itself while loading helper modules, they are not part of the template
+IGNORED_FOLDERS = {'__pycache__'}
+# archive of precompiled templates, written inside the template folder at upload time
+COMPILED_ARCHIVE_NAME = '.compiled.zip'
+# generated files at the root of a template folder, derived from it and not part of it
+IGNORED_ROOT_FILES = {COMPILED_ARCHIVE_NAME, COMPILED_ARCHIVE_NAME + '.tmp'}
+
+# folder -> (monotonic time it was computed at, fingerprint)
+__FINGERPRINTS = {}
+# every FolderCache, emptied for a folder by forget_fingerprint
+__FOLDER_CACHES = []
+
+
+def __walk_files(folder, relative_root=''):
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            relative_path = relative_root + entry.name
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name in IGNORED_FOLDERS:
+                    continue
+                yield from __walk_files(entry.path, relative_path + '/')
+            elif entry.is_file():
+                if not relative_root and entry.name in IGNORED_ROOT_FILES:
+                    continue
+                yield relative_path, entry.stat()
+
+def folder_fingerprint(folder) -> str:
+    """
+    Compute a fingerprint of a folder from the relative path, size and modification time of every file.
+    Files are only stat-ed, never read, so this is cheap enough to run on every render.
+    :param folder: Folder to fingerprint
+    :returns: Hex digest that changes whenever a file is added, removed or modified
+    """
+    digest = hashlib.sha1()
+    for relative_path, stat in sorted(__walk_files(folder), key=lambda item: item[0]):
+        digest.update(f"{relative_path}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+def current_fingerprint(folder) -> str:
+    """
+    Fingerprint of a folder, reused for TEMPLATE_FINGERPRINT_TTL seconds
+    so back to back renders of the same template do not scan its folder again.
+    """
+    folder = os.path.abspath(folder)
+    now = time.monotonic()
+    cached = __FINGERPRINTS.get(folder)
+    if cached is not None and now - cached[0] < TEMPLATE_FINGERPRINT_TTL:
+        return cached[1]
+    fingerprint = folder_fingerprint(folder)
+    __FINGERPRINTS[folder] = (now, fingerprint)
+    return fingerprint
+
+def forget_fingerprint(folder):
+    """
+    Drop the reused fingerprint of a folder and the values cached for it,
+    to be called when the folder is known to have changed or is not used anymore.
+    """
+    folder = os.path.abspath(folder)
+    __FINGERPRINTS.pop(folder, None)
+    for cache in __FOLDER_CACHES:
+        cache.forget(folder)
+
+
+class FolderCache:
+    """
+    Values derived from a folder (e.g. its Jinja2 environment), built once and kept until the folder fingerprint changes.
+    """
+    def __init__(self, build):
+        """
+        :param build: Function (folder, fingerprint) -> value
+        """
+        self._build = build
+        self._entries = {}
+        self._lock = threading.Lock()
+        _register_folder_cache(self)
+
+    def get(self, folder, fingerprint=None):
+        folder = os.path.abspath(folder)
+        if fingerprint is None:
+            fingerprint = current_fingerprint(folder)
+        cached = self._entries.get(folder)
+        if cached is not None and cached[0] == fingerprint:
+            return cached[1]
+        with self._lock:
+            cached = self._entries.get(folder)
+            if cached is not None and cached[0] == fingerprint:
+                return cached[1]
+            value = self._build(folder, fingerprint)
+            self._entries[folder] = (fingerprint, value)
+            return value
+
+    def forget(self, folder):
+        with self._lock:
+            self._entries.pop(os.path.abspath(folder), None)
+
+
+def _register_folder_cache(cache):
+    # module level, __FOLDER_CACHES would be mangled inside the class body
+    __FOLDER_CACHES.append(cache)
@@ -0,0 +1,185 @@
+import ast
+import importlib.util
+import logging
+import os
+import re
+import threading
+from typing import NamedTuple, Optional
+
+from jinja2.utils import _PassArg
+
+__logger = logging.getLogger(__name__)
+# decorators of jinja2 whose effect on a function is known without running its module
+__PASS_ARG_DECORATORS = {
+    'pass_context': _PassArg.context,
+    'pass_eval_context': _PassArg.eval_context,
+    'pass_environment': _PassArg.environment,
+}
+
+
+class HelperScan(NamedTuple):
+    """
+    Names a helper module exports, found without running it.
+    """
+    functions: dict  # plain top level function or class name -> jinja pass arg, None when not decorated
+    others: frozenset  # any other public name (constants, imports, decorated functions, ...): its value is unknown
+    star_import: bool  # 'from x import *': the exported names are not known
+
+
+def __decorator_name(decorator):
+    if isinstance(decorator, ast.Name):
+        return decorator.id
+    if isinstance(decorator, ast.Attribute):
+        return decorator.attr
+    return None
+
+def __bound_names(node):
+    """
+    Names bound by a top level statement, recursing into if / try / with / for blocks.
+    """
+    if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+        yield node.name
+    elif isinstance(node, (ast.Import, ast.ImportFrom)):
+        for alias in node.names:
+            yield (alias.asname or alias.name).split('.')[0]
+    elif isinstance(node, (ast.Assign, ast.AnnAssign, ast.AugAssign, ast.For, ast.AsyncFor, ast.With, ast.AsyncWith)):
+        targets = node.targets if isinstance(node, ast.Assign) else \
+            [item.optional_vars for item in node.items if item.optional_vars is not None] \
+            if isinstance(node, (ast.With, ast.AsyncWith)) else [node.target]
+        for target in targets:
+            for name in ast.walk(target):
+                if isinstance(name, ast.Name):
+                    yield name.id
+    if isinstance(node, (ast.If, ast.For, ast.AsyncFor, ast.While, ast.With, ast.AsyncWith, ast.Try)):
+        for child in node.body + getattr(node, 'orelse', []) + getattr(node, 'finalbody', []) + \
+                [statement for handler in getattr(node, 'handlers', []) for statement in handler.body]:
+            yield from __bound_names(child)
+
+def scan_helper_module(py_path) -> Optional[HelperScan]:
+    """
+    Parse a helper module to find the names it exports, like dir() would once it runs.
+    Returns None when it can not be parsed.
+    """
+    try:
+        with open(py_path, 'rb') as f:
+            tree = ast.parse(f.read(), py_path)
+    except (OSError, SyntaxError, ValueError) as e:
+        __logger.warning("Can not scan %s, it is loaded eagerly: %s", py_path, e)
+        return None
+    functions = {}
+    others = set()
+    star_import = False
+    for node in tree.body:
+        if isinstance(node, ast.ImportFrom) and any(alias.name == '*' for alias in node.names):
+            star_import = True
+            continue
+        plain_function = None
+        if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+            decorators = [__decorator_name(decorator) for decorator in node.decorator_list]
+            if not decorators:
+                plain_function = (node.name, None)
+            elif len(decorators) == 1 and decorators[0] in __PASS_ARG_DECORATORS and isinstance(node, ast.FunctionDef):
+                plain_function = (node.name, __PASS_ARG_DECORATORS[decorators[0]])
+        for name in __bound_names(node):
+            if name.startswith('_'):
+                continue
+            if plain_function is not None and name == plain_function[0] and name not in functions and name not in others:
+                functions[name] = plain_function[1]
+            else:
+                # bound more than once, or to a value only known by running the module
+                functions.pop(name, None)
+                others.add(name)
+    return HelperScan(functions, frozenset(others), star_import)
+
+
+def load_helper_module(py_path):
+    """
+    Import a helper module from its file, without adding it to sys.modules.
+    """
+    name = os.path.splitext(os.path.basename(py_path))[0]
+    spec = importlib.util.spec_from_file_location(name, py_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class LazyHelperModule:
+    """
+    Helper module of a template, imported on first use. Once imported, its exports replace the proxies registered
+    for it and the names it owns are added to the environment, like create_jinja_env does for eager modules.
+    """
+    def __init__(self, py_path, install):
+        """
+        :param install: Function (module) -> None adding the exports of the module to the environment
+        """
+        self.py_path = py_path
+        self.name = os.path.splitext(os.path.basename(py_path))[0]
+        self._install = install
+        self._module = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self._module is not None:
+            return self._module
+        with self._lock:
+            if self._module is None:
+                module = load_helper_module(self.py_path)
+                self._install(module)
+                self._module = module
+        return self._module
+
+
+class LazyHelper:
+    """
+    Stands for a function of a helper module that is not imported yet, and imports it when first called.
+    It carries the jinja_pass_arg of the function so Jinja2 and the wildcard resolver pass it the same arguments.
+    """
+    def __init__(self, helper_module: LazyHelperModule, name, pass_arg=None):
+        self.helper_module = helper_module
+        self.name = name
+        self.__name__ = name
+        self._function = None
+        if pass_arg is not None:
+            self.jinja_pass_arg = pass_arg
+
+    def __call__(self, *args, **kwargs):
+        # templates compiled before the module was imported keep calling the proxy
+        function = self._function
+        if function is None:
+            try:
+                module = self.helper_module.load()
+            except Exception as e:
+                raise RuntimeError(
+                    f"Error loading {self.helper_module.name} from {self.helper_module.py_path}: {e}") from e
+            function = self._function = getattr(module, self.name)
+        return function(*args, **kwargs)
+
+    def __repr__(self):
+        return f"<lazy {self.name} of {self.helper_module.py_path}>"
+
+
+def referenced_names(template_folder, candidates) -> set:
+    """
+    Candidates appearing as a word in a template (project, macros, fragments) or in a path of project/.
+    A cheap over-approximation of what the templates and wildcards use, without parsing them.
+    """
+    if not candidates:
+        return set()
+    pattern = re.compile(r'\b(' + '|'.join(re.escape(name) for name in sorted(candidates)) + r')\b')
+    found = set()
+    for folder in ('project', 'macros', 'fragments'):
+        root_folder = os.path.join(template_folder, folder)
+        for root, _, files in os.walk(root_folder):
+            for file_name in files:
+                path = os.path.join(root, file_name)
+                found.update(pattern.findall(os.path.relpath(path, root_folder)))
+                if folder == 'project' and not file_name.endswith(('.jinja', '.j2')):
+                    continue
+                try:
+                    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+                        found.update(pattern.findall(f.read()))
+                except OSError:
+                    continue
+                if found == candidates:
+                    return found
+    return found
@@ -1,69 +1,175 @@
-import importlib.util
+import logging
 import os
+import time
+import zipfile
 
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, ChoiceLoader, ModuleLoader
 
+from jinjaGenerator.settings import RENDER_LAZY_HELPERS
 from main.renderer.defaults import render_fragment
+from main.renderer.fingerprint import folder_fingerprint, FolderCache, COMPILED_ARCHIVE_NAME
+from main.renderer.lazy_helpers import scan_helper_module, referenced_names, load_helper_module, LazyHelperModule, \
+    LazyHelper
+from main.renderer.metrics import ENV_BUILDS, ENV_BUILD_DURATION
+
+__logger = logging.getLogger(__name__)
+# entry of the compiled archive holding the fingerprint of the sources it was compiled from
+__ARCHIVE_FINGERPRINT_ENTRY = '.fingerprint'
+# folders whose files are all templates, next to the '.jinja' / '.j2' files of 'project'
+__TEMPLATE_FOLDERS = ('macros/', 'fragments/')
 
 
 def __first_level_folders(path):
     items = os.listdir(path)
     return [item for item in items if os.path.isdir(os.path.join(path, item))]
 
-def __only_callable_values(d):
-    return {k: v for k, v in d.items() if callable(v)}
-
-def __load_python_files_from_folder(folder_path):
-    python_elements = {}
+def __python_files(folder_path):
     if not os.path.exists(folder_path):
-        return python_elements
-    python_files = [f for f in os.listdir(folder_path) if f.endswith('.py')]
-    for py_file in python_files:
-        py_path = os.path.join(folder_path, py_file)
-        py_name = os.path.splitext(py_file)[0]
-        try:
-            spec = importlib.util.spec_from_file_location(py_name, py_path)
-            module = importlib.util.module_from_spec(spec)
-            spec.loader.exec_module(module)
-            for attr in dir(module):
-                if not attr.startswith('_'):
-                    elem = getattr(module, attr)
-                    python_elements[attr] = elem
-        except Exception as e:
-            print(f"Error loading {py_name} from {py_path}: {e}")
-    return python_elements
-
-def create_jinja_env(template_folder):
+        return []
+    return [os.path.join(folder_path, f) for f in os.listdir(folder_path) if f.endswith('.py')]
+
+def __register_python_helpers(env, template_folder, folders, lazy):
+    """
+    Add the python files of the folders to the environment: 'filters' and 'tests' callables to env.filters and
+    env.tests, everything of the other folders to env.globals. A later file overrides the names of the earlier ones.
+    When lazy, a module is only imported when one of its functions is first called, through a LazyHelper registered
+    in its place, unless the templates or the paths use one of its other names (constants, imported names, ...).
+    """
+    groups = []  # (kind, target, callables only, python files)
+    for folder in folders:
+        python_files = __python_files(os.path.join(template_folder, folder))
+        if folder == 'filters':
+            groups.append(('filters', env.filters, True, python_files))
+        elif folder == 'tests':
+            groups.append(('tests', env.tests, True, python_files))
+        else:
+            groups.append(('globals', env.globals, False, python_files))
+    scans = {py_path: scan_helper_module(py_path) if lazy else None
+             for _, _, _, python_files in groups for py_path in python_files}
+    referenced = referenced_names(template_folder, frozenset().union(
+        *(scan.others for scan in scans.values() if scan is not None)))
+    # kind -> name -> python file whose value it takes, the last one defining it
+    owners = {'filters': {}, 'tests': {}, 'globals': {}}
+
+    def installer(kind, target, callables_only, py_path):
+        def install(module):
+            for name in dir(module):
+                if name.startswith('_') or owners[kind].get(name) != py_path:
+                    continue
+                value = getattr(module, name)
+                if callables_only and not callable(value):
+                    target.pop(name, None)
+                else:
+                    target[name] = value
+        return install
+
+    for kind, target, callables_only, python_files in groups:
+        for py_path in python_files:
+            install = installer(kind, target, callables_only, py_path)
+            scan = scans[py_path]
+            if scan is None or scan.star_import or scan.others & referenced:
+                try:
+                    module = load_helper_module(py_path)
+                except Exception as e:
+                    __logger.warning("Error loading %s from %s: %s", os.path.basename(py_path), py_path, e)
+                    continue
+                for name in dir(module):
+                    if not name.startswith('_'):
+                        owners[kind][name] = py_path
+                install(module)
+                continue
+            helper_module = LazyHelperModule(py_path, install)
+            for name, pass_arg in scan.functions.items():
+                owners[kind][name] = py_path
+                target[name] = LazyHelper(helper_module, name, pass_arg)
+            for name in scan.others:
+                # unused by the templates, added when the module is imported
+                owners[kind][name] = py_path
+                target.pop(name, None)
+
+def __is_template(name):
+    if name.startswith('project/'):
+        return name.endswith('.jinja') or name.endswith('.j2')
+    return name.startswith(__TEMPLATE_FOLDERS)
+
+def __compiled_templates_loader(template_folder, fingerprint=None):
+    """
+    Return a loader over the compiled archive of the template folder,
+    or None when there is no archive or it was compiled from other sources.
+    """
+    archive_path = os.path.join(template_folder, COMPILED_ARCHIVE_NAME)
+    if not os.path.exists(archive_path):
+        return None
+    try:
+        with zipfile.ZipFile(archive_path) as archive:
+            archive_fingerprint = archive.read(__ARCHIVE_FINGERPRINT_ENTRY).decode('utf-8')
+    except (zipfile.BadZipFile, KeyError) as e:
+        __logger.warning("Ignoring compiled archive %s: %s", archive_path, e)
+        return None
+    if fingerprint is None:
+        fingerprint = folder_fingerprint(template_folder)
+    if archive_fingerprint != fingerprint:
+        return None
+    return ModuleLoader(archive_path)
+
+def compile_templates(template_folder):
+    """
+    Compile every template of the folder ('.jinja' / '.j2' files in 'project', all files in 'macros' and 'fragments')
+    into an archive of python modules, picked up by create_jinja_env instead of parsing the sources.
+    Raises jinja2.TemplateSyntaxError on the first invalid template.
+    :returns: Path of the written archive
+    """
+    fingerprint = folder_fingerprint(template_folder)
+    env = create_jinja_env(template_folder, precompiled=False)
+    archive_path = os.path.join(template_folder, COMPILED_ARCHIVE_NAME)
+    temp_archive_path = archive_path + '.tmp'
+    try:
+        env.compile_templates(temp_archive_path, filter_func=__is_template, zip='deflated', ignore_errors=False)
+        with zipfile.ZipFile(temp_archive_path, 'a') as archive:
+            archive.writestr(__ARCHIVE_FINGERPRINT_ENTRY, fingerprint)
+        os.replace(temp_archive_path, archive_path)
+    finally:
+        if os.path.exists(temp_archive_path):
+            os.remove(temp_archive_path)
+    return archive_path
+
+def create_jinja_env(template_folder, precompiled=True, fingerprint=None, lazy_helpers=None, **env_options):
+    """
+    :param lazy_helpers: Import the python helpers on first use, RENDER_LAZY_HELPERS when not given
+    """
+    start = time.perf_counter()
     folders = __first_level_folders(template_folder)
     if not 'project' in folders:
         raise ValueError("No 'project' folder found in the template")
     project_folder = os.path.join(template_folder, 'project')
     folders.remove('project')
-    filters = {}
-    tests = {}
-    other_python = {}
-    for folder in folders:
-        if folder == 'filters':
-            filters_folder = os.path.join(template_folder, 'filters')
-            python_elements = __load_python_files_from_folder(filters_folder)
-            filters = __only_callable_values(python_elements)
-        elif folder == 'tests':
-            tests_folder = os.path.join(template_folder, 'tests')
-            python_elements = __load_python_files_from_folder(tests_folder)
-            tests = __only_callable_values(python_elements)
-        else:
-            other_folder = os.path.join(template_folder, folder)
-            python_elements = __load_python_files_from_folder(other_folder)
-            other_python.update(python_elements)
-    env = Environment(loader=FileSystemLoader(template_folder))
-    # add filters
-    for name, func in filters.items():
-        env.filters[name] = func
-    # add tests
-    for name, func in tests.items():
-        env.tests[name] = func
+    loader = FileSystemLoader(template_folder)
+    compiled_loader = __compiled_templates_loader(template_folder, fingerprint) if precompiled else None
+    if compiled_loader is not None:
+        # templates missing from the archive are still parsed from the sources
+        loader = ChoiceLoader([compiled_loader, loader])
+    env = Environment(loader=loader, **env_options)
+    # other python functions / data may override it
     env.globals['render_fragment'] = render_fragment
-    # add other python functions / data to globals
-    for name, func in other_python.items():
-        env.globals[name] = func
+    if lazy_helpers is None:
+        lazy_helpers = RENDER_LAZY_HELPERS
+    __register_python_helpers(env, template_folder, folders, lazy_helpers)
+    ENV_BUILDS.inc()
+    ENV_BUILD_DURATION.observe(time.perf_counter() - start)
     return env
+
+def __create_cached_jinja_env(template_folder, fingerprint):
+    # the fingerprint already detects changes, so jinja does not need to stat each template again,
+    # and every template of the folder is kept compiled
+    return create_jinja_env(template_folder, fingerprint=fingerprint, auto_reload=False, cache_size=-1)
+
+__ENV_CACHE = FolderCache(__create_cached_jinja_env)
+
+def get_jinja_env(template_folder, fingerprint=None):
+    """
+    Return the process-wide environment of a template folder, building it only when the folder changed.
+    The environment keeps its compiled templates, so warm renders skip both module loading and compilation.
+    :param template_folder: Template folder, as passed to create_jinja_env
+    :param fingerprint: Fingerprint of the folder, current_fingerprint when not given
+    """
+    return __ENV_CACHE.get(template_folder, fingerprint)
@@ -0,0 +1,61 @@
+import hashlib
+import os
+from typing import NamedTuple, Tuple, Union
+
+from .fingerprint import FolderCache
+from .wildcard_resolver import compile_path, WildcardExpression
+
+TEMPLATE_SUFFIXES = ('.jinja', '.j2')
+__HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class ManifestEntry(NamedTuple):
+    """
+    File of the 'project' folder of a template.
+    """
+    path: str                                           # relative to 'project', '/' separated
+    segments: Tuple[Union[str, WildcardExpression], ...]  # compiled path, see compile_path
+    is_template: bool                                   # rendered through Jinja2, otherwise copied as is
+    size: int
+    hash: str                                           # sha1 of the file content
+
+    @property
+    def has_wildcards(self) -> bool:
+        return any(isinstance(segment, WildcardExpression) for segment in self.segments)
+
+
+def __file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(__HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def build_manifest(template_folder) -> Tuple[ManifestEntry, ...]:
+    """
+    List every file of the 'project' folder of a template, sorted by path.
+    """
+    project_folder = os.path.join(template_folder, 'project')
+    entries = []
+    for root, dirs, files in os.walk(project_folder):
+        for file in files:
+            source_path = os.path.join(root, file)
+            template_path = str(os.path.relpath(source_path, project_folder)).replace('\\', '/')
+            entries.append(ManifestEntry(
+                path=template_path,
+                segments=compile_path(template_path),
+                is_template=template_path.endswith(TEMPLATE_SUFFIXES),
+                size=os.path.getsize(source_path),
+                hash=__file_hash(source_path),
+            ))
+    entries.sort(key=lambda entry: entry.path)
+    return tuple(entries)
+
+__MANIFEST_CACHE = FolderCache(lambda template_folder, fingerprint: build_manifest(template_folder))
+
+def get_manifest(template_folder, fingerprint=None) -> Tuple[ManifestEntry, ...]:
+    """
+    Return the cached manifest of a template folder, rebuilt only when the folder changed.
+    :param fingerprint: Fingerprint of the folder, current_fingerprint when not given
+    """
+    return __MANIFEST_CACHE.get(template_folder, fingerprint)
@@ -0,0 +1,121 @@
+import errno
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:  # not on Windows
+    fcntl = None
+
+from jinjaGenerator.settings import RENDER_STATIC_STRATEGY
+
+STRATEGIES = ('auto', 'hardlink', 'reflink', 'copy_file_range', 'copy')
+# ioctl cloning a whole file on btrfs, xfs, ... (linux/fs.h)
+__FICLONE = 0x40049409
+# errors meaning the strategy is not supported between these two files, and the next one should be tried
+__UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS, errno.EPERM,
+                        errno.EMLINK, errno.EBADF}
+# (strategy, source device, output device) that already failed, not tried again
+__unsupported = set()
+
+
+def __hardlink(source_path, output_path):
+    os.link(source_path, output_path)
+
+def __reflink(source_path, output_path):
+    if fcntl is None:
+        raise OSError(errno.ENOSYS, "reflinks are not supported on this platform")
+    with open(source_path, 'rb') as source, open(output_path, 'wb') as output:
+        fcntl.ioctl(output.fileno(), __FICLONE, source.fileno())
+
+def __copy_file_range(source_path, output_path):
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError(errno.ENOSYS, "copy_file_range is not supported on this platform")
+    with open(source_path, 'rb') as source, open(output_path, 'wb') as output:
+        remaining = os.fstat(source.fileno()).st_size
+        while remaining > 0:
+            copied = os.copy_file_range(source.fileno(), output.fileno(), remaining)
+            if copied == 0:
+                break
+            remaining -= copied
+
+def __copy(source_path, output_path):
+    shutil.copyfile(source_path, output_path)
+
+__COPIES = {
+    'hardlink': __hardlink,
+    'reflink': __reflink,
+    'copy_file_range': __copy_file_range,
+    'copy': __copy,
+}
+# tried in order, each one falling back to the next
+__FALLBACKS = {
+    'auto': ('reflink', 'copy_file_range', 'copy'),
+    'hardlink': ('hardlink', 'copy'),
+    'reflink': ('reflink', 'copy'),
+    'copy_file_range': ('copy_file_range', 'copy'),
+    'copy': ('copy',),
+}
+
+
+def is_materialized(source_path, output_path) -> bool:
+    """
+    Whether output_path already holds the content of source_path: it is the same file (a hardlink),
+    or it has the same size and modification time, which materialize gives to the files it copies.
+    """
+    try:
+        output_stat = os.stat(output_path)
+    except FileNotFoundError:
+        return False
+    source_stat = os.stat(source_path)
+    if (source_stat.st_dev, source_stat.st_ino) == (output_stat.st_dev, output_stat.st_ino):
+        return True
+    return source_stat.st_size == output_stat.st_size and source_stat.st_mtime_ns == output_stat.st_mtime_ns
+
+def unlink_shared(output_path):
+    """
+    Remove output_path when it is hardlinked to another file, e.g. a static file of the template,
+    so that writing it does not change the other file too.
+    """
+    try:
+        if os.stat(output_path).st_nlink > 1:
+            os.remove(output_path)
+    except FileNotFoundError:
+        pass
+
+def materialize(source_path, output_path, strategy=None) -> str:
+    """
+    Make output_path hold the content of source_path, without copying the content when the file system allows it.
+    :param strategy: one of STRATEGIES, RENDER_STATIC_STRATEGY when not given.
+        'auto' tries a reflink, then copy_file_range, then a plain copy; the other ones fall back to a plain copy.
+        Hardlinks share the file with the template: the output must not be edited in place.
+    :returns: the strategy used, or None when output_path already held the content
+    """
+    strategy = RENDER_STATIC_STRATEGY if strategy is None else strategy
+    if strategy not in __FALLBACKS:
+        raise ValueError(f"Unknown static file strategy '{strategy}', expected one of {', '.join(STRATEGIES)}")
+    if is_materialized(source_path, output_path):
+        return None
+    if os.path.lexists(output_path):
+        # replaced, not written in place: it may be hardlinked to another file
+        os.remove(output_path)
+    source_stat = os.stat(source_path)
+    output_device = os.stat(os.path.dirname(output_path) or '.').st_dev
+    for name in __FALLBACKS[strategy]:
+        key = (name, source_stat.st_dev, output_device)
+        if name != 'copy' and key in __unsupported:
+            continue
+        try:
+            __COPIES[name](source_path, output_path)
+        except OSError as e:
+            if name == 'copy' or e.errno not in __UNSUPPORTED_ERRNOS:
+                raise
+            __unsupported.add(key)
+            if os.path.lexists(output_path):
+                os.remove(output_path)
+            continue
+        if name != 'hardlink':
+            shutil.copymode(source_path, output_path)
+            # same modification time as the source, so that is_materialized recognizes the copy
+            os.utime(output_path, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+        return name
@@ -0,0 +1,288 @@
+import bisect
+import functools
+import inspect
+import threading
+import time
+
+from .render_cache import render_cache
+
+# upper bounds of the latency histograms, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# upper bounds of the histograms counting things, e.g. the paths a wildcard path resolves to
+COUNT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class Metric:
+    """
+    Metric of the registry, with one child per combination of label values.
+    Hot paths should keep the child returned by labels() instead of looking it up on every update.
+    """
+    type = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.label_names:
+            # exposed from the start, as 0
+            self.labels()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *label_values):
+        label_values = tuple(str(value) for value in label_values)
+        if len(label_values) != len(self.label_names):
+            raise ValueError(f"{self.name} expects the labels {self.label_names}, got {label_values}")
+        child = self._children.get(label_values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(label_values, self._new_child())
+        return child
+
+    def _samples(self):
+        """
+        Yield (name suffix, label values, extra (name, value) labels, value) of every child.
+        """
+        for label_values, child in list(self._children.items()):
+            yield '', label_values, (), child.value
+
+    @staticmethod
+    def _format_value(value):
+        if value == float('inf'):
+            return '+Inf'
+        if isinstance(value, float):
+            return str(int(value)) if value.is_integer() else repr(value)
+        return str(value)
+
+    def _format_labels(self, label_values, extra):
+        pairs = list(zip(self.label_names, label_values)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(
+            f'{name}="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+            for name, value in pairs
+        ) + '}'
+
+    def expose(self) -> str:
+        """
+        The metric in the Prometheus text format.
+        """
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for suffix, label_values, extra, value in self._samples():
+            lines.append(f"{self.name}{suffix}{self._format_labels(label_values, extra)} {self._format_value(value)}")
+        return '\n'.join(lines)
+
+
+class _CounterChild:
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class _GaugeChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+
+class Gauge(Metric):
+    """
+    Gauge set by the code, or read from function() at scrape time when one is given:
+    a number, or a dict label value -> number for a gauge with a single label.
+    """
+    type = 'gauge'
+
+    def __init__(self, name, documentation, label_names=(), function=None):
+        super().__init__(name, documentation, label_names)
+        self.function = function
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def _samples(self):
+        if self.function is None:
+            yield from super()._samples()
+            return
+        value = self.function()
+        if isinstance(value, dict):
+            for label_value, child_value in value.items():
+                yield '', (label_value,), (), child_value
+        else:
+            yield '', (), (), value
+
+
+class _HistogramChild:
+    __slots__ = ('buckets', 'counts', 'sum', 'count', '_lock')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one counts the values above every bucket
+        self.sum = 0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, label_names)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _samples(self):
+        for label_values, child in list(self._children.items()):
+            with child._lock:
+                counts, total, count = list(child.counts), child.sum, child.count
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                yield '_bucket', label_values, (('le', self._format_value(float(bound))),), cumulative
+            yield '_sum', label_values, (), total
+            yield '_count', label_values, (), count
+
+
+class MetricsRegistry:
+    """
+    Metrics of this process, exposed together by the /metrics endpoint.
+    Each process of a multi-process server has its own registry.
+    """
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def expose(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(metric.expose() for metric in metrics) + '\n'
+
+
+registry = MetricsRegistry()
+
+HTTP_REQUESTS = registry.register(Counter(
+    'jinja_http_requests_total', "Requests handled by the views, by view and status code", ('view', 'status')))
+HTTP_REQUEST_DURATION = registry.register(Histogram(
+    'jinja_http_request_duration_seconds', "Time spent in the views, until the response is returned", ('view',)))
+TEMPLATE_UPLOADS = registry.register(Counter(
+    'jinja_template_uploads_total', "Template uploads by result: new version, unchanged or rejected", ('result',)))
+TEMPLATE_UPLOAD_DURATION = registry.register(Histogram(
+    'jinja_template_upload_duration_seconds', "Time spent storing and compiling an uploaded template archive"))
+ENV_BUILDS = registry.register(Counter(
+    'jinja_env_builds_total', "Jinja2 environments created, helper modules included"))
+ENV_BUILD_DURATION = registry.register(Histogram(
+    'jinja_env_build_duration_seconds', "Time spent creating a Jinja2 environment"))
+RESOLVE_FANOUT = registry.register(Histogram(
+    'jinja_resolve_path_fanout', "Paths a path with wildcards resolves to", buckets=COUNT_BUCKETS))
+RENDERS = registry.register(Counter(
+    'jinja_renders_total', "Renders of a template into an output folder"))
+RENDER_DURATION = registry.register(Histogram(
+    'jinja_render_duration_seconds', "Time spent rendering a template into an output folder"))
+RENDER_FILES = registry.register(Histogram(
+    'jinja_render_files', "Output files of a render", buckets=COUNT_BUCKETS))
+FILES_WRITTEN = registry.register(Counter(
+    'jinja_render_files_written_total', "Output files written, by kind: template or static", ('kind',)))
+BYTES_WRITTEN = registry.register(Counter(
+    'jinja_render_bytes_written_total', "Bytes of the output files written, by kind: template or static", ('kind',)))
+registry.register(Gauge(
+    'jinja_render_cache', "Render cache state: entries, bytes, hits, misses and evictions", ('stat',),
+    function=lambda: {stat: value for stat, value in render_cache.stats().items()
+                      if stat in ('entries', 'bytes', 'hits', 'misses', 'evictions')}))
+
+__template_files = FILES_WRITTEN.labels('template')
+__static_files = FILES_WRITTEN.labels('static')
+__template_bytes = BYTES_WRITTEN.labels('template')
+__static_bytes = BYTES_WRITTEN.labels('static')
+
+
+def observe_render(timings, duration, files):
+    """
+    Record a finished render, from the 'render' and 'copy' phases of its RenderTimings.
+    """
+    RENDERS.inc()
+    RENDER_DURATION.observe(duration)
+    RENDER_FILES.observe(files)
+    for phase, files_child, bytes_child in (('render', __template_files, __template_bytes),
+                                            ('copy', __static_files, __static_bytes)):
+        count, _, size = timings.phases.get(phase, (0, 0, 0))
+        files_child.inc(count)
+        bytes_child.inc(size)
+
+def observe_view(name):
+    """
+    Decorate a view, sync or async, to count its requests by status code and time them.
+    """
+    duration = HTTP_REQUEST_DURATION.labels(name)
+
+    def decorator(view):
+        if inspect.iscoroutinefunction(view):
+            @functools.wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                start = time.perf_counter()
+                status = 500
+                try:
+                    response = await view(request, *args, **kwargs)
+                    status = response.status_code
+                    return response
+                finally:
+                    duration.observe(time.perf_counter() - start)
+                    HTTP_REQUESTS.labels(name, status).inc()
+            return async_wrapper
+
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            start = time.perf_counter()
+            status = 500
+            try:
+                response = view(request, *args, **kwargs)
+                status = response.status_code
+                return response
+            finally:
+                duration.observe(time.perf_counter() - start)
+                HTTP_REQUESTS.labels(name, status).inc()
+        return wrapper
+    return decorator
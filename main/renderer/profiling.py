@@ -0,0 +1,68 @@
+import cProfile
+import marshal
+import pstats
+
+from .renderer import render
+from .timing import RenderTimings, detail_timings
+
+# orders of the functions ranking, see RenderProfile.top_functions
+PROFILE_SORT_KEYS = ('tottime', 'cumtime', 'ncalls')
+
+
+class RenderProfile:
+    """
+    Deterministic profile of one render, with the breakdown of its time by template file, wildcard and fragment.
+    """
+    def __init__(self, profiler: cProfile.Profile, timings: RenderTimings, output_folder):
+        self.profiler = profiler
+        self.timings = timings
+        self.output_folder = output_folder
+
+    def top_functions(self, limit=30, sort='tottime') -> list:
+        """
+        The limit functions taking the most time, e.g. a slow filter of filters/filters.py.
+        :param sort: 'tottime' (time in the function itself), 'cumtime' (including its callees) or 'ncalls'
+        """
+        if sort not in PROFILE_SORT_KEYS:
+            raise ValueError(f"Unknown profile sort '{sort}', expected one of {', '.join(PROFILE_SORT_KEYS)}")
+        stats = pstats.Stats(self.profiler).stats
+        functions = [
+            {
+                "function": name,
+                "file": filename,
+                "line": line,
+                "ncalls": total_calls,
+                "tottime": total_time,
+                "cumtime": cumulative_time,
+            }
+            for (filename, line, name), (_, total_calls, total_time, cumulative_time, _) in stats.items()
+        ]
+        functions.sort(key=lambda function: function[sort], reverse=True)
+        return functions[:limit]
+
+    def to_dict(self, limit=30, sort='tottime') -> dict:
+        return {
+            "functions": self.top_functions(limit, sort),
+            **self.timings.details_to_dict(),
+            "timings": self.timings.to_dict(),
+        }
+
+    def dump(self) -> bytes:
+        """
+        The profile in the format of cProfile.Profile.dump_stats, readable with pstats or snakeviz.
+        """
+        self.profiler.create_stats()
+        return marshal.dumps(self.profiler.stats)
+
+
+def profile_render(template_folder, context, incremental=None, output_folder=None) -> RenderProfile:
+    """
+    Render like render() does, under cProfile. The outputs are rendered on the calling thread, so the profiler
+    sees all of them, and without the render cache, so they are actually rendered.
+    """
+    profiler = cProfile.Profile()
+    timings = RenderTimings()
+    with detail_timings(timings):
+        output_folder = profiler.runcall(render, template_folder, context, workers=0, incremental=incremental,
+                                         output_folder=output_folder, timings=timings, use_cache=False)
+    return RenderProfile(profiler, timings, output_folder)
@@ -0,0 +1,90 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+from jinjaGenerator.settings import RENDER_CACHE_MAX_ENTRIES, RENDER_CACHE_MAX_BYTES, RENDER_CACHE_MAX_ENTRY_BYTES
+
+
+def context_fingerprint(context) -> str:
+    """
+    Canonical hash of a render context: equal for equal JSON documents, whatever the order of their keys.
+    """
+    canonical = json.dumps(context, sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str)
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+class RenderCache:
+    """
+    Bounded LRU cache of rendered outputs, keyed by (template version, context fingerprint, template path, '_path' fingerprint).
+    Least recently used outputs are evicted once there are more than max_entries of them,
+    or once together they take more than max_bytes. Outputs of more than max_entry_bytes are not cached.
+    """
+    def __init__(self, max_entries, max_bytes, max_entry_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_bytes if max_entry_bytes is None else min(max_entry_bytes, max_bytes)
+        self._entries = OrderedDict()  # key -> (output, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 and self.max_bytes > 0
+
+    def get(self, key):
+        """
+        Return the cached output, or None when it is not cached.
+        """
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return cached[0]
+
+    def put(self, key, output: str, size=None):
+        """
+        :param size: UTF-8 bytes of output, when the caller already counted them
+        """
+        size = len(output.encode('utf-8')) if size is None else size
+        if size > self.max_entry_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._entries[key] = (output, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "max_entry_bytes": self.max_entry_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+
+render_cache = RenderCache(RENDER_CACHE_MAX_ENTRIES, RENDER_CACHE_MAX_BYTES, RENDER_CACHE_MAX_ENTRY_BYTES)
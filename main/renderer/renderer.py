@@ -1,48 +1,576 @@
-import os, shutil
+import hashlib, json, logging, os, shutil, tempfile, time, zipfile
+from collections import ChainMap
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
 
-from jinjaGenerator.settings import BASE_DIR
-from .loader import create_jinja_env
-from .wildcard_resolver import resolve_path
+from jinjaGenerator.settings import BASE_DIR, RENDER_WORKERS, RENDER_EXECUTOR, RENDER_STREAM_CHUNK_SIZE, RENDER_INCREMENTAL, \
+    RENDER_WRITE_BUFFER_SIZE, RENDER_TRACK_DEPENDENCIES
+from .fingerprint import current_fingerprint
+from .context import generate_with_parent, TrackingContext
+from .defaults import fragment_memo
+from .dependencies import DependencyTracker, load_output_dependencies, output_dependencies
+from .loader import get_jinja_env
+from .manifest import get_manifest
+from .materialize import materialize, unlink_shared
+from .metrics import observe_render
+from .render_cache import render_cache, context_fingerprint
+from .timing import RenderTimings, current_detail_timings
+from .wildcard_resolver import iter_resolved_paths
+from .workspaces import lock_output_folder
+from .zip_stream import ZipStream
 
+# INFO: one summary per render, DEBUG: every resolved and written file, see RENDER_LOG_LEVEL
+__logger = logging.getLogger(__name__)
+# render pass of a process pool worker, set once by __init_process_worker
+__worker_state = {}
+# written in the output folder by incremental renders: output relative path -> sha1 of its content
+OUTPUT_MANIFEST_NAME = '.render-manifest.json'
 
-def __create_output_folder(template_name):
-    output_folder = os.path.join(BASE_DIR, 'toutput', template_name)
-    if os.path.exists(output_folder):
+
+def __create_output_folder(output_folder, incremental=False):
+    # incremental renders keep the previous output, unless they can not know what it contains
+    keep_previous = incremental and os.path.exists(os.path.join(output_folder, OUTPUT_MANIFEST_NAME))
+    if os.path.exists(output_folder) and not keep_previous:
         shutil.rmtree(output_folder)
     os.makedirs(output_folder, exist_ok=True)
     return output_folder
 
-def render(template_folder, context):
-    project_folder = os.path.join(template_folder, 'project')
-    env = create_jinja_env(template_folder)
-    template_name = os.path.basename(template_folder)
-    output_folder = __create_output_folder(template_name)
-
-    # render all files in the project folder
-    for root, dirs, files in os.walk(project_folder):
-        for file in files:
-            template_path = os.path.relpath(os.path.join(root, file), project_folder)
-            template_path = str(template_path).replace('\\', '/')
-            resolved_paths = resolve_path(template_path, context, env)
-            for resolved_path, additional_context in resolved_paths:
-                print("Processing file:", template_path, "->", resolved_path, "with context:", additional_context)
-                if resolved_path.endswith('.jinja') or resolved_path.endswith('.j2'):
-                    template = env.get_template('project/' + template_path)
-                    full_context = context.copy()
-                    full_context.update({"_path": additional_context})
-                    output = template.render(full_context)
-                    # determine the output path
-                    relative_path = resolved_path
-                    relative_path = relative_path.replace('.jinja', '').replace('.j2', '')
-                    output_path = os.path.join(output_folder, relative_path)
-                    output_dir = os.path.dirname(output_path)
-                    os.makedirs(output_dir, exist_ok=True)
-                    with open(output_path, 'w') as f:
-                        f.write(output)
-                else: # copy the file as is
-                    source_path = os.path.join(root, file)
-                    relative_path = resolved_path
-                    output_path = os.path.join(output_folder, relative_path)
-                    output_dir = os.path.dirname(output_path)
-                    os.makedirs(output_dir, exist_ok=True)
-                    shutil.copy(source_path, output_path)
\ No newline at end of file
+def __load_output_manifest(output_folder):
+    """
+    Hashes saved in the output folder by the previous incremental render, {} when there are none.
+    The file is removed: a render failing midway leaves outputs the saved hashes do not describe anymore,
+    so the render after it starts from an empty output folder.
+    """
+    manifest_path = os.path.join(output_folder, OUTPUT_MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return {}
+    try:
+        with open(manifest_path, 'r') as f:
+            output_hashes = json.load(f)
+    except (OSError, ValueError) as e:
+        __logger.warning("Ignoring output manifest %s: %s", manifest_path, e)
+        output_hashes = {}
+    os.remove(manifest_path)
+    return output_hashes
+
+def __save_output_manifest(output_folder, output_hashes):
+    manifest_path = os.path.join(output_folder, OUTPUT_MANIFEST_NAME)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(output_hashes, f, indent=1, sort_keys=True)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+def __remove_stale_outputs(output_folder, stale_paths):
+    """
+    Delete the files of a previous render that are not produced anymore, and the folders left empty.
+    """
+    for relative_path in stale_paths:
+        output_path = os.path.join(output_folder, relative_path)
+        if os.path.isfile(output_path):
+            os.remove(output_path)
+        output_dir = os.path.dirname(output_path)
+        while output_dir != output_folder and os.path.isdir(output_dir) and not os.listdir(output_dir):
+            os.rmdir(output_dir)
+            output_dir = os.path.dirname(output_dir)
+
+def __output_relative_path(entry, resolved_path):
+    if entry.is_template:
+        return resolved_path.replace('.jinja', '').replace('.j2', '')
+    return resolved_path
+
+def __iter_outputs(manifest, context, env, timings=None):
+    """
+    Yield (output relative path, entry, additional_context) for every manifest entry, resolving the wildcards
+    lazily: each output is resolved when the previous one is consumed, so memory does not grow with the fan-out.
+    Two files may resolve to the same output, the last one wins when they are written in order.
+    The time spent resolving is added to the 'resolve' phase of timings, counting the outputs.
+    """
+    # checked once, formatting the context of every file is not free even when the record is dropped
+    debug = __logger.isEnabledFor(logging.DEBUG)
+    seconds, count = 0.0, 0
+    try:
+        for entry in manifest:
+            if not entry.has_wildcards:
+                count += 1
+                yield __output_relative_path(entry, entry.path), entry, {}
+                continue
+            resolved_paths = iter_resolved_paths(entry.path, context, env)
+            while True:
+                start = time.perf_counter()
+                resolved = next(resolved_paths, None)
+                seconds += time.perf_counter() - start
+                if resolved is None:
+                    break
+                resolved_path, additional_context = resolved
+                if debug:
+                    __logger.debug("Processing file: %s -> %s with context: %s", entry.path, resolved_path,
+                                   additional_context)
+                count += 1
+                yield __output_relative_path(entry, resolved_path), entry, additional_context
+    finally:
+        if timings is not None:
+            timings.add('resolve', seconds, count=count)
+
+def __last_output_indexes(manifest, context, env):
+    """
+    Resolve the paths once without keeping the outputs, to know where each output path is resolved last.
+    Returns a dict output relative path -> index of its last output in __iter_outputs, so its length is the number
+    of output files of the render.
+    """
+    return {relative_path: index
+            for index, (relative_path, _, _) in enumerate(__iter_outputs(manifest, context, env))}
+
+def __outputs_to_render(outputs, tracker, output_folder, previous_hashes, reused_hashes):
+    """
+    Yield the outputs of an incremental render that have to be written: an output path keeps its file when all the
+    outputs resolved to it are template outputs whose dependencies did not change since the previous render,
+    its hash is put into reused_hashes instead. Otherwise all of them are yielded, in order, so the last one wins.
+    The outputs that are up to date are held until their path is known to be reused, i.e. the end of the outputs.
+    """
+    pending = {}  # output relative path -> up to date outputs of the path, not yielded yet
+    rendered = set()  # output relative paths that are written again
+    for relative_path, entry, additional_context in outputs:
+        if relative_path not in rendered:
+            previous_hash = previous_hashes.get(relative_path)
+            if entry.is_template and previous_hash is not None \
+                    and tracker.is_up_to_date(relative_path, additional_context) \
+                    and os.path.isfile(os.path.join(output_folder, relative_path)):
+                pending.setdefault(relative_path, []).append((entry, additional_context))
+                continue
+            rendered.add(relative_path)
+            # the earlier outputs of the path are written before this one
+            for pending_entry, pending_context in pending.pop(relative_path, ()):
+                yield relative_path, pending_entry, pending_context
+        yield relative_path, entry, additional_context
+    for relative_path in pending:
+        reused_hashes[relative_path] = previous_hashes[relative_path]
+        tracker.carry_over(relative_path)
+
+def __create_output_dir(output_folder, relative_path, created_dirs):
+    # outputs of the same folder only create it once
+    output_dir = os.path.dirname(os.path.join(output_folder, relative_path))
+    if output_dir not in created_dirs:
+        os.makedirs(output_dir, exist_ok=True)
+        created_dirs.add(output_dir)
+
+
+class RenderPass:
+    """
+    State shared by all the outputs of one render of a template with a context.
+    """
+    def __init__(self, template_folder, context, env, fingerprint, output_folder=None, incremental=False, use_cache=True,
+                 timings=None, track_dependencies=False):
+        self.template_folder = template_folder
+        self.context = context
+        self.env = env
+        self.fingerprint = fingerprint
+        self.output_folder = output_folder
+        self.incremental = incremental
+        # record the context keys read by each template output into dependencies, see dependencies.py;
+        # outputs taken from the render cache or the pure fragment memo would not record them, so neither is used
+        self.track_dependencies = track_dependencies
+        self.dependencies = {}  # output relative path -> output_dependencies
+        use_cache = use_cache and not track_dependencies
+        # the render cache key of the outputs is cache_version + (template path, '_path' fingerprint), None without cache
+        self.cache_version = (fingerprint, context_fingerprint(context)) if use_cache and render_cache.enabled else None
+        # outputs of the pure fragments, see render_fragment
+        self.fragment_memo = None if track_dependencies else {}
+        self.timings = RenderTimings() if timings is None else timings
+        # per file log records, checked once per render (the module logger name would be mangled here)
+        self.log_files = logging.getLogger(__name__).isEnabledFor(logging.DEBUG)
+
+
+def __generate_template(render_pass, entry, additional_context, context=None):
+    """
+    Yield the output of a template of the manifest in chunks, as Jinja2 generates them,
+    or at once when it is in the render cache. Outputs of at most render_cache.max_entry_bytes are stored into it,
+    larger ones are not kept in memory.
+    Pure fragments are only memoized when consumed inside fragment_memo(render_pass.fragment_memo).
+    :param context: Context of the output, render_pass.context when not given, e.g. a TrackingContext over it
+    """
+    cache_key = None
+    if render_pass.cache_version is not None:
+        # two templates, or one template with two '_path', may give the same output path: neither is keyed by it
+        cache_key = render_pass.cache_version + (entry.path, context_fingerprint(additional_context))
+        output = render_cache.get(cache_key)
+        if output is not None:
+            yield output
+            return
+    template = render_pass.env.get_template('project/' + entry.path)
+    # '_path' laid over the context and the globals, instead of copying both for every output
+    full_context = ChainMap({"_path": additional_context}, render_pass.context if context is None else context,
+                            template.globals)
+    cached_chunks = [] if cache_key is not None else None
+    cached_size = 0
+    for chunk in generate_with_parent(template, full_context):
+        if cached_chunks is not None:
+            cached_size += len(chunk.encode('utf-8'))
+            # too large for the cache: stop keeping the chunks, so memory stays bounded by the chunk size
+            if cached_size > render_cache.max_entry_bytes:
+                cached_chunks = None
+            else:
+                cached_chunks.append(chunk)
+        yield chunk
+    if cached_chunks is not None:
+        render_cache.put(cache_key, ''.join(cached_chunks), cached_size)
+
+def __write_chunks(chunks, output_path):
+    """
+    :returns: bytes written
+    """
+    # the previous output may be a static file hardlinked to the template
+    unlink_shared(output_path)
+    with open(output_path, 'w', buffering=RENDER_WRITE_BUFFER_SIZE) as f:
+        for chunk in chunks:
+            f.write(chunk)
+        # tell() of a text file is much slower than a stat
+        f.flush()
+        return os.fstat(f.fileno()).st_size
+
+def __write_chunks_if_changed(chunks, output_path, previous_hash):
+    """
+    Write the chunks to output_path unless the file already has the same content.
+    Outputs up to RENDER_WRITE_BUFFER_SIZE are compared in memory, larger ones are spilled to a temporary file
+    that replaces the output when its content changed.
+    :returns: tuple(sha1 of the content, bytes of the content)
+    """
+    digest = hashlib.sha1()
+    size = 0
+    buffered, buffered_size = [], 0
+    temp_file = None
+    try:
+        for chunk in chunks:
+            encoded = chunk.encode('utf-8')
+            digest.update(encoded)
+            size += len(encoded)
+            if temp_file is None:
+                buffered.append(chunk)
+                buffered_size += len(chunk)
+                if buffered_size <= RENDER_WRITE_BUFFER_SIZE:
+                    continue
+                fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(output_path), prefix='.', suffix='.tmp')
+                temp_file = open(fd, 'w', buffering=RENDER_WRITE_BUFFER_SIZE)
+                chunk = ''.join(buffered)
+                buffered = None
+            temp_file.write(chunk)
+    except BaseException:
+        if temp_file is not None:
+            temp_file.close()
+            os.remove(temp_path)
+        raise
+    content_hash = digest.hexdigest()
+    unchanged = content_hash == previous_hash and os.path.isfile(output_path)
+    if temp_file is None:
+        if not unchanged:
+            __write_chunks(buffered, output_path)
+        return content_hash, size
+    temp_file.close()
+    if unchanged:
+        os.remove(temp_path)
+    else:
+        os.replace(temp_path, output_path)
+    return content_hash, size
+
+def __write_template_output(render_pass, relative_path, entry, additional_context, output_path, previous_hash):
+    context = TrackingContext(render_pass.context) if render_pass.track_dependencies else None
+    with fragment_memo(render_pass.fragment_memo):
+        chunks = __generate_template(render_pass, entry, additional_context, context)
+        if render_pass.incremental:
+            result = __write_chunks_if_changed(chunks, output_path, previous_hash)
+        else:
+            result = None, __write_chunks(chunks, output_path)
+    if context is not None:
+        render_pass.dependencies[relative_path] = output_dependencies(context.keys_read, additional_context)
+    return result
+
+def __write_static_output(render_pass, entry, output_path, previous_hash):
+    # link or copy the file as is, skipped when the output is already identical
+    content_hash = entry.hash if render_pass.incremental else None
+    if render_pass.incremental and content_hash == previous_hash and os.path.isfile(output_path):
+        return content_hash, entry.size
+    materialize(os.path.join(render_pass.template_folder, 'project', entry.path), output_path)
+    return content_hash, entry.size
+
+def __write_output(render_pass, relative_path, entry, additional_context, previous_hash=None):
+    """
+    Write one output file, streaming the output of templates through a buffered writer,
+    and add its duration and size to the 'render' or 'copy' phase of the render timings.
+    In incremental mode, returns the sha1 of its content and does not write the file when it already has that content.
+    """
+    output_path = os.path.join(render_pass.output_folder, relative_path)
+    start = time.perf_counter()
+    if entry.is_template:
+        content_hash, size = __write_template_output(render_pass, relative_path, entry, additional_context,
+                                                     output_path, previous_hash)
+    else:
+        content_hash, size = __write_static_output(render_pass, entry, output_path, previous_hash)
+    duration = time.perf_counter() - start
+    render_pass.timings.add('render' if entry.is_template else 'copy', duration, size=size)
+    detail_timings = current_detail_timings()
+    if detail_timings is not None:
+        detail_timings.add_detail('templates', entry.path, duration)
+    if render_pass.log_files:
+        __logger.debug("Wrote %s in %.2f ms (%d bytes)", relative_path, duration * 1000, size)
+    return content_hash
+
+def __init_process_worker(template_folder, context, output_folder, incremental, track_dependencies):
+    # the render cache of the worker processes would be thrown away with them, so it is not used
+    __worker_state['render_pass'] = RenderPass(template_folder, context, get_jinja_env(template_folder), None,
+                                               output_folder, incremental, use_cache=False,
+                                               track_dependencies=track_dependencies)
+
+def __write_output_in_process(relative_path, entry, additional_context, previous_hash):
+    # the timings and dependencies of the file are sent back with its hash, to be merged into those of the render
+    render_pass = __worker_state['render_pass']
+    render_pass.timings = RenderTimings()
+    render_pass.dependencies = {}
+    content_hash = __write_output(render_pass, relative_path, entry, additional_context, previous_hash)
+    return content_hash, render_pass.timings.phases, render_pass.dependencies
+
+def __write_outputs_in_pool(render_pass, outputs, workers, executor, previous_hashes, progress=None,
+                            created_dirs=None):
+    """
+    Write the outputs on a pool, submitting them while they are resolved: at most a few per worker are in flight,
+    so memory does not grow with the number of outputs.
+    :param progress: Called with the number of files written after each of them
+    Returns a dict output relative path -> content hash, as returned by __write_output
+    """
+    created_dirs = set() if created_dirs is None else created_dirs
+    output_hashes = {}
+    # the hash of the file as it is now: written by this render when the output resolved twice, see __write_output
+    current_hash = lambda relative_path: output_hashes.get(relative_path, previous_hashes.get(relative_path))
+    if executor == 'process':
+        # jinja environments can not be pickled: each process builds its own, and receives the context once
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=__init_process_worker,
+                                   initargs=(render_pass.template_folder, render_pass.context,
+                                             render_pass.output_folder, render_pass.incremental,
+                                             render_pass.track_dependencies))
+        submit = lambda relative_path, entry, additional_context: pool.submit(
+            __write_output_in_process, relative_path, entry, additional_context, current_hash(relative_path))
+
+        def collect(result):
+            content_hash, phases, dependencies = result
+            render_pass.timings.merge(phases)
+            render_pass.dependencies.update(dependencies)
+            return content_hash
+    elif executor == 'thread':
+        pool = ThreadPoolExecutor(max_workers=workers)
+        submit = lambda relative_path, entry, additional_context: pool.submit(
+            __write_output, render_pass, relative_path, entry, additional_context, current_hash(relative_path))
+        collect = lambda content_hash: content_hash
+    else:
+        raise ValueError(f"Unknown render executor '{executor}', expected 'thread' or 'process'")
+    in_flight = {}  # future -> output relative path
+    in_flight_paths = {}  # output relative path -> future
+
+    def collect_done(return_when):
+        done, _ = wait(in_flight, return_when=return_when)
+        for future in done:
+            relative_path = in_flight.pop(future)
+            if in_flight_paths.get(relative_path) is future:
+                del in_flight_paths[relative_path]
+            output_hashes[relative_path] = collect(future.result())
+            if progress is not None:
+                progress(len(output_hashes))
+
+    with pool:
+        for relative_path, entry, additional_context in outputs:
+            previous = in_flight_paths.get(relative_path)
+            if previous is not None:
+                # the same output resolved twice: the last one wins, so it is written after the previous one
+                wait([previous])
+                collect_done(FIRST_COMPLETED)
+            while len(in_flight) >= workers * 4:
+                collect_done(FIRST_COMPLETED)
+            __create_output_dir(render_pass.output_folder, relative_path, created_dirs)
+            future = submit(relative_path, entry, additional_context)
+            in_flight[future] = relative_path
+            in_flight_paths[relative_path] = future
+        collect_done(ALL_COMPLETED)
+        return output_hashes
+
+def render(template_folder, context, workers=None, executor=None, incremental=None, progress=None, output_folder=None,
+           timings=None, use_cache=True, track_dependencies=None):
+    """
+    Render the template folder with the context into output_folder, toutput/<template name> when not given.
+    :param workers: Number of workers rendering and writing the output files, RENDER_WORKERS when not given.
+        0 or 1 renders them one after another on the calling thread.
+    :param executor: 'thread' or 'process', RENDER_EXECUTOR when not given
+    :param incremental: Keep the previous output and only write the files whose content changed, delete the files
+        that are not produced anymore. RENDER_INCREMENTAL when not given
+    :param progress: Called with (files done, files total) before the first and after each written file.
+        The paths are resolved once more upfront to count the files
+    :param output_folder: Folder the files are written to, e.g. a workspace of this render only (see workspaces.py).
+        Renders sharing an output folder must not run at the same time. When not given, renders of the template
+        into toutput/<template name> wait for each other, in every thread and process.
+    :param timings: RenderTimings the phases of the render are added to, see timing.py
+    :param use_cache: Look up and store the outputs in the render cache
+    :param track_dependencies: In incremental mode, record the context keys each template output reads and only
+        render again the outputs whose keys or '_path' changed since the previous render of the output folder, see
+        dependencies.py. Does not use the render cache. RENDER_TRACK_DEPENDENCIES when not given
+    :returns: the output folder
+    """
+    if output_folder is None:
+        output_folder = os.path.join(BASE_DIR, 'toutput', os.path.basename(template_folder))
+        with lock_output_folder(output_folder):
+            return render(template_folder, context, workers=workers, executor=executor, incremental=incremental,
+                          progress=progress, output_folder=output_folder, timings=timings, use_cache=use_cache,
+                          track_dependencies=track_dependencies)
+    workers = RENDER_WORKERS if workers is None else workers
+    executor = RENDER_EXECUTOR if executor is None else executor
+    incremental = RENDER_INCREMENTAL if incremental is None else incremental
+    timings = RenderTimings() if timings is None else timings
+    track_dependencies = incremental and (RENDER_TRACK_DEPENDENCIES if track_dependencies is None
+                                          else track_dependencies)
+    start = time.perf_counter()
+    with timings.phase('fingerprint'):
+        fingerprint = current_fingerprint(template_folder)
+    with timings.phase('env'):
+        env = get_jinja_env(template_folder, fingerprint)
+    with timings.phase('manifest'):
+        manifest = get_manifest(template_folder, fingerprint)
+    with timings.phase('prepare'):
+        output_folder = __create_output_folder(output_folder, incremental)
+        previous_hashes = __load_output_manifest(output_folder) if incremental else {}
+        render_pass = RenderPass(template_folder, context, env, fingerprint, output_folder, incremental,
+                                 use_cache=use_cache, timings=timings, track_dependencies=track_dependencies)
+        tracker = None
+        if incremental:
+            # removed even when this render does not track dependencies, it would leave them outdated
+            previous_dependencies = load_output_dependencies(output_folder)
+            if track_dependencies:
+                tracker = DependencyTracker(fingerprint, context, previous_dependencies)
+                render_pass.dependencies = tracker.outputs
+
+    # the paths are resolved while the outputs are written, so only the outputs in flight are held in memory
+    outputs = __iter_outputs(manifest, context, env, timings)
+    reused_hashes = {}
+    if tracker is not None:
+        outputs = __outputs_to_render(outputs, tracker, output_folder, previous_hashes, reused_hashes)
+    created_dirs = set()
+    report = None
+    if progress is not None:
+        with timings.phase('count'):
+            files_total = len(__last_output_indexes(manifest, context, env))
+        progress(0, files_total)
+        report = lambda files_done: progress(files_done, files_total)
+    outputs_start = time.perf_counter()
+    if workers > 1:
+        output_hashes = __write_outputs_in_pool(render_pass, outputs, workers, executor, previous_hashes, report,
+                                                created_dirs)
+    else:
+        output_hashes = {}
+        for relative_path, entry, additional_context in outputs:
+            __create_output_dir(output_folder, relative_path, created_dirs)
+            # an output resolved twice compares with the file the earlier one wrote
+            previous_hash = output_hashes.get(relative_path, previous_hashes.get(relative_path))
+            output_hashes[relative_path] = __write_output(render_pass, relative_path, entry, additional_context,
+                                                          previous_hash)
+            if report is not None:
+                report(len(output_hashes))
+    if reused_hashes:
+        timings.add('reused', 0, count=len(reused_hashes))
+        output_hashes = {**reused_hashes, **output_hashes}
+    # includes resolving the paths, also reported on its own as 'resolve'
+    timings.add('outputs', time.perf_counter() - outputs_start, count=len(output_hashes))
+    if progress is not None:
+        progress(len(output_hashes), len(output_hashes))
+    if incremental:
+        with timings.phase('cleanup'):
+            __remove_stale_outputs(output_folder, [path for path in previous_hashes if path not in output_hashes])
+            __save_output_manifest(output_folder, output_hashes)
+            if tracker is not None:
+                tracker.save(output_folder)
+    duration = time.perf_counter() - start
+    timings.add('total', duration)
+    observe_render(timings, duration, len(output_hashes))
+    __logger.info("Rendered %s: %d files in %.2f ms into %s", os.path.basename(template_folder), len(output_hashes),
+                  duration * 1000, output_folder)
+    return output_folder
+
+def warm_up_template(template_folder):
+    """
+    Build the environment and manifest of a template folder and load all its templates,
+    so its next render finds them in the process-wide caches.
+    """
+    fingerprint = current_fingerprint(template_folder)
+    env = get_jinja_env(template_folder, fingerprint)
+    manifest = get_manifest(template_folder, fingerprint)
+    for entry in manifest:
+        if entry.is_template:
+            env.get_template('project/' + entry.path)
+    return len(manifest)
+
+def __write_zip_outputs(archive, stream, render_pass, manifest, prefix=''):
+    """
+    Render the outputs of one context into the archive, under prefix. Yields the archive bytes as they are produced.
+    An archive entry can not be replaced once written: the paths are resolved once upfront to only write the last
+    output of each path, then resolved again lazily while the outputs are written, like render does.
+    """
+    last_indexes = __last_output_indexes(manifest, render_pass.context, render_pass.env)
+    outputs = __iter_outputs(manifest, render_pass.context, render_pass.env)
+    for index, (relative_path, entry, additional_context) in enumerate(outputs):
+        if last_indexes[relative_path] != index:
+            # another output of the same path comes later and wins
+            continue
+        if entry.is_template:
+            # the archive can not seek back to patch the header, and the size of a template output is only known
+            # once it is rendered, so its entry is always zip64
+            with fragment_memo(render_pass.fragment_memo), \
+                    archive.open(prefix + relative_path, 'w', force_zip64=True) as f:
+                for chunk in __generate_template(render_pass, entry, additional_context):
+                    f.write(chunk.encode('utf-8'))
+                    # most chunks stay in the compressor, nothing to send for those
+                    data = stream.drain()
+                    if data:
+                        yield data
+        else: # copy the file as is
+            source_path = os.path.join(render_pass.template_folder, 'project', entry.path)
+            force_zip64 = entry.size > zipfile.ZIP64_LIMIT
+            with open(source_path, 'rb') as source, archive.open(prefix + relative_path, 'w', force_zip64=force_zip64) as f:
+                for chunk in iter(lambda: source.read(RENDER_STREAM_CHUNK_SIZE), b''):
+                    f.write(chunk)
+                    data = stream.drain()
+                    if data:
+                        yield data
+        # the rest of the entry, written when it is closed
+        data = stream.drain()
+        if data:
+            yield data
+
+def render_zip_stream(template_folder, context):
+    """
+    Render the template folder with the context into a ZIP archive, without writing anything to disk.
+    Yields the bytes of the archive while the files are rendered: each output is compressed as soon as it is
+    rendered and static files are read in chunks of RENDER_STREAM_CHUNK_SIZE bytes.
+    """
+    fingerprint = current_fingerprint(template_folder)
+    env = get_jinja_env(template_folder, fingerprint)
+    manifest = get_manifest(template_folder, fingerprint)
+
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        render_pass = RenderPass(template_folder, context, env, fingerprint)
+        yield from __write_zip_outputs(archive, stream, render_pass, manifest)
+    yield stream.drain()
+
+def render_batch_zip_stream(template_folder, contexts):
+    """
+    Render the template folder once per context into a single ZIP archive, like render_zip_stream,
+    with the output of the n-th context (counting from 0) in the folder '<n>/', e.g. '0000/'.
+    The environment and the manifest are looked up once for the whole batch.
+    A context failing to render is reported in '<n>.error.txt' and does not stop the others.
+    """
+    fingerprint = current_fingerprint(template_folder)
+    env = get_jinja_env(template_folder, fingerprint)
+    manifest = get_manifest(template_folder, fingerprint)
+
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for index, context in enumerate(contexts):
+            item_name = f"{index:04d}"
+            try:
+                render_pass = RenderPass(template_folder, context, env, fingerprint)
+                yield from __write_zip_outputs(archive, stream, render_pass, manifest, item_name + '/')
+            except Exception as e:
+                archive.writestr(item_name + '.error.txt', f"Failed to render item {index}: {e}\n")
+                yield stream.drain()
+    yield stream.drain()
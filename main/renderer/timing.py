@@ -0,0 +1,106 @@
+import contextlib
+import contextvars
+import threading
+import time
+
+# timings collecting the per template / wildcard / fragment breakdown of the render in progress, see detail_timings
+__detail_timings = contextvars.ContextVar('detail_timings', default=None)
+
+
+class RenderTimings:
+    """
+    Durations, counts and bytes of the phases of a render, cheap enough to be always collected.
+    Wall phases (e.g. 'resolve', 'outputs') are timed once per render; per file phases ('render' for templates,
+    'copy' for static files) add up the time of every file, which exceeds the wall time on a pool.
+    """
+    def __init__(self):
+        self.phases = {}  # name -> [count, seconds, bytes]
+        # category ('templates', 'wildcards', 'fragments') -> name -> [count, seconds], only inside detail_timings
+        self.details = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds, count=1, size=0):
+        with self._lock:
+            phase = self.phases.get(name)
+            if phase is None:
+                self.phases[name] = [count, seconds, size]
+            else:
+                phase[0] += count
+                phase[1] += seconds
+                phase[2] += size
+
+    def add_detail(self, category, name, seconds, count=1):
+        with self._lock:
+            detail = self.details.setdefault(category, {}).get(name)
+            if detail is None:
+                self.details[category][name] = [count, seconds]
+            else:
+                detail[0] += count
+                detail[1] += seconds
+
+    def merge(self, phases):
+        """
+        Add the phases of another RenderTimings, e.g. collected in a worker process.
+        """
+        for name, (count, seconds, size) in phases.items():
+            self.add(name, seconds, count, size)
+
+    @contextlib.contextmanager
+    def phase(self, name, count=1):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, count)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {name: {"count": count, "ms": round(seconds * 1000, 3), "bytes": size}
+                    for name, (count, seconds, size) in self.phases.items()}
+
+    def details_to_dict(self) -> dict:
+        """
+        Breakdown of every category, the slowest names first. Durations include the nested work,
+        e.g. a template includes the fragments it renders.
+        """
+        with self._lock:
+            return {
+                category: [{"name": name, "count": count, "ms": round(seconds * 1000, 3)}
+                           for name, (count, seconds) in sorted(names.items(), key=lambda item: -item[1][1])]
+                for category, names in self.details.items()
+            }
+
+    def server_timing(self) -> str:
+        """
+        Value of a Server-Timing header, one metric per phase with its duration in milliseconds.
+        """
+        with self._lock:
+            return ', '.join(f'{name};dur={seconds * 1000:.2f}' + self._description(count, size)
+                             for name, (count, seconds, size) in self.phases.items())
+
+    @staticmethod
+    def _description(count, size):
+        if size:
+            return f';desc="{count} x, {size} B"'
+        if count != 1:
+            return f';desc="{count} x"'
+        return ''
+
+
+@contextlib.contextmanager
+def detail_timings(timings):
+    """
+    Collect into timings.details the duration of every template, wildcard and fragment evaluated inside the block,
+    on this thread only. Outside of it the renderer does not time them.
+    """
+    token = __detail_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        __detail_timings.reset(token)
+
+def current_detail_timings():
+    """
+    The RenderTimings set by detail_timings, None when the breakdown is not collected.
+    """
+    return __detail_timings.get()
@@ -1,10 +1,61 @@
-import random
+import ast
+import functools
+import operator
 import re
-import string
-from typing import List, Tuple, Dict, Any, Callable
+import time
+from collections.abc import Mapping
+from typing import List, Tuple, Dict, Any, NamedTuple, Optional, Union, Iterator
 
 from jinja2 import Environment
 
+from .context import LayeredContext
+from .metrics import RESOLVE_FANOUT
+from .timing import current_detail_timings
+
+__UNSAFE_PATH_CHARS = re.compile(r'[^a-zA-Z0-9/._-]')
+__CALL = re.compile(r'^\s*([A-Za-z_]\w*)\s*\((.*)\)\s*$', re.DOTALL)
+__MISSING = object()
+# operators of the expressions evaluated by __evaluate_node
+__UNARY_OPERATORS = {ast.USub: operator.neg, ast.UAdd: operator.pos, ast.Not: operator.not_}
+__BINARY_OPERATORS = {
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv, ast.Mod: operator.mod,
+    ast.Eq: operator.eq, ast.NotEq: operator.ne, ast.Lt: operator.lt, ast.LtE: operator.le,
+    ast.Gt: operator.gt, ast.GtE: operator.ge, ast.In: lambda a, b: a in b, ast.NotIn: lambda a, b: a not in b,
+}
+
+
+class Argument(NamedTuple):
+    """
+    Expression inside a wildcard, e.g. 'param1' or 10 in truncate(10), or the root models[0] of models[0].name.
+    Parsed once into a Python expression tree (node), evaluated without eval: see __evaluate_node for what it supports.
+    node is None when the text is not a Python expression, e.g. truncate(a b), and is used as a bare string.
+    """
+    text: str
+    node: Optional[ast.expr]
+
+
+class Call(NamedTuple):
+    """
+    Call of a filter or global inside a wildcard, e.g. truncate(10) or get_non_hidden_models().
+    """
+    text: str
+    name: str
+    args: Tuple[Argument, ...]
+
+
+class WildcardExpression(NamedTuple):
+    """
+    Parsed '%...%' wildcard, e.g. models.name$uppercase$truncate(10):
+    the first dotted part is the root (a name, a call or a literal), every next part is looked up in dicts
+    and applied to each item of a list (fan-out), then the resolved value is piped through the filters.
+    """
+    text: str
+    parts: Tuple[str, ...]
+    root: Union[Call, Argument]
+    filters: Tuple[Call, ...]
+
+
 def __deep_merge(dict1, dict2):
     """
     Deep merge two dictionaries.
@@ -19,199 +70,282 @@ def __deep_merge(dict1, dict2):
             result[key] = value
     return result
 
-def __create_evaluation_context(context: dict, env: Environment) -> Dict[str, Any]:
+def __compile_argument(text: str) -> Argument:
+    text = text.strip()
+    try:
+        return Argument(text, ast.parse(text, mode='eval').body)
+    except SyntaxError:
+        return Argument(text, None)
+
+def __compile_call(text: str) -> Call:
+    text = text.strip()
+    match = __CALL.match(text)
+    if not match:
+        # a name without arguments; anything else fails with 'not found' when evaluated
+        return Call(text, text, ())
+    name, args_str = match.groups()
+    args = tuple(__compile_argument(arg) for arg in args_str.split(',') if arg.strip())
+    return Call(text, name, args)
+
+def compile_wildcard(wildcard: str) -> WildcardExpression:
     """
-    Create a context suitable for evaluating wildcards.
-    This includes callable items from the context and Jinja2 filters and tests.
+    Parse the text between two '%' into a WildcardExpression.
+    :param wildcard: Wildcard text, e.g. "models.name$truncate(10)"
     """
-    eval_context = context.copy()
-    # add jinja2 filters
-    for filter_name, filter_func in env.filters.items():
-        eval_context[filter_name] = filter_func
-    # add jinja2 globals
-    for global_name, global_value in env.globals.items():
-        eval_context[global_name] = global_value
-    return eval_context.copy()
+    base_part, *filter_specs = wildcard.split('$')
+    parts = tuple(base_part.strip().split('.'))
+    root_part = parts[0]
+    if __CALL.match(root_part):
+        root = __compile_call(root_part)
+    else:
+        root = __compile_argument(root_part)
+    filters = tuple(__compile_call(filter_spec) for filter_spec in filter_specs)
+    return WildcardExpression(wildcard, parts, root, filters)
 
-def __extract_filters(wildcard: str, env: Environment,
-    checker: Callable[[str, Environment], bool] = lambda x, env: x in env.filters) -> Tuple[str, List[Tuple[Callable, List[str]]]]:
+@functools.lru_cache(maxsize=4096)
+def compile_path(path: str) -> Tuple[Union[str, WildcardExpression], ...]:
     """
-    Extract filter functions and their raw argument strings.
-    :param checker: Function to check if a filter exists in the environment. Can be replaced with checking globals as well.
-    :returns: tuple(base, List of tuples (filter_function, [raw_args]))
+    Split a path into literal text and compiled wildcards. Compiled paths are cached per path string.
+    :example:
+    "models/%models.name$uppercase%.txt.j2" -> ("models/", WildcardExpression(...), ".txt.j2")
     """
-    if '$' not in wildcard:
-        return wildcard.strip(), []
+    segments = []
+    rest = path
+    while rest.count('%') >= 2:
+        start_index = rest.find('%')
+        end_index = rest.find('%', start_index + 1)
+        if start_index > 0:
+            segments.append(rest[:start_index])
+        segments.append(compile_wildcard(rest[start_index + 1:end_index]))
+        rest = rest[end_index + 1:]
+    if rest:
+        segments.append(rest)
+    return tuple(segments)
 
-    base_part, *filter_specs = wildcard.split('$')
-    base_part = base_part.strip()
-
-    filters = []
-    for filter_spec in filter_specs:
-        filter_spec = filter_spec.strip()
-
-        # Filter without arguments
-        if checker(filter_spec, env):
-            filters.append((env.filters[filter_spec] if filter_spec in env.filters else env.globals[filter_spec], []))
-        # Filter with arguments
-        elif '(' in filter_spec and filter_spec.endswith(')'):
-            fname, fargs = filter_spec.split('(', 1)
-            fname = fname.strip()
-            if not checker(fname, env):
-                raise Exception(f"Filter '{filter_spec}' not found in Jinja2 environment.")
-
-            # Extract raw arguments (still as strings)
-            args_str = fargs[:-1]  # remove closing parenthesis
-            raw_args = [arg.strip() for arg in args_str.split(',') if arg.strip()]
-            filters.append((env.filters[fname] if fname in env.filters else env.globals[fname], raw_args))
-        else:
-            raise Exception(f"Filter '{filter_spec}' not found in Jinja2 environment.")
+def __lookup_name(name: str, context: dict, env: Environment) -> Any:
+    """
+    Look a name up the way wildcards see it: Jinja2 globals first, then filters, then the context.
+    """
+    if name in env.globals:
+        return env.globals[name]
+    if name in env.filters:
+        return env.filters[name]
+    return context.get(name, __MISSING)
 
-    return base_part, filters
+def __invoke(func, args: List[Any], context: Mapping, env: Environment) -> Any:
+    """
+    Call a filter or global, passing the context or the environment first when it is annotated for it.
+    """
+    pass_arg = getattr(getattr(func, 'jinja_pass_arg', None), 'name', None)
+    if pass_arg == 'context':
+        return func(context, *args)
+    if pass_arg == 'environment':
+        return func(env, *args)
+    return func(*args)
 
-def __evaluate_filter_args(raw_args: List[str], filter_name: str, eval_context: dict) -> List[Any]:
+def __evaluate_node(node: ast.expr, context: Mapping, env: Environment) -> Any:
     """
-    Evaluate raw argument strings to actual values.
-    :param raw_args: List of raw argument strings
-    :param filter_name: Name of the filter (for error messages)
-    :param eval_context: Evaluation context
-    :returns: List of evaluated arguments
+    Evaluate the expression tree of an Argument like eval would, for the subset of Python wildcards use:
+    literals, names, item and attribute access, arithmetic, comparisons and calls of filters or globals.
+    Anything else raises, as do attributes starting with '_'.
     """
-    evaluated_args = []
-    for arg in raw_args:
+    if isinstance(node, ast.Constant):
+        return node.value
+    if isinstance(node, ast.Name):
+        value = __lookup_name(node.id, context, env)
+        if value is __MISSING:
+            raise NameError(f"name '{node.id}' is not defined")
+        return value
+    if isinstance(node, ast.Subscript):
+        return __evaluate_node(node.value, context, env)[__evaluate_node(node.slice, context, env)]
+    if isinstance(node, ast.Attribute):
+        if node.attr.startswith('_'):
+            raise AttributeError(f"'{node.attr}' can not be used in a wildcard")
+        return getattr(__evaluate_node(node.value, context, env), node.attr)
+    if isinstance(node, (ast.List, ast.Tuple)):
+        values = [__evaluate_node(item, context, env) for item in node.elts]
+        return values if isinstance(node, ast.List) else tuple(values)
+    if isinstance(node, ast.Dict) and None not in node.keys:
+        return {__evaluate_node(key, context, env): __evaluate_node(value, context, env)
+                for key, value in zip(node.keys, node.values)}
+    if isinstance(node, ast.UnaryOp) and type(node.op) in __UNARY_OPERATORS:
+        return __UNARY_OPERATORS[type(node.op)](__evaluate_node(node.operand, context, env))
+    if isinstance(node, ast.BinOp) and type(node.op) in __BINARY_OPERATORS:
+        return __BINARY_OPERATORS[type(node.op)](__evaluate_node(node.left, context, env),
+                                                 __evaluate_node(node.right, context, env))
+    if isinstance(node, ast.BoolOp):
+        value = None
+        for operand in node.values:
+            value = __evaluate_node(operand, context, env)
+            if bool(value) == isinstance(node.op, ast.Or):
+                break
+        return value
+    if isinstance(node, ast.Compare) and all(type(op) in __BINARY_OPERATORS for op in node.ops):
+        left = __evaluate_node(node.left, context, env)
+        for op, comparator in zip(node.ops, node.comparators):
+            right = __evaluate_node(comparator, context, env)
+            if not __BINARY_OPERATORS[type(op)](left, right):
+                return False
+            left = right
+        return True
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and not node.keywords \
+            and not any(isinstance(arg, ast.Starred) for arg in node.args):
+        func = __lookup_name(node.func.id, context, env)
+        if not callable(func):
+            raise NameError(f"'{node.func.id}' is not a filter or global function")
+        return __invoke(func, [__evaluate_node(arg, context, env) for arg in node.args], context, env)
+    raise ValueError(f"unsupported expression '{ast.unparse(node)}'")
+
+def __evaluate_argument(argument: Argument, context: Mapping, env: Environment) -> Any:
+    if argument.node is None:
+        return argument.text
+    try:
+        return __evaluate_node(argument.node, context, env)
+    except Exception:
+        # used as a string when it can not be evaluated, e.g. context_aware_filter(param1)
+        return argument.text
+
+def __evaluate_root(expression: WildcardExpression, context: Mapping, env: Environment) -> Any:
+    root = expression.root
+    if isinstance(root, Call):
+        func = env.globals.get(root.name, env.filters.get(root.name))
+        if func is None or not callable(func):
+            raise Exception(f"Error evaluating part '{root.text}' of wildcard '{expression.text}': "
+                            f"'{root.name}' is not a filter or global function")
+        args = [__evaluate_argument(arg, context, env) for arg in root.args]
+        return __invoke(func, args, context, env)
+    if root.node is None:
+        raise Exception(f"Error evaluating part '{root.text}' of wildcard '{expression.text}': invalid expression")
+    try:
+        value = __evaluate_node(root.node, context, env)
+    except Exception as e:
+        raise Exception(f"Error evaluating part '{root.text}' of wildcard '{expression.text}': {e}")
+    if value is None:
+        raise Exception(f"Error evaluating part '{root.text}' of wildcard '{expression.text}': name not found")
+    return value
+
+def __lookup_part(value: Mapping, part: str, expression: WildcardExpression) -> Any:
+    if part in value:
+        return value[part]
+    try:
+        key = ast.literal_eval(part)
+        return value[key]
+    except Exception as e:
+        raise Exception(f"Error evaluating part '{part}' of wildcard '{expression.text}': {e!r}")
+
+def __iter_parts(value: Any, expression: WildcardExpression, index: int) -> Iterator[Tuple[str, Any]]:
+    """
+    Apply the dotted parts from index on to the value, fanning out over lists.
+    Yields tuples (resolved_text, additional_context nested under the previous part)
+    """
+    if isinstance(value, list):
+        for item in value:
+            yield from __iter_parts(item, expression, index)
+        return
+    if index == len(expression.parts):
+        if isinstance(value, Mapping):
+            raise Exception(f"Error evaluating wildcard '{expression.text}': resolved to an object, not a value")
+        text = str(value)
+        yield text, text
+        return
+    part = expression.parts[index]
+    if not isinstance(value, Mapping):
+        raise Exception(f"Error evaluating part '{part}': {value}")
+    for text, additional_context in __iter_parts(__lookup_part(value, part, expression), expression, index + 1):
+        yield text, {part: additional_context}
+
+def __apply_filters(expression: WildcardExpression, value: str, context: dict, env: Environment) -> str:
+    for call in expression.filters:
+        filter_func = env.filters.get(call.name)
+        if filter_func is None:
+            raise Exception(f"Filter '{call.text}' not found in Jinja2 environment.")
+        if not callable(filter_func):
+            raise Exception(f"Filter '{filter_func}' is not callable.")
+        args = [__evaluate_argument(arg, context, env) for arg in call.args]
         try:
-            evaluated_arg = eval(arg, {}, eval_context)
-            evaluated_args.append(evaluated_arg)
+            value = __invoke(filter_func, [value] + args, context, env)
         except Exception as e:
-            # Try treating the argument as a string literal
-            try:
-                evaluated_arg = eval(f"'{arg}'", {}, eval_context)
-                evaluated_args.append(evaluated_arg)
-            except Exception as e2:
-                raise Exception(f"Error evaluating argument '{arg}' for filter '{filter_name}': {e}; {e2}")
-    return evaluated_args
-
-def __evaluate_expression(expression: str, eval_context: dict, env: Environment) -> Any:
-    # try to evaluate as a filter
-    _, values = __extract_filters("IGNORED_BASE$" + expression, env, lambda x, env: x in env.filters or x in env.globals)
-    fname, fargs = values[0]
-    fargs = __evaluate_filter_args(fargs, fname.__name__, eval_context)
-    if getattr(fname, 'jinja_pass_arg', None) is not None:
-        pass_arg = getattr(fname, 'jinja_pass_arg')
-        if getattr(pass_arg, 'name', None) == 'context':
-            fargs = [eval_context] + fargs
-        elif getattr(pass_arg, 'name', None) == 'environment':
-            fargs = [env] + fargs
-    return fname(*fargs)
-
-def __process_wildcard(wildcard: str, eval_context: dict, env: Environment, previous_resolved_value = None) -> List[Tuple[str, Dict[str, Any]]]:
-    """
-    Process a wildcard and return the resolved string and additional context.
-    Returns a list of tuples (resolved_path, additional_context)
+            raise Exception(f"Error applying filter '{call.name}' with args {args} on value '{value}': {e}")
+        value = __UNSAFE_PATH_CHARS.sub('', str(value).replace('\\', '/'))
+    return value
+
+def iter_wildcard(expression: WildcardExpression, context: Mapping, env: Environment) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    Evaluate a compiled wildcard, without its filters, against the context.
+    Yields tuples (resolved_text, additional_context), one list item at a time.
     :example:
-    wildcard = "models.user.fields"
-    This will evaluate models from the context, then user from models, then fields from user.
+    "models.name" with {"models": [{"name": "user"}]} -> ("user", {"models": {"name": "user"}})
     """
-    parts = wildcard.split('.')
-    part = parts[0]
-    rest = '.'.join(parts[1:])
+    root_value = __evaluate_root(expression, context, env)
+    for text, additional_context in __iter_parts(root_value, expression, 1):
+        yield text, {expression.parts[0]: additional_context}
 
-    # eval this part
-    resolved_part = None
-    exception = None
-    try: resolved_part = eval(part, {}, eval_context)
-    except Exception as e:
-        # try to evaluate as filter / global functio
-        try: resolved_part = __evaluate_expression(part, eval_context, env)
-        except Exception: pass
-
-    resolved_value = previous_resolved_value
-    if resolved_value is None:
-        if resolved_part is not None:
-            resolved_value = resolved_part
-        else:
-            print(f"Error evaluating part '{part}' of wildcard '{wildcard}': {exception}")
-            raise exception
-    elif isinstance(resolved_value, dict):
-        if part in resolved_value:
-            resolved_value = resolved_value[part]
-        elif resolved_part is not None and isinstance(resolved_part, str) and resolved_part in resolved_value:
-            resolved_value = resolved_value[part]
-        else:
-            RESOLVED_VALUE = resolved_value
-            random_suffix = ''.join(random.choices(string.ascii_uppercase + string.digits, k=10))
-            try: resolved_value = eval(f"RESOLVED_VALUE_{random_suffix}[{part}]", {f'RESOLVED_VALUE_{random_suffix}': RESOLVED_VALUE})
-            except Exception as e:
-                print(f"Error evaluating part '{part}' of wildcard '{wildcard}': {e}")
-                raise e
-    elif isinstance(resolved_value, list):
-        new_resolved_values = []
-        for item in resolved_value:
-            new_resolved_values += __process_wildcard(wildcard, eval_context, env, item)
-        resolved_value = new_resolved_values
-    else:
-        raise Exception(f"Error evaluating part '{part}': {resolved_value}")
-
-    if len(parts) > 1:
-        resolved_rest = __process_wildcard(rest, eval_context, env, resolved_value)
-        # need to enhance. add {part}.{item.resolved_path} to the resolved_path
-        # and same for the keys in the additional context
-        return [
-            # (item[0], {f"{part}.{k}": v for k, v in item[1].items()})
-            (item[0], {part: item[1]})
-            for item in resolved_rest
-        ]
-    if not isinstance(resolved_value, dict) and not isinstance(resolved_value, list):
-        return [(str(resolved_value), {wildcard: str(resolved_value)})]
-    elif isinstance(resolved_value, list):
-        return resolved_value
-    raise Exception(f"Error evaluating part '{part}': {resolved_value}. Unknown resolved_value type.")
-
-
-def resolve_path(path: str, context: dict, env: Environment) -> List[Tuple[str, Dict[str, Any]]]:
+def evaluate_wildcard(expression: WildcardExpression, context: Mapping, env: Environment) -> List[Tuple[str, Dict[str, Any]]]:
+    """
+    iter_wildcard, as a list.
+    """
+    return list(iter_wildcard(expression, context, env))
+
+def __timed_values(values, timings, expression: WildcardExpression):
+    # the evaluation of a wildcard is spread over its values: the time of each one adds up to a single evaluation
+    count = 1
+    while True:
+        start = time.perf_counter()
+        try:
+            value = next(values)
+        except StopIteration:
+            timings.add_detail('wildcards', expression.text, time.perf_counter() - start, count=count)
+            return
+        timings.add_detail('wildcards', expression.text, time.perf_counter() - start, count=count)
+        count = 0
+        yield value
+
+def __iter_segments(segments, index: int, prefix: str, context: Mapping, env: Environment) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    while index < len(segments) and isinstance(segments[index], str):
+        prefix += segments[index]
+        index += 1
+    if index == len(segments):
+        yield prefix, {}
+        return
+    expression = segments[index]
+    timings = current_detail_timings()
+    values = iter_wildcard(expression, context, env)
+    if timings is not None:
+        values = __timed_values(values, timings, expression)
+    for resolved_text, additional_context in values:
+        # the context seen by the filters and the next wildcards, sharing the base context instead of copying it
+        final_additional_context = LayeredContext(context, additional_context)
+        if expression.filters:
+            start = time.perf_counter() if timings is not None else 0
+            resolved_text = __apply_filters(expression, resolved_text, final_additional_context, env)
+            if timings is not None:
+                # the filters of every value count in the time of the wildcard, not in its evaluations
+                timings.add_detail('wildcards', expression.text, time.perf_counter() - start, count=0)
+            additional_context[expression.text] = resolved_text
+        # values resolved by the next wildcards see this one in their context;
+        # the values of this wildcard take precedence in the merged additional context
+        for resolved_path, path_context in __iter_segments(segments, index + 1, prefix + resolved_text, final_additional_context, env):
+            yield resolved_path, __deep_merge(path_context, additional_context)
+
+def iter_resolved_paths(path: str, context: Mapping, env: Environment) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    Resolve a path with possible wildcards using the context, lazily: nested wildcards are expanded one value at a
+    time, so only the pair being consumed is held in memory however large the fan-out is.
+    Yields tuples (resolved_path, additional_context); an invalid wildcard raises once the pairs before it are yielded.
+    """
+    segments = compile_path(path)
+    if all(isinstance(segment, str) for segment in segments):
+        yield path, {}
+        return
+    fanout = 0
+    for resolved in __iter_segments(segments, 0, '', context, env):
+        fanout += 1
+        yield resolved
+    RESOLVE_FANOUT.observe(fanout)
+
+def resolve_path(path: str, context: Mapping, env: Environment) -> List[Tuple[str, Dict[str, Any]]]:
     """
     Resolve a path with possible wildcards using the context.
-    Returns a list of tuples (resolved_path, additional_context)
-    """
-    if path.count('%') < 2:
-        return [(path, {})]
-    evaluation_context = __create_evaluation_context(context, env)
-    start_index = path.find('%')
-    end_index = path.find('%', start_index + 1)
-    wildcard = path[start_index + 1:end_index]
-    value, filters = __extract_filters(wildcard, env)
-    resolved_paths = __process_wildcard(value, evaluation_context, env)
-    rez = []
-    for resolved_path, additional_context in resolved_paths:
-        final_additional_context = __deep_merge(context, additional_context)
-        for filter_func, raw_args in filters:
-            eval_args = __evaluate_filter_args(raw_args, filter_func.__name__, __create_evaluation_context(final_additional_context, env))
-            has_special_arg = False
-            # if function is annotated with pass_context, add the context as first argument
-            if getattr(filter_func, 'jinja_pass_arg', None) is not None:
-                # what to pass: context or environment?
-                pass_arg = getattr(filter_func, 'jinja_pass_arg')
-                if getattr(pass_arg, 'name', None) == 'context':
-                    eval_args = [final_additional_context] + eval_args
-                    has_special_arg = True
-                elif getattr(pass_arg, 'name', None) == 'environment':
-                    eval_args = [env] + eval_args
-                    has_special_arg = True
-            if not callable(filter_func):
-                raise Exception(f"Filter '{filter_func}' is not callable.")
-            try:
-                resolved_path = filter_func(eval_args[0], resolved_path, *eval_args[1:]) if has_special_arg \
-                    else filter_func(resolved_path, *eval_args)
-            except Exception as e:
-                raise Exception(f"Error applying filter '{filter_func.__name__}' with args {eval_args} on value '{resolved_path}': {e}")
-            # update the context with the new resolved_path
-            resolved_path = re.sub(r'[^a-zA-Z0-9/._-]', '', str(resolved_path).replace('\\', '/'))
-            additional_context[wildcard] = resolved_path
-            final_additional_context[wildcard] = resolved_path
-
-        new_path = path[:start_index] + resolved_path + path[end_index + 1:]
-        start_rez_index = len(rez)
-        rez += resolve_path(new_path, final_additional_context, env)
-        for i in range(start_rez_index, len(rez)):
-            rez[i][1].update(__deep_merge(rez[i][1], additional_context))
-    return rez
+    Returns a list of tuples (resolved_path, additional_context), see iter_resolved_paths
+    """
+    return list(iter_resolved_paths(path, context, env))
@@ -0,0 +1,212 @@
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # not on Windows
+    fcntl = None
+
+from jinjaGenerator.settings import BASE_DIR, RENDER_WORKSPACE_RETENTION, RENDER_WORKSPACE_MAX_BYTES
+
+__logger = logging.getLogger(__name__)
+# one folder per render, toutput/.workspaces/<template name>-<id>
+WORKSPACES_DIR = os.path.join(BASE_DIR, 'toutput', '.workspaces')
+
+# lock files of the workspaces of this process still being written: workspace -> open lock file
+__held = {}
+# without fcntl, locks of the output folders of this process: lock path -> threading.Lock
+__folder_locks = {}
+__lock = threading.Lock()
+# held while collect_workspaces runs on the background thread, see start_workspace_collection
+__collecting = threading.Lock()
+
+
+def __lock_path(output_folder):
+    # next to the output folder, which renders delete and create again
+    parent, name = os.path.split(os.path.normpath(output_folder))
+    return os.path.join(parent, f".{name}.lock")
+
+def __acquire(output_folder, blocking=True):
+    """
+    Open and lock the lock file of an output folder, exclusively across threads and processes.
+    Returns the open lock file, closing it releases the lock; None when blocking is False and the lock is held.
+    Without fcntl the file is only opened, see lock_output_folder and collect_workspaces.
+    """
+    lock_path = __lock_path(output_folder)
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    lock_file = open(lock_path, 'a')
+    if fcntl is not None:
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            lock_file.close()
+            return None
+    return lock_file
+
+@contextmanager
+def lock_output_folder(output_folder):
+    """
+    Hold the lock of an output folder while rendering into it: renders of the same folder in other threads or
+    processes wait for it, instead of deleting or overwriting each other's files.
+    Without fcntl, e.g. on Windows, only renders of the same process wait for each other.
+    """
+    if fcntl is None:
+        with __lock:
+            folder_lock = __folder_locks.setdefault(__lock_path(output_folder), threading.Lock())
+        with folder_lock:
+            yield output_folder
+        return
+    lock_file = __acquire(output_folder)
+    try:
+        yield output_folder
+    finally:
+        lock_file.close()
+
+def create_workspace(template_name) -> str:
+    """
+    Create an empty output folder for one render, so concurrent renders of the same template do not share it.
+    It stays active, and is not collected by any process, until release_workspace is called or this process exits.
+    """
+    workspace = os.path.join(WORKSPACES_DIR, f"{template_name}-{uuid.uuid4().hex}")
+    # locked before the folder exists, so collect_workspaces never sees it unlocked
+    lock_file = __acquire(workspace)
+    with __lock:
+        __held[workspace] = lock_file
+    try:
+        os.makedirs(workspace)
+    except BaseException:
+        release_workspace(workspace)
+        raise
+    return workspace
+
+def release_workspace(workspace):
+    """
+    Mark the render of a workspace as finished: its output is kept until collect_workspaces removes it.
+    """
+    if os.path.isdir(workspace):
+        # the age of a workspace counts from the end of its render
+        os.utime(workspace)
+    with __lock:
+        lock_file = __held.pop(workspace, None)
+    if lock_file is not None:
+        lock_file.close()
+        if fcntl is None:
+            # the lock file itself marks the workspace as active, see __is_active
+            os.remove(lock_file.name)
+
+def remove_workspace(workspace):
+    """
+    Release the workspace and delete it now with its lock file, instead of waiting for collect_workspaces.
+    """
+    release_workspace(workspace)
+    __remove_workspace(workspace)
+
+def __folder_size(folder):
+    size = 0
+    for root, _, files in os.walk(folder):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except FileNotFoundError:
+                pass
+    return size
+
+def __remove_workspace(path):
+    shutil.rmtree(path, ignore_errors=True)
+    try:
+        os.remove(__lock_path(path))
+    except FileNotFoundError:
+        pass
+
+def __is_active(path, held):
+    """
+    Whether a render of this or another process still writes into the workspace, i.e. holds its lock.
+    """
+    if path in held:
+        return True
+    if fcntl is None:
+        # the lock of other processes can not be checked, their workspaces are active as long as the lock file exists
+        return os.path.exists(__lock_path(path))
+    lock_file = __acquire(path, blocking=False)
+    if lock_file is None:
+        return True
+    lock_file.close()
+    return False
+
+def __remove_orphan_lock(entry, expired_before):
+    # lock file of a workspace that was never created, e.g. its process crashed right after locking it
+    try:
+        if entry.stat().st_mtime < expired_before \
+                and not os.path.exists(os.path.join(WORKSPACES_DIR, entry.name[1:-len('.lock')])):
+            os.remove(entry.path)
+    except FileNotFoundError:
+        # removed with its workspace meanwhile
+        pass
+
+def collect_workspaces():
+    """
+    Delete the finished workspaces older than RENDER_WORKSPACE_RETENTION seconds, then the oldest finished ones
+    until all the workspaces together take at most RENDER_WORKSPACE_MAX_BYTES.
+    Active workspaces, of any process, are never deleted, even when they alone exceed the budget.
+    Walks every workspace: call it through start_workspace_collection from requests.
+    :returns: number of deleted workspaces
+    """
+    if not os.path.isdir(WORKSPACES_DIR):
+        return 0
+    with __lock:
+        held = set(__held)
+    expired_before = time.time() - RENDER_WORKSPACE_RETENTION
+    finished = []  # (finished at, path, size)
+    total_size = 0
+    deleted = 0
+    with os.scandir(WORKSPACES_DIR) as entries:
+        for entry in entries:
+            if not entry.is_dir(follow_symlinks=False):
+                if entry.name.startswith('.') and entry.name.endswith('.lock'):
+                    __remove_orphan_lock(entry, expired_before)
+                continue
+            size = __folder_size(entry.path)
+            if __is_active(entry.path, held):
+                total_size += size
+                continue
+            finished_at = entry.stat().st_mtime
+            if finished_at < expired_before:
+                __remove_workspace(entry.path)
+                deleted += 1
+                continue
+            finished.append((finished_at, entry.path, size))
+            total_size += size
+    for _, path, size in sorted(finished):
+        if total_size <= RENDER_WORKSPACE_MAX_BYTES:
+            break
+        __remove_workspace(path)
+        total_size -= size
+        deleted += 1
+    return deleted
+
+def start_workspace_collection():
+    """
+    Run collect_workspaces on a background thread, so requests do not wait for it to walk the workspaces.
+    Does nothing while the previous collection is still running.
+    :returns: the thread, None when a collection is already running
+    """
+    if not __collecting.acquire(blocking=False):
+        return None
+
+    def run():
+        try:
+            deleted = collect_workspaces()
+            if deleted:
+                __logger.info("Deleted %d workspaces", deleted)
+        except Exception as e:
+            __logger.warning("Can not collect the workspaces: %s", e)
+        finally:
+            __collecting.release()
+    thread = threading.Thread(target=run, name='workspace-collection', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,27 @@
+class ZipStream:
+    """
+    Write-only, unseekable file object for zipfile.ZipFile: collects the bytes written to the archive
+    so they can be sent as soon as they are produced, instead of building the archive in memory or on disk.
+    """
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        """
+        Return and forget everything written since the previous call.
+        """
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
@@ -0,0 +1,195 @@
+"""
+In-memory registry of the templates, so renders look their template up without querying the database,
+and warm-up of their environments so the first render after a deploy or an upload does not build them.
+"""
+import logging
+import threading
+import time
+from typing import NamedTuple, Optional
+
+from asgiref.sync import sync_to_async
+from django.db import DatabaseError, connections
+
+from jinjaGenerator.settings import TEMPLATE_REGISTRY_TTL, TEMPLATE_WARM_UP
+from .models import Template as TemplateModel
+from .renderer.renderer import warm_up_template
+
+__logger = logging.getLogger(__name__)
+
+
+class RegisteredTemplate(NamedTuple):
+    id: int
+    name: str
+    folder: str
+    version: str
+
+
+class TemplateRegistry:
+    """
+    Templates by name and by id, loaded from the database at once and reloaded every TEMPLATE_REGISTRY_TTL seconds
+    on a background thread, the loaded templates are served meanwhile.
+    A template missing from it is still looked up in the database, e.g. when uploaded through another process.
+    """
+    def __init__(self, ttl=TEMPLATE_REGISTRY_TTL):
+        self.ttl = ttl
+        self._by_name = {}
+        self._by_id = {}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+        # held while the registry is reloaded in the background, see _refresh
+        self._refreshing = threading.Lock()
+
+    def load(self):
+        by_name = {}
+        by_id = {}
+        # names are unique, see migration 0004
+        for model in TemplateModel.objects.only('id', 'name', 'folder', 'version'):
+            template = self._from_model(model)
+            by_id[template.id] = template
+            by_name[template.name] = template
+        with self._lock:
+            self._by_name, self._by_id = by_name, by_id
+            self._loaded_at = time.monotonic()
+
+    def _expired(self):
+        if self._loaded_at is None:
+            return True
+        return self.ttl is not None and time.monotonic() - self._loaded_at >= self.ttl
+
+    def _refresh(self):
+        """
+        Reload the registry on a background thread, unless it is already being reloaded.
+        """
+        if not self._refreshing.acquire(blocking=False):
+            return
+
+        def run():
+            try:
+                self.load()
+            except DatabaseError as e:
+                # the module logger name would be mangled here
+                logging.getLogger(__name__).warning("Can not reload the template registry: %s", e)
+            finally:
+                # database connections are per thread, and this one is done with its own
+                connections.close_all()
+                self._refreshing.release()
+        threading.Thread(target=run, name='template-registry-refresh', daemon=True).start()
+
+    def _ensure_loaded(self):
+        # only the first load makes the caller wait for the database
+        if self._loaded_at is None:
+            self.load()
+        elif self._expired():
+            self._refresh()
+
+    def clear(self):
+        """
+        Forget the loaded templates, once a reload in progress is done: the next lookup loads them again.
+        """
+        with self._refreshing, self._lock:
+            self._by_name, self._by_id = {}, {}
+            self._loaded_at = None
+
+    @staticmethod
+    def _from_model(model) -> RegisteredTemplate:
+        return RegisteredTemplate(model.id, model.name, model.folder, model.version)
+
+    def register(self, model) -> RegisteredTemplate:
+        """
+        Add or replace a template from its saved model, to be called whenever the model changes.
+        """
+        template = self._from_model(model)
+        with self._lock:
+            previous = self._by_id.get(template.id)
+            if previous is not None and previous.name != template.name \
+                    and self._by_name.get(previous.name) == previous:
+                del self._by_name[previous.name]
+            current = self._by_name.get(template.name)
+            if current is not None and current.id != template.id:
+                # names are unique: the row registered under it before was deleted
+                self._by_id.pop(current.id, None)
+            self._by_id[template.id] = template
+            self._by_name[template.name] = template
+        return template
+
+    def _lookup(self, name, id):
+        if id is None:
+            return self._by_name.get(name), {"name": name}
+        try:
+            id = int(id)
+        except (TypeError, ValueError):
+            return None, None
+        return self._by_id.get(id), {"id": id}
+
+    def get(self, name=None, id=None) -> Optional[RegisteredTemplate]:
+        """
+        Template by name or by id, None when there is none.
+        """
+        self._ensure_loaded()
+        template, lookup = self._lookup(name, id)
+        if template is None and lookup is not None:
+            model = TemplateModel.objects.filter(**lookup).first()
+            if model is not None:
+                template = self.register(model)
+        return template
+
+    async def aget(self, name=None, id=None) -> Optional[RegisteredTemplate]:
+        """
+        get() for async views, only going through a thread when the database has to be queried.
+        """
+        if self._loaded_at is not None:
+            if self._expired():
+                self._refresh()
+            template, _ = self._lookup(name, id)
+            if template is not None:
+                return template
+        return await sync_to_async(self.get)(name, id)
+
+    def templates(self, names=None) -> list:
+        """
+        Registered templates, only the ones of names when given.
+        """
+        self._ensure_loaded()
+        templates = list(self._by_id.values())
+        if names is not None:
+            templates = [template for template in templates if template.name in names]
+        return templates
+
+
+template_registry = TemplateRegistry()
+
+
+def warm_up_templates(names=TEMPLATE_WARM_UP):
+    """
+    Load the template registry, then warm the registered templates up one after another, logging the ones that fail.
+    :param names: Names of the templates, None for all of them, [] for none
+    """
+    start = time.perf_counter()
+    try:
+        # loads the registry, even when no template is warmed up
+        templates = template_registry.templates(names)
+    except DatabaseError as e:
+        __logger.warning("Can not load the template registry: %s", e)
+        return
+    warmed = 0
+    for template in templates:
+        try:
+            warm_up_template(template.folder)
+            warmed += 1
+        except Exception as e:
+            __logger.warning("Can not warm template %s up from %s: %s", template.name, template.folder, e)
+    __logger.info("Warmed %d templates up in %.2f ms", warmed, (time.perf_counter() - start) * 1000)
+
+def start_warm_up(names=TEMPLATE_WARM_UP):
+    """
+    Run warm_up_templates on a background thread, renders arriving meanwhile build what they need themselves.
+    """
+    def run():
+        try:
+            warm_up_templates(names)
+        finally:
+            # database connections are per thread, and this one is done with its own
+            connections.close_all()
+    thread = threading.Thread(target=run, name='template-warm-up', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,172 @@
+import hashlib
+import json
+import os
+import posixpath
+import shutil
+import tempfile
+import time
+from typing import NamedTuple
+
+from jinjaGenerator.settings import TEMPLATE_STORE_DIR, TEMPLATE_VERSION_RETENTION
+from .renderer.fingerprint import IGNORED_FOLDERS, IGNORED_ROOT_FILES
+from .renderer.loader import compile_templates
+from .renderer.materialize import materialize
+
+# content of every uploaded file, stored once under blobs/<2 first hex digits>/<sha1>
+BLOBS_DIR = os.path.join(TEMPLATE_STORE_DIR, 'blobs')
+# one folder per template version, versions/<version>/<template name>, made of hardlinks to the blobs
+VERSIONS_DIR = os.path.join(TEMPLATE_STORE_DIR, 'versions')
+__READ_CHUNK_SIZE = 1024 * 1024
+
+
+class TemplateVersion(NamedTuple):
+    """
+    Immutable version of a template: renders read its folder, which is never modified once created.
+    """
+    version: str  # sha1 of the manifest
+    folder: str
+    manifest: dict  # file path relative to the template folder -> sha1 of its content
+
+
+def __blob_path(content_hash):
+    return os.path.join(BLOBS_DIR, content_hash[:2], content_hash)
+
+def __version_folder(version, template_name):
+    return os.path.join(VERSIONS_DIR, version, template_name)
+
+def __archive_root(zip_file):
+    """
+    First folder at the root of the archive, the template itself; files outside of it are ignored.
+    """
+    for name in zip_file.namelist():
+        if '/' in name:
+            return name.split('/', 1)[0]
+    raise ValueError("No directory found in ZIP file")
+
+def __archive_members(zip_file, root):
+    """
+    Yield (path relative to the template folder, ZipInfo) of the files of the template.
+    """
+    for info in zip_file.infolist():
+        if info.is_dir() or not info.filename.startswith(root + '/'):
+            continue
+        relative_path = posixpath.normpath(info.filename[len(root) + 1:])
+        parts = relative_path.split('/')
+        if relative_path.startswith('/') or '..' in parts or IGNORED_FOLDERS.intersection(parts):
+            continue
+        if len(parts) == 1 and relative_path in IGNORED_ROOT_FILES:
+            continue
+        yield relative_path, info
+
+def __hash_member(zip_file, info):
+    digest = hashlib.sha1()
+    with zip_file.open(info) as f:
+        while chunk := f.read(__READ_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def __store_blob(zip_file, info, content_hash, reuse=True):
+    blob_path = __blob_path(content_hash)
+    if reuse and os.path.exists(blob_path):
+        return blob_path
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(blob_path), prefix='.', suffix='.tmp')
+    try:
+        with open(fd, 'wb') as f, zip_file.open(info) as member:
+            shutil.copyfileobj(member, f, __READ_CHUNK_SIZE)
+        # another upload may have stored the same content meanwhile, either copy is fine
+        os.replace(temp_path, blob_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return blob_path
+
+def __link_blob(zip_file, info, content_hash, output_path):
+    """
+    Store the content of the member and hardlink it to output_path.
+    """
+    try:
+        materialize(__store_blob(zip_file, info, content_hash), output_path, 'hardlink')
+    except FileNotFoundError:
+        # a concurrent prune_template_store removed the blob after it was found: store it again, once linked it has
+        # more than one link and is not pruned anymore
+        materialize(__store_blob(zip_file, info, content_hash, reuse=False), output_path, 'hardlink')
+
+def import_template_archive(zip_file, template_name) -> TemplateVersion:
+    """
+    Store the template of an uploaded ZIP as a new version, or return the existing one when the content is identical.
+    Files are hashed first, straight from the archive: an unchanged upload is only read, nothing is written.
+    New versions are built in a temporary folder, precompiled, then renamed into place,
+    so a version folder is either complete or absent.
+    Raises ValueError when the archive holds no folder, TemplateSyntaxError when a template does not compile.
+    """
+    root = __archive_root(zip_file)
+    members = dict(__archive_members(zip_file, root))
+    manifest = {relative_path: __hash_member(zip_file, info) for relative_path, info in sorted(members.items())}
+    version = hashlib.sha1(json.dumps(manifest, sort_keys=True).encode('utf-8')).hexdigest()
+    version_folder = __version_folder(version, template_name)
+    try:
+        # handed out again: a prune_template_store running meanwhile sees it as just retired and keeps it
+        os.utime(version_folder)
+        return TemplateVersion(version, version_folder, manifest)
+    except FileNotFoundError:
+        pass
+
+    os.makedirs(os.path.dirname(version_folder), exist_ok=True)
+    temp_folder = tempfile.mkdtemp(dir=os.path.dirname(version_folder), prefix='.' + template_name + '.', suffix='.tmp')
+    try:
+        for relative_path, content_hash in manifest.items():
+            output_path = os.path.join(temp_folder, *relative_path.split('/'))
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            __link_blob(zip_file, members[relative_path], content_hash, output_path)
+        compile_templates(temp_folder)
+        try:
+            os.rename(temp_folder, version_folder)
+        except OSError:
+            if not os.path.isdir(version_folder):
+                raise
+            # the same version was uploaded concurrently and is complete: keep that one
+            shutil.rmtree(temp_folder)
+    except BaseException:
+        shutil.rmtree(temp_folder, ignore_errors=True)
+        raise
+    return TemplateVersion(version, version_folder, manifest)
+
+def retire_template_version(folder):
+    """
+    Mark a version folder as no longer active, starting its TEMPLATE_VERSION_RETENTION delay before it can be pruned.
+    """
+    if folder and os.path.isdir(folder) and os.path.abspath(folder).startswith(os.path.abspath(VERSIONS_DIR) + os.sep):
+        os.utime(folder)
+
+def prune_template_store(active_folders):
+    """
+    Delete the version folders that are not active and were retired more than TEMPLATE_VERSION_RETENTION seconds ago,
+    so renders started on them can finish, then the blobs no version links to anymore.
+    """
+    if not os.path.isdir(VERSIONS_DIR):
+        return
+    active_folders = {os.path.abspath(folder) for folder in active_folders}
+    expired_before = time.time() - TEMPLATE_VERSION_RETENTION
+    for version in os.listdir(VERSIONS_DIR):
+        version_dir = os.path.join(VERSIONS_DIR, version)
+        if not os.path.isdir(version_dir):
+            continue
+        for template_name in os.listdir(version_dir):
+            folder = os.path.join(version_dir, template_name)
+            # also removes the temporary folders left by uploads that crashed
+            if folder in active_folders or os.stat(folder).st_mtime > expired_before:
+                continue
+            shutil.rmtree(folder)
+        if not os.listdir(version_dir):
+            os.rmdir(version_dir)
+    if not os.path.isdir(BLOBS_DIR):
+        return
+    for prefix in os.listdir(BLOBS_DIR):
+        prefix_dir = os.path.join(BLOBS_DIR, prefix)
+        for blob in os.listdir(prefix_dir):
+            blob_path = os.path.join(prefix_dir, blob)
+            stat = os.stat(blob_path)
+            # a single link left: no version uses it (or versions hold copies when hardlinks are not supported)
+            if stat.st_nlink == 1 and stat.st_mtime <= expired_before:
+                os.remove(blob_path)
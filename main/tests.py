@@ -1,3 +1,727 @@
-from django.test import TestCase
+import errno
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+import zipfile
+from unittest import mock
 
-# Create your tests here.
+try:
+    import fcntl
+except ImportError:  # not on Windows
+    fcntl = None
+
+from django.conf import settings
+from jinjaGenerator.settings import RENDER_JOB_WORKERS
+from django.db import IntegrityError
+from jinja2 import ChoiceLoader, FileSystemLoader, ModuleLoader, TemplateSyntaxError
+from django.test import SimpleTestCase, TestCase
+
+from .renderer.loader import create_jinja_env, compile_templates
+from .renderer.materialize import materialize, is_materialized
+from .renderer.render_cache import RenderCache
+from .renderer import materialize as materialize_module, workspaces
+from .renderer.renderer import render, render_zip_stream
+from .renderer.wildcard_resolver import resolve_path
+from . import template_store
+from .jobs import submit_render_job, get_render_job
+from .models import Template as TemplateModel
+from .template_registry import TemplateRegistry, template_registry
+
+DEFAULT_TEMPLATE = os.path.join(settings.BASE_DIR, 'templates', 'default_template')
+CONTEXT = {
+    "name": "john_doe", "n": 3,
+    "current_time": "2023-10-01T12:00:00Z",
+    "object": {"name": "a", "value": 2},
+    "config": {"db": {"engine": "postgres"}},
+    "tags": ["x", "y"],
+    "models": [{"name": "user", "hidden": True}, {"name": "post"}, {"name": "comment_long_name_here"}],
+}
+
+
+class TemplateFolderTestCase(SimpleTestCase):
+    """
+    Renders of small template folders written into a temporary folder, with their output next to them.
+    """
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.template_folder = os.path.join(temp_dir.name, 'template')
+        self.output_folder = os.path.join(temp_dir.name, 'output')
+
+    def write_project(self, files, folder='project'):
+        """
+        Write the files of the 'project' folder, or another folder of the template, relative path -> content,
+        None removes the file.
+        """
+        for relative_path, content in files.items():
+            path = os.path.join(self.template_folder, folder, relative_path)
+            if content is None:
+                os.remove(path)
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(content)
+
+    def read_output(self):
+        outputs = {}
+        for root, _, files in os.walk(self.output_folder):
+            for name in files:
+                if not name.startswith('.'):
+                    with open(os.path.join(root, name)) as f:
+                        outputs[os.path.relpath(os.path.join(root, name), self.output_folder)] = f.read()
+        return outputs
+
+
+class WildcardResolverTests(SimpleTestCase):
+    """
+    Paths and '_path' contexts of the documented wildcard forms, as the eval based resolver returned them.
+    """
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.env = create_jinja_env(DEFAULT_TEMPLATE, precompiled=False, lazy_helpers=False)
+
+    def resolve(self, path, context=CONTEXT):
+        return resolve_path(path, context, self.env)
+
+    def test_path_without_wildcards(self):
+        self.assertEqual(self.resolve('t2.html'), [('t2.html', {})])
+
+    def test_dotted_traversal(self):
+        self.assertEqual(self.resolve('t4.%object.name%.%object.value%.html.j2'),
+                         [('t4.a.2.html.j2', {'object': {'name': 'a', 'value': '2'}})])
+        self.assertEqual(self.resolve('%config.db.engine%.cfg'),
+                         [('postgres.cfg', {'config': {'db': {'engine': 'postgres'}}})])
+
+    def test_list_fan_out(self):
+        self.assertEqual(self.resolve('models/%models.name%.out.j2'), [
+            ('models/user.out.j2', {'models': {'name': 'user'}}),
+            ('models/post.out.j2', {'models': {'name': 'post'}}),
+            ('models/comment_long_name_here.out.j2', {'models': {'name': 'comment_long_name_here'}}),
+        ])
+
+    def test_list_of_values_fans_out(self):
+        self.assertEqual(self.resolve('%tags%.txt'), [('x.txt', {'tags': 'x'}), ('y.txt', {'tags': 'y'})])
+
+    def test_filter_chain_with_arguments(self):
+        wildcard = "models.name$context_aware_filter( 'param1')$truncate(10)"
+        self.assertEqual(self.resolve(f"models/%{wildcard}%.txt.j2"), [
+            ('models/VALUEuserP....txt.j2', {'models': {'name': 'user'}, wildcard: 'VALUEuserP...'}),
+            ('models/VALUEpostP....txt.j2', {'models': {'name': 'post'}, wildcard: 'VALUEpostP...'}),
+            ('models/VALUEcomme....txt.j2', {'models': {'name': 'comment_long_name_here'}, wildcard: 'VALUEcomme...'}),
+        ])
+
+    def test_filter_arguments_are_evaluated(self):
+        wildcard = 'models.name$truncate(n + 1)'
+        self.assertEqual([path for path, _ in self.resolve(f"%{wildcard}%.txt")], ['user.txt', 'post.txt', 'comm....txt'])
+        # names that are not defined are used as strings
+        self.assertEqual(self.resolve('%name$replace(john, jane)%.txt')[0][0], 'jane_doe.txt')
+
+    def test_global_function_root(self):
+        self.assertEqual(
+            self.resolve('controller%get_non_hidden_models().name%/%get_non_hidden_models().name$uppercase%.txt.j2'), [
+                ('controllerpost/POST.txt.j2', {'get_non_hidden_models()': {'name': 'post'},
+                                                'get_non_hidden_models().name$uppercase': 'POST'}),
+                ('controllerpost/COMMENT_LONG_NAME_HERE.txt.j2', {
+                    'get_non_hidden_models()': {'name': 'post'},
+                    'get_non_hidden_models().name$uppercase': 'COMMENT_LONG_NAME_HERE'}),
+                ('controllercomment_long_name_here/POST.txt.j2', {
+                    'get_non_hidden_models()': {'name': 'comment_long_name_here'},
+                    'get_non_hidden_models().name$uppercase': 'POST'}),
+                ('controllercomment_long_name_here/COMMENT_LONG_NAME_HERE.txt.j2', {
+                    'get_non_hidden_models()': {'name': 'comment_long_name_here'},
+                    'get_non_hidden_models().name$uppercase': 'COMMENT_LONG_NAME_HERE'}),
+            ])
+
+    def test_multiple_wildcards(self):
+        # the next wildcards see the item of the previous ones: models is the current model in the second one
+        self.assertEqual([path for path, _ in self.resolve('rootdir/service%models.name%/%models.name$uppercase%.txt.j2')], [
+            'rootdir/serviceuser/USER.txt.j2',
+            'rootdir/servicepost/POST.txt.j2',
+            'rootdir/servicecomment_long_name_here/COMMENT_LONG_NAME_HERE.txt.j2',
+        ])
+        self.assertEqual(self.resolve('%models[0].name%-%name%.txt'),
+                         [('user-john_doe.txt', {'models[0]': {'name': 'user'}, 'name': 'john_doe'})])
+
+    def test_invalid_wildcards_raise(self):
+        for path in ('%nope%.txt', '%foo-bar%.txt', '%object.nope%.txt', '%name$nofilter%.txt', '%object%.txt'):
+            with self.subTest(path=path), self.assertRaises(Exception):
+                self.resolve(path)
+
+
+class RenderZipStreamTests(TemplateFolderTestCase):
+    def test_template_output_is_streamed_while_rendered(self):
+        self.write_project({'big.txt.j2': "{% for i in range(300000) %}{{ (i * 7919) % 100003 }}\n{% endfor %}",
+                            'static.txt': "as is"})
+        self.write_project({'assets/large.bin': "0123456789abcdef" * 64 * 1024})
+        chunks = list(render_zip_stream(self.template_folder, {}))
+        self.assertGreater(len(chunks), 10)
+        # no empty response chunks
+        self.assertTrue(all(chunks))
+        with zipfile.ZipFile(io.BytesIO(b''.join(chunks))) as archive:
+            self.assertEqual(archive.read('static.txt'), b"as is")
+            self.assertEqual(archive.read('big.txt').decode().splitlines()[:3], ['0', '7919', '15838'])
+
+
+    def test_outputs_with_the_same_path_are_written_once(self):
+        self.write_project({'%entries.name$first%.txt.j2': "{{ _path['entries']['name'] }}", 'x.txt.j2': "template",
+                            'x.txt': "static", 'models/%entries.name%.txt': "static"})
+        context = {"entries": [{"name": "ab"}, {"name": "ac"}, {"name": "b"}]}
+        with zipfile.ZipFile(io.BytesIO(b''.join(render_zip_stream(self.template_folder, context)))) as archive:
+            names = archive.namelist()
+            self.assertEqual(len(names), len(set(names)))
+            outputs = {name: archive.read(name).decode() for name in names}
+        render(self.template_folder, context, workers=0, incremental=False, output_folder=self.output_folder)
+        self.assertEqual(outputs, self.read_output())
+        self.assertEqual(outputs['a.txt'], "ac")
+
+
+class IncrementalRenderTests(TemplateFolderTestCase):
+    def setUp(self):
+        super().setUp()
+        self.write_project({
+            't1.html.j2': "{{ title }}",
+            'z.txt.j2': "{% if fail %}{{ missing.attribute }}{% endif %}done",
+        })
+
+    def render(self, context, **kwargs):
+        kwargs.setdefault('workers', 0)
+        return render(self.template_folder, context, incremental=True, output_folder=self.output_folder, **kwargs)
+
+    def test_render_after_a_failed_render(self):
+        for track_dependencies in (False, True):
+            with self.subTest(track_dependencies=track_dependencies):
+                self.render({"title": "A"}, track_dependencies=track_dependencies)
+                with self.assertRaises(Exception):
+                    self.render({"title": "B", "fail": True}, track_dependencies=track_dependencies)
+                self.render({"title": "A"}, track_dependencies=track_dependencies)
+                self.assertEqual(self.read_output(), {'t1.html': "A", 'z.txt': "done"})
+
+    def test_tracked_render_after_an_untracked_render(self):
+        self.render({"title": "A"}, track_dependencies=True)
+        self.render({"title": "B"}, track_dependencies=False)
+        self.assertEqual(self.read_output(), {'t1.html': "B", 'z.txt': "done"})
+        self.render({"title": "A"}, track_dependencies=True)
+        self.assertEqual(self.read_output(), {'t1.html': "A", 'z.txt': "done"})
+
+    def test_outputs_of_unchanged_keys_are_reused(self):
+        self.write_project({'other.txt.j2': "{{ other }}"})
+        self.render({"title": "A", "other": 1}, track_dependencies=True)
+        os.utime(os.path.join(self.output_folder, 'other.txt'), (0, 0))
+        self.render({"title": "B", "other": 1}, track_dependencies=True)
+        self.assertEqual(self.read_output(), {'t1.html': "B", 'z.txt': "done", 'other.txt': "1"})
+        # not written again
+        self.assertEqual(os.stat(os.path.join(self.output_folder, 'other.txt')).st_mtime, 0)
+
+
+class PoolRenderTests(TemplateFolderTestCase):
+    def setUp(self):
+        super().setUp()
+        self.write_project({
+            'index.txt.j2': "{% for model in models %}{{ model.name }}\n{% endfor %}",
+            'models/%models.name%.txt.j2': "{{ _path.models.name | upper }} {{ title }}",
+            '%models.name$first%.txt.j2': "{{ _path.models.name }}",
+            'static/logo.txt': "as is",
+        })
+
+    def render_variants(self, contexts, incremental):
+        # the output trees of the same renders, one after another, on a thread pool and on a process pool
+        trees = {}
+        for name, workers, executor in (('serial', 0, None), ('thread', 3, 'thread'), ('process', 3, 'process')):
+            self.output_folder = os.path.join(os.path.dirname(self.template_folder), name)
+            for context in contexts:
+                render(self.template_folder, context, workers=workers, executor=executor, incremental=incremental,
+                       output_folder=self.output_folder, use_cache=False)
+            trees[name] = self.read_output()
+        return trees
+
+    def test_pools_write_the_same_outputs(self):
+        models = [{"name": name} for name in ("user", "post", "page", "comment")]
+        for incremental in (False, True):
+            with self.subTest(incremental=incremental):
+                trees = self.render_variants([{"title": "A", "models": models},
+                                              {"title": "B", "models": models[1:]}], incremental)
+                self.assertEqual(len(trees['serial']), 7)
+                self.assertEqual(trees['serial']['p.txt'], "page")
+                self.assertEqual(trees['thread'], trees['serial'])
+                self.assertEqual(trees['process'], trees['serial'])
+
+
+class CompiledTemplatesTests(TemplateFolderTestCase):
+    def setUp(self):
+        super().setUp()
+        self.write_project({'a.txt.j2': "{% import 'macros/m' as m %}{{ m.hello(name) }}", 'static.txt': "as is"})
+        self.write_project({'m': "{% macro hello(name) %}hello {{ name }}{% endmacro %}"}, 'macros')
+
+    def test_compiled_archive_is_used(self):
+        archive_path = compile_templates(self.template_folder)
+        with zipfile.ZipFile(archive_path) as archive:
+            # the templates of project/ and every file of macros/, not the static files
+            self.assertEqual(len([name for name in archive.namelist() if name.endswith('.py')]), 2)
+        env = create_jinja_env(self.template_folder)
+        self.assertIsInstance(env.loader, ChoiceLoader)
+        self.assertIsInstance(env.loader.loaders[0], ModuleLoader)
+        self.assertEqual(env.get_template('project/a.txt.j2').render(name="x"), "hello x")
+        self.assertIsInstance(create_jinja_env(self.template_folder, precompiled=False).loader, FileSystemLoader)
+
+    def test_stale_archive_is_ignored(self):
+        compile_templates(self.template_folder)
+        self.write_project({'a.txt.j2': "changed {{ name }}"})
+        env = create_jinja_env(self.template_folder)
+        self.assertIsInstance(env.loader, FileSystemLoader)
+        self.assertEqual(env.get_template('project/a.txt.j2').render(name="x"), "changed x")
+
+    def test_syntax_errors_raise(self):
+        self.write_project({'bad.txt.j2': "{% if %}"})
+        with self.assertRaises(TemplateSyntaxError):
+            compile_templates(self.template_folder)
+        # neither the archive nor its temporary file is left
+        self.assertEqual(sorted(os.listdir(self.template_folder)), ['macros', 'project'])
+
+
+class LazyHelpersTests(TemplateFolderTestCase):
+    def helper(self, source):
+        # the module appends to <template>/imports.txt when it is imported
+        return f"open(__file__.rsplit('/', 2)[0] + '/imports.txt', 'a').write(__name__ + '\\n')\n{source}"
+
+    def imports(self):
+        path = os.path.join(self.template_folder, 'imports.txt')
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            return f.read().split()
+
+    def render_text(self, env, source):
+        return env.from_string(source).render()
+
+    def test_modules_are_imported_on_first_call(self):
+        self.write_project({'a.txt.j2': "{{ 'x' | shout }}"})
+        self.write_project({'text.py': self.helper("def shout(value):\n    return value.upper() + '!'\n")}, 'filters')
+        env = create_jinja_env(self.template_folder, lazy_helpers=True)
+        self.assertEqual(self.imports(), [])
+        self.assertEqual(self.render_text(env, "{{ 'x' | shout }}{{ 'y' | shout }}"), "X!Y!")
+        self.assertEqual(self.imports(), ['text'])
+        # the proxy is replaced by the function once imported
+        self.assertEqual(env.filters['shout'].__module__, 'text')
+
+    def test_star_imports_and_referenced_constants_are_imported_eagerly(self):
+        self.write_project({'a.txt.j2': "{{ GREETING }}"})
+        self.write_project({
+            'star.py': self.helper("from os.path import *\n"),
+            'constants.py': self.helper("GREETING = 'hello'\n"),
+            'unused.py': self.helper("OTHER = 'unused'\ndef helper():\n    return OTHER\n"),
+        }, 'globals')
+        env = create_jinja_env(self.template_folder, lazy_helpers=True)
+        self.assertEqual(sorted(self.imports()), ['constants', 'star'])
+        self.assertEqual(self.render_text(env, "{{ GREETING }}"), "hello")
+        self.assertNotIn('OTHER', env.globals)
+        self.assertEqual(self.render_text(env, "{{ helper() }}"), "unused")
+        self.assertEqual(env.globals['OTHER'], 'unused')
+
+    def test_later_files_override_earlier_ones_in_both_modes(self):
+        self.write_project({'a.txt.j2': "{{ 'x' | label }}"})
+        self.write_project({
+            'first.py': "def label(value):\n    return 'first'\n\ndef only_first(value):\n    return 'first'\n",
+            'second.py': "def label(value):\n    return 'second'\n",
+        }, 'filters')
+        # files are registered in the order the folder lists them
+        last = [name for name in os.listdir(os.path.join(self.template_folder, 'filters')) if name.endswith('.py')][-1]
+        outputs = {}
+        for lazy in (False, True):
+            env = create_jinja_env(self.template_folder, lazy_helpers=lazy)
+            outputs[lazy] = self.render_text(env, "{{ 'x' | label }} {{ 'x' | only_first }}")
+        self.assertEqual(outputs[False], f"{last[:-3]} first")
+        self.assertEqual(outputs[True], outputs[False])
+
+
+class PureFragmentTests(TemplateFolderTestCase):
+    def test_pure_fragments_are_rendered_once_per_arguments(self):
+        calls = []
+        self.write_project({'f.txt': "{{ count(x) }}{{ x }}"}, 'fragments')
+        self.write_project({
+            'a.txt.j2': "{{ render_fragment('f.txt', {'x': 1}, pure=True) }}"
+                        "{{ render_fragment('f.txt', {'x': 1}, pure=True) }}"
+                        "{{ render_fragment('f.txt', {'x': 2}, pure=True) }}"
+                        "{{ render_fragment('f.txt', {'x': 1}) }}",
+            # the memo is shared by the outputs of the render
+            'b.txt.j2': "{{ render_fragment('f.txt', {'x': 2}, pure=True) }}"
+                        "{{ render_fragment('f.txt', {'x': 1}, overrides_context=True, pure=True) }}",
+        })
+        for _ in range(2):
+            render(self.template_folder, {"count": lambda x: calls.append(x) or ''}, workers=0, incremental=False,
+                   output_folder=self.output_folder, use_cache=False)
+            self.assertEqual(self.read_output(), {'a.txt': "1121", 'b.txt': "21"})
+            # pure with the same arguments once, then again for another overrides_context, and every impure call
+            self.assertEqual(sorted(calls), [1, 1, 1, 2])
+            # the memo only lasts one render
+            calls.clear()
+
+
+class MaterializeTests(TemplateFolderTestCase):
+    def setUp(self):
+        super().setUp()
+        # strategies that failed are remembered per device, for the whole process
+        patcher = mock.patch.object(materialize_module, '__unsupported', set())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.write_project({'static.txt': "as is"})
+        self.source_path = os.path.join(self.template_folder, 'project', 'static.txt')
+        os.makedirs(self.output_folder)
+        self.output_path = os.path.join(self.output_folder, 'static.txt')
+
+    def assertCopied(self, shared):
+        with open(self.output_path) as f:
+            self.assertEqual(f.read(), "as is")
+        self.assertEqual(os.path.samefile(self.source_path, self.output_path), shared)
+        self.assertTrue(is_materialized(self.source_path, self.output_path))
+
+    def test_strategies(self):
+        for strategy, used, shared in (('hardlink', {'hardlink'}, True), ('copy', {'copy'}, False),
+                                       ('auto', {'reflink', 'copy_file_range', 'copy'}, False)):
+            with self.subTest(strategy=strategy):
+                self.assertIn(materialize(self.source_path, self.output_path, strategy), used)
+                self.assertCopied(shared)
+                # already there: left as is
+                self.assertIsNone(materialize(self.source_path, self.output_path, strategy))
+                os.remove(self.output_path)
+
+    def test_hardlinks_fall_back_to_a_copy(self):
+        with mock.patch.object(materialize_module.os, 'link', side_effect=OSError(errno.EXDEV, "cross device")) as link:
+            for _ in range(2):
+                self.assertEqual(materialize(self.source_path, self.output_path, 'hardlink'), 'copy')
+                self.assertCopied(shared=False)
+                os.remove(self.output_path)
+        # not tried again on the same devices
+        self.assertEqual(link.call_count, 1)
+
+    def test_other_errors_raise(self):
+        with self.assertRaises(FileNotFoundError):
+            materialize(self.source_path + '.missing', self.output_path, 'hardlink')
+
+    def test_rendered_static_files_are_hardlinked(self):
+        # other.txt.j2 is written after the static other.txt, over its hardlink
+        self.write_project({'other.txt': "static", 'other.txt.j2': "{{ n }}"})
+        with mock.patch.object(materialize_module, 'RENDER_STATIC_STRATEGY', 'hardlink'):
+            render(self.template_folder, {"n": 1}, workers=0, incremental=False, output_folder=self.output_folder)
+        self.assertCopied(shared=True)
+        self.assertEqual(self.read_output(), {'static.txt': "as is", 'other.txt': "1"})
+        with open(os.path.join(self.template_folder, 'project', 'other.txt')) as f:
+            self.assertEqual(f.read(), "static")
+
+
+class RenderCacheTests(TemplateFolderTestCase):
+    def render_twice(self, context):
+        # the second render takes the outputs of the first one from the render cache
+        outputs = []
+        for _ in range(2):
+            render(self.template_folder, context, workers=0, incremental=False, output_folder=self.output_folder)
+            outputs.append(self.read_output())
+        render(self.template_folder, context, workers=0, incremental=False, output_folder=self.output_folder,
+               use_cache=False)
+        outputs.append(self.read_output())
+        return outputs
+
+    def test_entries_over_the_entry_limit_are_not_cached(self):
+        cache = RenderCache(max_entries=10, max_bytes=100, max_entry_bytes=10)
+        # counted in UTF-8 bytes, 2 per character here
+        cache.put('small', "é" * 5)
+        cache.put('large', "é" * 6)
+        self.assertEqual(cache.get('small'), "é" * 5)
+        self.assertIsNone(cache.get('large'))
+        self.assertEqual(cache.stats()['bytes'], 10)
+
+    def test_outputs_over_the_entry_limit_are_streamed_to_disk(self):
+        self.write_project({'big.txt.j2': "{% for i in range(20000) %}{{ i }}\n{% endfor %}{{ probe() }}"})
+        output_path = os.path.join(self.output_folder, 'big.txt')
+        written_before_end = []
+
+        def probe():
+            written_before_end.append(os.path.getsize(output_path))
+            return ''
+        cache = RenderCache(max_entries=10, max_bytes=1024 * 1024, max_entry_bytes=1024)
+        with mock.patch('main.renderer.renderer.render_cache', cache), \
+                mock.patch('main.renderer.renderer.RENDER_WRITE_BUFFER_SIZE', 4096):
+            for _ in range(2):
+                render(self.template_folder, {"probe": probe}, workers=0, incremental=False,
+                       output_folder=self.output_folder)
+        # the file holds most of the output while the template still renders, and the cache none of it
+        self.assertGreater(written_before_end[0], 100 * 1024)
+        self.assertEqual(len(written_before_end), 2)
+        self.assertEqual(cache.stats()['entries'], 0)
+        self.assertEqual(cache.stats()['hits'], 0)
+        self.assertEqual(self.read_output()['big.txt'], ''.join(f"{i}\n" for i in range(20000)))
+
+    def test_templates_with_the_same_output_path(self):
+        self.write_project({'x.txt.j2': "A {{ n }}", 'x.txt.jinja': "B {{ n }}"})
+        first, cached, uncached = self.render_twice({"n": 1})
+        self.assertEqual(first, uncached)
+        self.assertEqual(cached, uncached)
+
+    def test_outputs_with_the_same_path_and_another_path_context(self):
+        self.write_project({'%entries.name$first%.txt.j2': "{{ _path['entries']['name'] }}"})
+        first, cached, uncached = self.render_twice({"entries": [{"name": "ab"}, {"name": "ac"}]})
+        self.assertEqual(uncached, {'a.txt': "ac"})
+        self.assertEqual(first, uncached)
+        self.assertEqual(cached, uncached)
+
+    def test_outputs_with_the_same_path_in_tracked_incremental_renders(self):
+        self.write_project({'%entries.name$first%.txt.j2': "{{ _path['entries']['name'] }}"})
+        context = {"entries": [{"name": "ab"}, {"name": "ac"}]}
+        output_folder = self.output_folder
+        for workers in (0, 2):
+            self.output_folder = f"{output_folder}-{workers}"
+            with self.subTest(workers=workers):
+                for _ in range(2):
+                    render(self.template_folder, context, workers=workers, executor='thread', incremental=True,
+                           output_folder=self.output_folder, track_dependencies=True)
+                    self.assertEqual(self.read_output(), {'a.txt': "ac"})
+                with open(os.path.join(self.output_folder, '.render-manifest.json')) as f:
+                    self.assertEqual(json.load(f), {'a.txt': hashlib.sha1(b"ac").hexdigest()})
+
+
+class TemplateStoreTests(SimpleTestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        for name, value in (('BLOBS_DIR', os.path.join(temp_dir.name, 'blobs')),
+                            ('VERSIONS_DIR', os.path.join(temp_dir.name, 'versions')),
+                            ('TEMPLATE_VERSION_RETENTION', 60)):
+            patcher = mock.patch.object(template_store, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def upload(self, files, template_name='template'):
+        archive_bytes = io.BytesIO()
+        with zipfile.ZipFile(archive_bytes, 'w') as archive:
+            for relative_path, content in files.items():
+                archive.writestr('uploaded/' + relative_path, content)
+        with zipfile.ZipFile(archive_bytes) as archive:
+            return template_store.import_template_archive(archive, template_name)
+
+    def test_versions(self):
+        files = {'project/a.txt.j2': "{{ a }}", 'project/static.txt': "as is"}
+        first = self.upload(files)
+        self.assertEqual(first.manifest['project/static.txt'], hashlib.sha1(b"as is").hexdigest())
+        with open(os.path.join(first.folder, 'project', 'a.txt.j2')) as f:
+            self.assertEqual(f.read(), "{{ a }}")
+        # an unchanged upload keeps its version
+        self.assertEqual(self.upload(files), first)
+        # a changed one creates a new version, sharing the blobs of the unchanged files
+        second = self.upload({**files, 'project/a.txt.j2': "{{ b }}"})
+        self.assertNotEqual(second.version, first.version)
+        self.assertNotEqual(second.folder, first.folder)
+        self.assertEqual(os.stat(os.path.join(second.folder, 'project', 'static.txt')).st_nlink, 3)
+        with open(os.path.join(first.folder, 'project', 'a.txt.j2')) as f:
+            self.assertEqual(f.read(), "{{ a }}")
+
+    def test_prune_keeps_the_current_and_the_reused_versions(self):
+        files = {'project/a.txt.j2': "{{ a }}", 'project/static.txt': "as is"}
+        first = self.upload(files)
+        current = self.upload({**files, 'project/a.txt.j2': "{{ b }}"})
+        template_store.retire_template_version(first.folder)
+        os.utime(first.folder, (0, 0))
+        # handed out again before the prune
+        self.assertEqual(self.upload(files), first)
+        template_store.prune_template_store([current.folder])
+        self.assertTrue(os.path.isdir(first.folder))
+
+        os.utime(first.folder, (0, 0))
+        blobs = [os.path.join(root, name) for root, _, names in os.walk(template_store.BLOBS_DIR) for name in names]
+        for blob in blobs:
+            os.utime(blob, (0, 0))
+        template_store.prune_template_store([current.folder])
+        self.assertFalse(os.path.exists(first.folder))
+        self.assertTrue(os.path.isdir(current.folder))
+        with open(os.path.join(current.folder, 'project', 'static.txt')) as f:
+            self.assertEqual(f.read(), "as is")
+        # only the blob of the pruned version is removed
+        self.assertEqual(sorted(os.path.basename(blob) for blob in blobs if os.path.exists(blob)),
+                         sorted(current.manifest.values()))
+
+
+class TemplateRegistryTests(TestCase):
+    def test_lookups(self):
+        model = TemplateModel.objects.create(name='a', folder='/a/1', version='1')
+        registry = TemplateRegistry(ttl=None)
+        template = registry.get(name='a')
+        self.assertEqual(template, (model.id, 'a', '/a/1', '1'))
+        with self.assertNumQueries(0):
+            self.assertEqual(registry.get(id=model.id), template)
+            self.assertEqual(registry.get(id=str(model.id)), template)
+            self.assertIsNone(registry.get(id='nope'))
+        # uploaded through another process: looked up in the database, then registered
+        other = TemplateModel.objects.create(name='b', folder='/b/1')
+        self.assertEqual(registry.get(name='b').id, other.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(registry.get(name='b').id, other.id)
+        self.assertIsNone(registry.get(name='missing'))
+
+    def test_register_and_reload(self):
+        model = TemplateModel.objects.create(name='a', folder='/a/1')
+        registry = TemplateRegistry(ttl=60)
+        registry.load()
+        model.folder = '/a/2'
+        model.save()
+        # saved by this process
+        registry.register(model)
+        self.assertEqual(registry.get(name='a').folder, '/a/2')
+        # deleted and uploaded again: the new row replaces the old one under its name
+        model.delete()
+        recreated = TemplateModel.objects.create(name='a', folder='/a/3')
+        registry.register(recreated)
+        self.assertEqual(registry.get(name='a').id, recreated.id)
+        self.assertIsNone(registry.get(id=-1))
+        # saved by another process: seen once the registry reloads
+        TemplateModel.objects.filter(id=recreated.id).update(folder='/a/4')
+        self.assertEqual(registry.get(name='a').folder, '/a/3')
+        registry.load()
+        self.assertEqual(registry.get(name='a').folder, '/a/4')
+        self.assertEqual([template.name for template in registry.templates()], ['a'])
+
+    def test_expired_registry_serves_from_memory_while_reloading(self):
+        TemplateModel.objects.create(name='a', folder='/a/1')
+        registry = TemplateRegistry(ttl=0)
+        registry.load()
+        with mock.patch.object(registry, '_refresh') as refresh, self.assertNumQueries(0):
+            self.assertEqual(registry.get(name='a').folder, '/a/1')
+        refresh.assert_called_once_with()
+
+    def test_names_are_unique(self):
+        TemplateModel.objects.create(name='a', folder='/a/1')
+        with self.assertRaises(IntegrityError):
+            TemplateModel.objects.create(name='a', folder='/a/2')
+
+
+class BatchRenderViewTests(TemplateFolderTestCase, TestCase):
+    def setUp(self):
+        super().setUp()
+        # the process-wide registry would keep the templates of the rolled back test transactions
+        template_registry.clear()
+        self.addCleanup(template_registry.clear)
+        self.write_project({
+            'a.txt.j2': "{{ title }}",
+            'b.txt.j2': "{% if fail %}{{ missing.attribute }}{% endif %}done",
+        })
+        TemplateModel.objects.create(name='batch', folder=self.template_folder)
+
+    def test_json_lines_with_a_failing_item(self):
+        body = '{"title": "A"}\n\n{"title": "B", "fail": true}\n'
+        response = self.client.post('/template/render/batch?template_name=batch', body,
+                                    content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        with zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content))) as archive:
+            names = archive.namelist()
+            self.assertEqual({name.split('/')[0] for name in names if '/' in name}, {'0000', '0001'})
+            self.assertEqual(archive.read('0000/a.txt'), b"A")
+            self.assertEqual(archive.read('0000/b.txt'), b"done")
+            self.assertNotIn('0000.error.txt', names)
+            self.assertEqual(archive.read('0001/a.txt'), b"B")
+            self.assertTrue(archive.read('0001.error.txt').decode().startswith("Failed to render item 1: "))
+
+
+class RenderJobTests(TemplateFolderTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(workspaces, 'WORKSPACES_DIR', os.path.join(self.output_folder, 'workspaces'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.write_project({
+            'a.txt.j2': "{{ title }}",
+            'b.txt.j2': "{{ wait() }}{% if fail %}{{ missing.attribute }}{% endif %}done",
+            '%models%.txt.j2': "{{ _path.models }}",
+        })
+        self.jobs = []
+        self.release = threading.Event()
+        # the jobs end before their folders are removed
+        self.addCleanup(lambda: [self.wait_for(job, lambda: job.finished) for job in self.jobs])
+        self.addCleanup(self.release.set)
+
+    def submit(self, **context):
+        job = submit_render_job('template', self.template_folder,
+                                {"title": "A", "models": ["x", "y"], "wait": lambda: self.release.wait(10) and '',
+                                 **context})
+        self.jobs.append(job)
+        return job
+
+    def wait_for(self, job, condition):
+        deadline = time.monotonic() + 10
+        while not condition():
+            self.assertLess(time.monotonic(), deadline, f"job still {job.status}")
+            time.sleep(0.005)
+
+    def test_lifecycle(self):
+        running = [self.submit() for _ in range(RENDER_JOB_WORKERS)]
+        queued = self.submit()
+        for job in running:
+            # the files are counted before they are written
+            self.wait_for(job, lambda: job.files_total is not None)
+            self.assertEqual((job.status, job.files_total, job.finished_at), ('running', 4, None))
+            self.assertLess(job.files_done, job.files_total)
+        self.assertEqual((queued.status, queued.started_at, queued.files_total), ('queued', None, None))
+        self.release.set()
+        for job in running + [queued]:
+            self.wait_for(job, lambda: job.finished)
+            self.assertEqual(job.status, 'done')
+            self.assertEqual(get_render_job(job.id), job)
+            self.assertEqual((job.files_done, job.files_total, job.error), (4, 4, None))
+            self.assertLessEqual(job.created_at, job.started_at)
+            self.assertLessEqual(job.started_at, job.finished_at)
+            with open(os.path.join(job.output_folder, 'y.txt')) as f:
+                self.assertEqual(f.read(), "y")
+
+    def test_failed_job(self):
+        self.release.set()
+        with self.assertLogs('main.jobs', 'ERROR'):
+            job = self.submit(fail=True)
+            self.wait_for(job, lambda: job.finished)
+        self.assertEqual(job.status, 'failed')
+        self.assertIn("missing", job.error)
+        self.assertIsNotNone(job.finished_at)
+        self.assertEqual(job.to_dict()['status'], 'failed')
+
+
+@unittest.skipIf(fcntl is None, "workspaces are only locked across processes with fcntl")
+class WorkspacesTests(SimpleTestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        for name, value in (('WORKSPACES_DIR', temp_dir.name), ('RENDER_WORKSPACE_MAX_BYTES', 0)):
+            patcher = mock.patch.object(workspaces, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def finished_workspace(self):
+        workspace = workspaces.create_workspace('template')
+        with open(os.path.join(workspace, 'output.txt'), 'w') as f:
+            f.write("output")
+        workspaces.release_workspace(workspace)
+        return workspace
+
+    def test_workspaces_locked_by_another_process_are_not_collected(self):
+        finished = self.finished_workspace()
+        other = self.finished_workspace()
+        # what a render of another process holds while it writes into the workspace
+        with open(os.path.join(os.path.dirname(other), '.' + os.path.basename(other) + '.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            active = workspaces.create_workspace('template')
+            self.assertEqual(workspaces.collect_workspaces(), 1)
+            self.assertFalse(os.path.exists(finished))
+            self.assertTrue(os.path.isdir(other))
+            self.assertTrue(os.path.isdir(active))
+        workspaces.release_workspace(active)
+        # once its lock is released, the other workspace goes over the budget and is collected with its lock file
+        self.assertEqual(workspaces.collect_workspaces(), 1)
+        self.assertFalse(os.path.exists(other))
+        self.assertEqual(sorted(os.listdir(workspaces.WORKSPACES_DIR)),
+                         sorted([os.path.basename(active), '.' + os.path.basename(active) + '.lock']))
+
+    def test_removed_workspaces_leave_no_lock_file(self):
+        workspace = workspaces.create_workspace('template')
+        workspaces.remove_workspace(workspace)
+        self.assertEqual(os.listdir(workspaces.WORKSPACES_DIR), [])
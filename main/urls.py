@@ -2,9 +2,15 @@ from django.conf.urls.static import static
 from django.urls import path
 
 from jinjaGenerator import settings
-from main.views import load_template, render_template
+from main.views import load_template, render_template, render_template_batch, render_cache_stats, \
+    submit_render_job_view, render_job_status, metrics
 
 urlpatterns = [
     path('template/load', load_template),
     path('template/render', render_template),
+    path('template/render/batch', render_template_batch),
+    path('template/render/cache', render_cache_stats),
+    path('template/render/jobs', submit_render_job_view),
+    path('template/render/jobs/<str:job_id>', render_job_status),
+    path('metrics', metrics),
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
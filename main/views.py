@@ -1,14 +1,37 @@
 import datetime
+import hmac
 import json
+import time
 
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
-import os, zipfile, tempfile, shutil
+from jinja2 import TemplateSyntaxError
+import os, zipfile, tempfile
 
+from jinjaGenerator.settings import RENDER_PROFILING_TOKEN, TEMPLATE_WARM_UP
+from .jobs import submit_render_job, get_render_job, QueueFullError
 from .models import Template as TemplateModel
-from .renderer.renderer import render
+from .renderer.fingerprint import forget_fingerprint
+from .renderer.metrics import registry, observe_view, TEMPLATE_UPLOADS, TEMPLATE_UPLOAD_DURATION
+from .renderer.render_cache import render_cache
+from .renderer.profiling import profile_render, PROFILE_SORT_KEYS
+from .renderer.renderer import render, render_zip_stream, render_batch_zip_stream
+from .renderer.timing import RenderTimings
+from .renderer.workspaces import create_workspace, release_workspace, start_workspace_collection
+from .template_registry import template_registry, start_warm_up
+from .template_store import import_template_archive, retire_template_version, prune_template_store
 
 
+def __query_flag(request, name):
+    """
+    Read a boolean query parameter, None when it is not given so the renderer uses its default.
+    """
+    value = request.GET.get(name, None)
+    if value is None:
+        return None
+    return value.lower() in ('1', 'true', 'yes')
+
+@observe_view('load_template')
 @csrf_exempt
 def load_template(request):
     if request.method != 'POST':
@@ -25,7 +48,7 @@ def load_template(request):
         return JsonResponse({"error": "Only ZIP files are allowed"}, status=400)
 
     try:
-        # Create a temporary directory to extract files
+        # Create a temporary directory for the uploaded file
         with tempfile.TemporaryDirectory() as temp_dir:
             # Save uploaded file to temporary location
             temp_zip_path = os.path.join(temp_dir, 'uploaded.zip')
@@ -33,78 +56,254 @@ def load_template(request):
                 for chunk in uploaded_file.chunks():
                     destination.write(chunk)
 
-            # Extract ZIP file
+            # Store the first folder of the ZIP as a version of the template, compiling all templates:
+            # syntax errors are reported before switching to it, and an unchanged upload reuses its version
             with zipfile.ZipFile(temp_zip_path, 'r') as zip_ref:
-                zip_ref.extractall(temp_dir)
-
-            # Find the first directory in the extracted content
-            extracted_items = os.listdir(temp_dir)
-            first_level_dirs = [item for item in extracted_items if
-                                os.path.isdir(os.path.join(temp_dir, item))]
-
-            if not first_level_dirs:
-                return JsonResponse({"error": "No directory found in ZIP file"}, status=400)
-
-            # Get the first folder
-            original_folder_name = first_level_dirs[0]
-            original_folder_path = os.path.join(temp_dir, original_folder_name)
-
-            # Define target directory (templates folder in project root)
-            base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-            templates_dir = os.path.join(base_dir, 'templates')
-
-            # Create templates directory if it doesn't exist
-            os.makedirs(templates_dir, exist_ok=True)
+                start = time.perf_counter()
+                try:
+                    template_version = import_template_archive(zip_ref, template_name)
+                except TemplateSyntaxError as e:
+                    TEMPLATE_UPLOADS.labels('rejected').inc()
+                    return JsonResponse({"error": f"Template syntax error in {e.name} at line {e.lineno}: {e.message}"}, status=400)
+                except ValueError as e:
+                    TEMPLATE_UPLOADS.labels('rejected').inc()
+                    return JsonResponse({"error": str(e)}, status=400)
+                finally:
+                    TEMPLATE_UPLOAD_DURATION.observe(time.perf_counter() - start)
 
-            # Define new folder name (you can customize this)
-            new_folder_path = os.path.join(templates_dir, template_name)
-
-            # Create the template model
-            existing_model = TemplateModel.objects.filter(name=template_name).first()
-            if existing_model:
-                existing_model.folder = new_folder_path
-                existing_model.save()
-            else:
-                TemplateModel.objects.create(name=template_name, folder=new_folder_path)
-
-            # Remove existing folder if it exists
-            if os.path.exists(new_folder_path):
-                shutil.rmtree(new_folder_path)
-
-            # Move and rename the folder
-            shutil.move(original_folder_path, new_folder_path)
+        # Switch the template model to the new version, renders already running keep reading their own folder
+        # names are unique: a concurrent first upload of the same name makes this one update its row
+        existing_model, created = TemplateModel.objects.get_or_create(name=template_name, defaults={
+            "folder": template_version.folder, "version": template_version.version,
+            "manifest": template_version.manifest})
+        unchanged = not created and existing_model.version == template_version.version \
+            and existing_model.folder == template_version.folder
+        TEMPLATE_UPLOADS.labels('unchanged' if unchanged else 'new').inc()
+        if created:
+            template_registry.register(existing_model)
+        elif not unchanged:
+            previous_folder = existing_model.folder
+            existing_model.folder = template_version.folder
+            existing_model.version = template_version.version
+            existing_model.manifest = template_version.manifest
+            existing_model.save(update_fields=['folder', 'version', 'manifest'])
+            template_registry.register(existing_model)
+            retire_template_version(previous_folder)
+            forget_fingerprint(previous_folder)
+        if not unchanged:
+            if TEMPLATE_WARM_UP is None or template_name in TEMPLATE_WARM_UP:
+                start_warm_up([template_name])
+            # an unchanged upload retired nothing, so it has nothing to prune either
+            prune_template_store(TemplateModel.objects.values_list('folder', flat=True))
 
         # return 200 ok and json response with message "Template loaded successfully"
-        return JsonResponse({"message": "Template loaded successfully"}, status=200)
+        return JsonResponse({"message": "Template loaded successfully", "version": template_version.version}, status=200)
 
     except zipfile.BadZipFile:
         return JsonResponse({"error": "Invalid ZIP file"}, status=400)
     except Exception as e:
         return JsonResponse({"error": f"Failed to process file: {str(e)}"}, status=500)
 
-def render_template(request):
-    # get the input of the template from the request body as json
-    if request.method != 'POST':
-        return JsonResponse({"error": "Only POST method allowed"}, status=405)
+def __parse_render_input(request):
+    """
+    Read the JSON context of a render request.
+    :returns: tuple(input_data, error_response), error_response is None when the input is valid
+    """
     try:
         input_str = request.body.decode('utf-8')
         input_data = json.loads(input_str)
     except Exception as e:
-        return JsonResponse({"error": f"Invalid JSON input: {str(e)}"}, status=400)
+        return None, JsonResponse({"error": f"Invalid JSON input: {str(e)}"}, status=400)
     if not input_data:
-        return JsonResponse({"error": "Input data is required"}, status=400)
-    # get the template based on the query parameters 'template_name' or 'template_id'
+        return None, JsonResponse({"error": "Input data is required"}, status=400)
+    return input_data, None
+
+def __template_lookup(request):
+    """
+    Lookup of the template of a render request in the template registry, from the query parameters 'template_name'
+    or 'template_id'.
+    :returns: tuple(lookup_kwargs, error_response), error_response is None when a parameter is given
+    """
     template_name = request.GET.get('template_name', None)
     template_id = request.GET.get('template_id', None)
     if not template_name and not template_id:
-        return JsonResponse({"error": "template_name or template_id query parameter is required"}, status=400)
+        return None, JsonResponse({"error": "template_name or template_id query parameter is required"}, status=400)
     if template_id:
-        template = TemplateModel.objects.filter(id=template_id).first()
-    else:
-        template = TemplateModel.objects.filter(name=template_name).first()
+        return {"id": template_id}, None
+    return {"name": template_name}, None
+
+@observe_view('render_template')
+def render_template(request):
+    # get the input of the template from the request body as json
+    if request.method != 'POST':
+        return JsonResponse({"error": "Only POST method allowed"}, status=405)
+    input_data, error_response = __parse_render_input(request)
+    if error_response:
+        return error_response
+    # get the template based on the query parameters 'template_name' or 'template_id'
+    lookup, error_response = __template_lookup(request)
+    if error_response:
+        return error_response
+    template = template_registry.get(**lookup)
     if not template:
         return JsonResponse({"error": "Template not found"}, status=404)
 
     template_folder = template.folder
-    render(template_folder, input_data)
-    return JsonResponse({"message": f"Rendering template from folder {template_folder} with input {input_data}"}, status=200)
\ No newline at end of file
+    # 'output=zip' streams the rendered files back as a ZIP archive instead of writing them to toutput/
+    if request.GET.get('output', None) == 'zip':
+        response = StreamingHttpResponse(render_zip_stream(template_folder, input_data), content_type='application/zip')
+        response['Content-Disposition'] = f'attachment; filename="{template.name}.zip"'
+        return response
+    # 'profile=top' or 'profile=pstats' runs this render under cProfile, for staff users or with the profiling token
+    if request.GET.get('profile', None):
+        return __profile_render(request, template, input_data)
+    timings = RenderTimings()
+    # 'workspace=1' renders into an output folder of this request only, instead of the shared toutput/<name>
+    if __query_flag(request, 'workspace'):
+        start_workspace_collection()
+        output_folder = create_workspace(template.name)
+        try:
+            render(template_folder, input_data, output_folder=output_folder, timings=timings)
+        finally:
+            release_workspace(output_folder)
+    else:
+        output_folder = render(template_folder, input_data, incremental=__query_flag(request, 'incremental'),
+                               timings=timings)
+    response_data = {"message": f"Rendering template from folder {template_folder} with input {input_data}",
+                     "output_folder": output_folder}
+    # 'timings=1' adds the duration, count and bytes of every phase of the render to the response
+    if __query_flag(request, 'timings'):
+        response_data["timings"] = timings.to_dict()
+    response = JsonResponse(response_data, status=200)
+    response['Server-Timing'] = timings.server_timing()
+    return response
+
+def __profiling_allowed(request):
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_active and user.is_staff:
+        return True
+    token = request.headers.get('X-Profiling-Token', None)
+    return bool(RENDER_PROFILING_TOKEN) and token is not None and hmac.compare_digest(token, RENDER_PROFILING_TOKEN)
+
+def __profile_render(request, template, input_data):
+    """
+    Render under the profiler into a workspace of this request.
+    'profile=top' returns the hottest functions ('profile_limit', 'profile_sort') and the time of every template file,
+    wildcard and fragment; 'profile=pstats' returns the profile itself, to be opened with pstats or snakeviz.
+    """
+    if not __profiling_allowed(request):
+        return JsonResponse({"error": "Profiling requires a staff user or the X-Profiling-Token header"}, status=403)
+    mode = request.GET['profile'].lower()
+    if mode in ('1', 'true', 'yes'):
+        mode = 'top'
+    if mode not in ('top', 'pstats'):
+        return JsonResponse({"error": f"Unknown profile '{mode}', expected 'top' or 'pstats'"}, status=400)
+    try:
+        limit = int(request.GET.get('profile_limit', 30))
+    except ValueError:
+        return JsonResponse({"error": "profile_limit must be an integer"}, status=400)
+    sort = request.GET.get('profile_sort', 'tottime')
+    if sort not in PROFILE_SORT_KEYS:
+        return JsonResponse({"error": f"profile_sort must be one of {', '.join(PROFILE_SORT_KEYS)}"}, status=400)
+
+    start_workspace_collection()
+    output_folder = create_workspace(template.name)
+    try:
+        profile = profile_render(template.folder, input_data, output_folder=output_folder)
+    finally:
+        release_workspace(output_folder)
+    if mode == 'pstats':
+        response = HttpResponse(profile.dump(), content_type='application/octet-stream')
+        response['Content-Disposition'] = f'attachment; filename="{template.name}.prof"'
+    else:
+        response = JsonResponse({"output_folder": output_folder, "profile": profile.to_dict(limit, sort)}, status=200)
+    response['Server-Timing'] = profile.timings.server_timing()
+    return response
+
+@observe_view('render_cache_stats')
+def render_cache_stats(request):
+    if request.method != 'GET':
+        return JsonResponse({"error": "Only GET method allowed"}, status=405)
+    return JsonResponse(render_cache.stats(), status=200)
+
+def __parse_batch_input(request):
+    """
+    Read the contexts of a batch render request: a JSON list, or JSON Lines with one context per line.
+    :returns: tuple(contexts, error_response), error_response is None when every context is valid
+    """
+    try:
+        input_str = request.body.decode('utf-8')
+    except UnicodeDecodeError as e:
+        return None, JsonResponse({"error": f"Invalid input: {str(e)}"}, status=400)
+    if input_str.lstrip().startswith('['):
+        try:
+            contexts = json.loads(input_str)
+        except Exception as e:
+            return None, JsonResponse({"error": f"Invalid JSON input: {str(e)}"}, status=400)
+    else:
+        contexts = []
+        for line_number, line in enumerate(input_str.splitlines(), start=1):
+            if not line.strip():
+                continue
+            try:
+                contexts.append(json.loads(line))
+            except Exception as e:
+                return None, JsonResponse({"error": f"Invalid JSON on line {line_number}: {str(e)}"}, status=400)
+    if not contexts:
+        return None, JsonResponse({"error": "At least one context is required"}, status=400)
+    if not all(isinstance(context, dict) and context for context in contexts):
+        return None, JsonResponse({"error": "Every context must be a non empty JSON object"}, status=400)
+    return contexts, None
+
+@observe_view('render_template_batch')
+def render_template_batch(request):
+    # render the same template for many contexts, returned as one ZIP with a folder per context
+    if request.method != 'POST':
+        return JsonResponse({"error": "Only POST method allowed"}, status=405)
+    contexts, error_response = __parse_batch_input(request)
+    if error_response:
+        return error_response
+    lookup, error_response = __template_lookup(request)
+    if error_response:
+        return error_response
+    template = template_registry.get(**lookup)
+    if not template:
+        return JsonResponse({"error": "Template not found"}, status=404)
+    response = StreamingHttpResponse(render_batch_zip_stream(template.folder, contexts), content_type='application/zip')
+    response['Content-Disposition'] = f'attachment; filename="{template.name}-batch.zip"'
+    return response
+
+@observe_view('submit_render_job')
+async def submit_render_job_view(request):
+    # same input as render_template, but the render runs in the background and its job id is returned right away
+    if request.method != 'POST':
+        return JsonResponse({"error": "Only POST method allowed"}, status=405)
+    input_data, error_response = __parse_render_input(request)
+    if error_response:
+        return error_response
+    lookup, error_response = __template_lookup(request)
+    if error_response:
+        return error_response
+    template = await template_registry.aget(**lookup)
+    if not template:
+        return JsonResponse({"error": "Template not found"}, status=404)
+    try:
+        job = submit_render_job(template.name, template.folder, input_data)
+    except QueueFullError as e:
+        return JsonResponse({"error": f"Too many render jobs: {str(e)}"}, status=429)
+    return JsonResponse(job.to_dict(), status=202)
+
+@observe_view('render_job_status')
+async def render_job_status(request, job_id):
+    if request.method != 'GET':
+        return JsonResponse({"error": "Only GET method allowed"}, status=405)
+    job = get_render_job(job_id)
+    if not job:
+        return JsonResponse({"error": "Job not found"}, status=404)
+    return JsonResponse(job.to_dict(), status=200)
+
+def metrics(request):
+    # scraped by Prometheus: counters, gauges and histograms of this process, in the text format
+    if request.method != 'GET':
+        return JsonResponse({"error": "Only GET method allowed"}, status=405)
+    return HttpResponse(registry.expose(), content_type='text/plain; version=0.0.4; charset=utf-8')